@@ -1,29 +1,54 @@
 """FastAPI application for RAG API."""
 import os
-from dotenv import load_dotenv
-
-# Load environment variables first
-load_dotenv()
-
-# Check for required environment variables
-if not os.getenv("OPENAI_API_KEY"):
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
-
+import asyncio
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
-from .routers import documents, qa, chat
+# Loads environment variables before the routers read their settings
+from .core.config import require_api_key
+from .routers import documents, qa, chat, shard, collections, debug
+from .core.corpus import SHARD_COUNT, ensure_corpus, get_corpus
+from .core.shards import SHARD_URLS, run_shard_sync, close_http_client, render_metrics as render_shard_metrics
+from .core.catalog import ensure_catalog
+from .core.snapshot import load_startup_snapshot
+from .core.watchdog import LOOP_WATCHDOG, start_watchdog, stop_watchdog, get_watchdog
+from .core.admission import ADMISSION_CONTROL, AdmissionMiddleware, get_controller
+from .core.profiler import RequestProfilerMiddleware
+from .core.memory import run_memory_budget
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Create necessary directories
+    # Startup: Fail fast on missing configuration; the OpenAI client itself is
+    # only constructed on first use
+    require_api_key()
+    # Create necessary directories
     os.makedirs(os.getenv("DOCUMENTS_DIR", "./data/documents"), exist_ok=True)
     os.makedirs(os.getenv("EMBEDDINGS_DIR", "./data/embeddings"), exist_ok=True)
+    # Replicas shipped with a snapshot install it instead of building the corpus
+    await asyncio.to_thread(load_startup_snapshot)
+    # Build the shared corpus index if it is missing or stale (only one worker
+    # builds, the others wait on the lock), then map it into this worker
+    await asyncio.to_thread(ensure_corpus)
+    await asyncio.to_thread(get_corpus)
+    # Add documents ingested before the catalog existed (first start only)
+    await asyncio.to_thread(ensure_catalog)
+    # Shard servers keep their part of the corpus in sync with the embeddings
+    shard_sync = asyncio.create_task(run_shard_sync()) if SHARD_COUNT > 1 else None
+    if LOOP_WATCHDOG:
+        start_watchdog()
+    # Evict indexes and caches before the worker outgrows its memory budget
+    memory_budget = asyncio.create_task(run_memory_budget())
     yield
-    # Shutdown: Nothing to clean up for now
+    # Shutdown: Stop the event-loop watchdog and background tasks
+    await stop_watchdog()
+    memory_budget.cancel()
+    if shard_sync is not None:
+        shard_sync.cancel()
+    await close_http_client()
 
 
 # Create FastAPI app
@@ -34,6 +59,14 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Request profiling (admin only); inside admission control so queueing time is not sampled
+if debug.ADMIN_TOKEN:
+    app.add_middleware(RequestProfilerMiddleware)
+
+# Per-lane concurrency budgets; added before CORS so rejections carry CORS headers
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -47,6 +80,9 @@ app.add_middleware(
 app.include_router(documents.router)
 app.include_router(qa.router)
 app.include_router(chat.router)
+app.include_router(shard.router)
+app.include_router(collections.router)
+app.include_router(debug.router)
 
 
 @app.get("/health")
@@ -55,6 +91,21 @@ async def health_check():
     return {"status": "ok", "version": "0.1.0"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Event-loop lag metrics (requires LOOP_WATCHDOG=1), admission and shard counters in Prometheus text format."""
+    watchdog = get_watchdog()
+    if watchdog is None:
+        text = "# Event-loop watchdog disabled; set LOOP_WATCHDOG=1\n"
+    else:
+        text = watchdog.render_metrics()
+    if ADMISSION_CONTROL:
+        text += get_controller().render_metrics()
+    if SHARD_URLS:
+        text += render_shard_metrics()
+    return text
+
+
 def start():
     """Run the API using uvicorn."""
     uvicorn.run(
@@ -0,0 +1,240 @@
+"""Admission control: per-lane concurrency budgets with bounded, prioritized queues.
+
+Each request is assigned to a lane by method and path (``ROUTE_LANES``):
+
+- ``interactive``: questions, chat and shard searches
+- ``bulk``: uploads, deletions and batch question answering
+- ``admin``: embedding repair and status scans, shard refreshes
+
+Requests on other routes (health, metrics, listings) are not limited.
+
+At most ``ADMISSION_CONCURRENCY`` requests run at once, and each lane has its
+own concurrency limit on top of that. A request that cannot start waits in its
+lane's queue. When a slot frees up, waiting requests of the lane with the
+highest priority start first, so interactive traffic is served ahead of bulk
+and admin work. A full queue rejects with 429. A request whose expected wait,
+estimated on arrival from the queue ahead of it and the lane's recent service
+time, exceeds its lane's ``max_wait`` is rejected with 503 at once rather than
+after waiting for nothing; one that still waits longer than ``max_wait`` gets
+503 as well. Both carry a ``Retry-After`` header, so overload shows up as fast
+rejections instead of timeouts.
+"""
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+# Whether requests go through admission control
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1").lower() in ("1", "true", "yes")
+# Requests running at once across all lanes
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "16"))
+# Per lane: priority (lower starts first), concurrent requests, queued requests
+# and longest wait in seconds; ADMISSION_LANES (JSON) overrides entries
+LANES: Dict[str, Dict[str, float]] = {
+    "interactive": {"priority": 0, "concurrency": 16, "queue": 64, "max_wait": 2.0},
+    "bulk": {"priority": 1, "concurrency": 4, "queue": 16, "max_wait": 30.0},
+    "admin": {"priority": 2, "concurrency": 1, "queue": 2, "max_wait": 30.0},
+}
+for _name, _overrides in json.loads(os.getenv("ADMISSION_LANES", "{}")).items():
+    LANES[_name] = {**LANES.get(_name, {}), **_overrides}
+# (method, path prefix, lane); the first match wins
+ROUTE_LANES: List[Tuple[str, str, str]] = [
+    ("POST", "/qa/batch", "bulk"),
+    ("POST", "/qa", "interactive"),
+    ("POST", "/chat", "interactive"),
+    ("POST", "/shard/search", "interactive"),
+    ("POST", "/shard/refresh", "admin"),
+    ("POST", "/documents/process-missing-embeddings", "admin"),
+    ("GET", "/documents/embedding-status", "admin"),
+    ("POST", "/documents", "bulk"),
+    ("PUT", "/documents", "bulk"),
+    ("DELETE", "/documents", "bulk"),
+]
+
+
+def route_lane(method: str, path: str) -> Optional[str]:
+    """Lane of a request, or None if it is not limited."""
+    for route_method, prefix, lane in ROUTE_LANES:
+        if method == route_method and (path == prefix or path.startswith(prefix + "/")):
+            return lane
+    return None
+
+
+class Rejected(Exception):
+    """A request was turned away; carries the status code and the Retry-After seconds."""
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Lane:
+    """Budget, queue and counters of one class of requests."""
+
+    def __init__(self, name: str, priority: float, concurrency: float, queue: float, max_wait: float):
+        self.name = name
+        self.priority = priority
+        self.concurrency = int(concurrency)
+        self.queue = int(queue)
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # Moving average of how long a request holds its slot
+        self.service_time = 1.0
+        self.admitted = 0
+        self.rejected = {429: 0, 503: 0}
+
+    def expected_wait(self) -> float:
+        """Seconds a request arriving now would likely wait for a slot."""
+        return self.service_time * (len(self.waiters) + 1) / max(1, self.concurrency)
+
+    def retry_after(self) -> int:
+        """Seconds until the requests ahead are likely to be done."""
+        ahead = len(self.waiters) + self.active
+        return max(1, math.ceil(self.service_time * ahead / max(1, self.concurrency)))
+
+
+class AdmissionController:
+    """Hands out request slots by lane priority within a global limit."""
+
+    def __init__(self, capacity: int = ADMISSION_CONCURRENCY, lanes: Optional[Dict[str, Dict[str, float]]] = None):
+        self.capacity = capacity
+        self.active = 0
+        self.lanes = {name: Lane(name, **config) for name, config in (lanes or LANES).items()}
+        self._by_priority = sorted(self.lanes.values(), key=lambda lane: lane.priority)
+
+    def _has_room(self, lane: Lane) -> bool:
+        return self.active < self.capacity and lane.active < lane.concurrency
+
+    def _start(self, lane: Lane) -> None:
+        self.active += 1
+        lane.active += 1
+        lane.admitted += 1
+
+    async def acquire(self, name: str) -> None:
+        """Wait for a slot in a lane, or raise ``Rejected``."""
+        lane = self.lanes[name]
+        if not lane.waiters and self._has_room(lane):
+            self._start(lane)
+            return
+        if len(lane.waiters) >= lane.queue:
+            lane.rejected[429] += 1
+            raise Rejected(429, lane.retry_after(), f"Too many queued {name} requests")
+        expected = lane.expected_wait()
+        if expected > lane.max_wait:
+            lane.rejected[503] += 1
+            raise Rejected(
+                503, lane.retry_after(),
+                f"Expected wait of {expected:.1f}s for a {name} slot exceeds {lane.max_wait:g}s"
+            )
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), lane.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                lane.waiters.remove(waiter)
+                lane.rejected[503] += 1
+                raise Rejected(503, lane.retry_after(), f"Waited longer than {lane.max_wait:g}s for a {name} slot")
+        except asyncio.CancelledError:
+            # The client went away; give back a slot that was granted meanwhile
+            if waiter.done():
+                self.release(name, 0.0)
+            else:
+                lane.waiters.remove(waiter)
+            raise
+
+    def release(self, name: str, elapsed: float) -> None:
+        """Free a slot and start the highest-priority waiting requests that fit."""
+        lane = self.lanes[name]
+        self.active -= 1
+        lane.active -= 1
+        lane.service_time = 0.8 * lane.service_time + 0.2 * elapsed
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        for lane in self._by_priority:
+            while lane.waiters and self._has_room(lane):
+                self._start(lane)
+                lane.waiters.popleft().set_result(None)
+            if self.active >= self.capacity:
+                break
+
+    def render_metrics(self) -> str:
+        """Lane gauges and counters in Prometheus text format."""
+        lines = [
+            "# HELP admission_active_requests Requests holding a slot.",
+            "# TYPE admission_active_requests gauge",
+        ]
+        lines += [f'admission_active_requests{{lane="{lane.name}"}} {lane.active}' for lane in self._by_priority]
+        lines += [
+            "# HELP admission_queued_requests Requests waiting for a slot.",
+            "# TYPE admission_queued_requests gauge",
+        ]
+        lines += [f'admission_queued_requests{{lane="{lane.name}"}} {len(lane.waiters)}' for lane in self._by_priority]
+        lines += [
+            "# HELP admission_admitted_total Requests that got a slot.",
+            "# TYPE admission_admitted_total counter",
+        ]
+        lines += [f'admission_admitted_total{{lane="{lane.name}"}} {lane.admitted}' for lane in self._by_priority]
+        lines += [
+            "# HELP admission_rejected_total Requests rejected because the queue was full (429) or the wait was or would be too long (503).",
+            "# TYPE admission_rejected_total counter",
+        ]
+        lines += [
+            f'admission_rejected_total{{lane="{lane.name}",status="{status}"}} {count}'
+            for lane in self._by_priority for status, count in lane.rejected.items()
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class AdmissionMiddleware:
+    """ASGI middleware holding a lane slot for the whole request, streamed bodies included."""
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None):
+        self.app = app
+        self.controller = controller or get_controller()
+
+    async def __call__(self, scope, receive, send):
+        lane = route_lane(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(lane)
+        except Rejected as e:
+            logger.warning(f"Rejected {scope['method']} {scope['path']} with {e.status_code}: {e.reason}")
+            response = JSONResponse(
+                {"detail": e.reason},
+                status_code=e.status_code,
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(lane, time.perf_counter() - start)
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_controller() -> AdmissionController:
+    """The admission controller shared by this worker."""
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController()
+    return _controller
@@ -0,0 +1,368 @@
+"""Persistent document catalog: one row per ingested document.
+
+The catalog is a small SQLite database next to the embeddings, updated
+whenever a document's embeddings are written or deleted. It answers document
+listings (sorted and paginated) and download lookups by id without opening the
+per-document embeddings JSON files, which hold every chunk's text.
+
+Each document belongs to one collection (see ``corpus``), recorded with it.
+
+The catalog also keeps the MinHash signatures of indexed chunks, bucketed for
+near-duplicate lookups (see ``dedup``), and which chunks are duplicates of which.
+
+Catalogs created after documents were already ingested are filled once from
+those JSON files, by the first worker to start.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .document_processor import DOCUMENTS_DIR
+from .dedup import band_keys, chunk_signatures, signature_bytes
+from .corpus import DEFAULT_COLLECTION, collection_dirs, list_collections
+
+# Directory holding the per-document embeddings
+EMBEDDINGS_DIR = Path(os.getenv("EMBEDDINGS_DIR", "./src/api/data/embeddings"))
+# SQLite database of the catalog
+CATALOG_PATH = Path(os.getenv("CATALOG_PATH", str(EMBEDDINGS_DIR / "catalog.sqlite3")))
+
+# Columns the listing can be sorted by, and the SQL ordering for each
+SORT_COLUMNS = {
+    "filename": "filename COLLATE NOCASE",
+    "file_type": "file_type",
+    "size": "size",
+    "pages": "pages",
+    "chunks": "chunks",
+    "ingested_at": "ingested_at",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    document_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    file_type TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    pages INTEGER,
+    chunks INTEGER,
+    ingested_at REAL,
+    path TEXT,
+    collection TEXT NOT NULL DEFAULT 'default'
+);
+CREATE INDEX IF NOT EXISTS documents_filename ON documents (filename COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS documents_ingested_at ON documents (ingested_at);
+CREATE TABLE IF NOT EXISTS chunk_signatures (
+    chunk_id TEXT PRIMARY KEY,
+    document_id TEXT NOT NULL,
+    signature BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_signatures_document ON chunk_signatures (document_id);
+CREATE TABLE IF NOT EXISTS signature_buckets (
+    bucket INTEGER NOT NULL,
+    chunk_id TEXT NOT NULL,
+    document_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS signature_buckets_bucket ON signature_buckets (bucket);
+CREATE INDEX IF NOT EXISTS signature_buckets_document ON signature_buckets (document_id);
+CREATE TABLE IF NOT EXISTS chunk_duplicates (
+    chunk_id TEXT PRIMARY KEY,
+    document_id TEXT NOT NULL,
+    canonical_chunk_id TEXT NOT NULL,
+    canonical_document_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunk_duplicates_document ON chunk_duplicates (document_id);
+CREATE INDEX IF NOT EXISTS chunk_duplicates_canonical ON chunk_duplicates (canonical_document_id);
+"""
+_COLUMNS = (
+    "document_id", "filename", "file_type", "size", "sha256", "pages", "chunks", "ingested_at", "path", "collection"
+)
+# PRAGMA user_version once existing documents (1) and their chunk signatures (2) have been added
+_BACKFILLED = 2
+
+# One connection per thread; SQLite connections cannot be shared between threads
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        CATALOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(CATALOG_PATH, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        # WAL lets workers read while another one writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        _add_collection_column(connection)
+        _local.connection = connection
+    return connection
+
+
+def _add_collection_column(connection: sqlite3.Connection) -> None:
+    """Add the collection column to catalogs created before collections existed."""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(documents)")}
+    if "collection" not in columns:
+        try:
+            connection.execute(
+                f"ALTER TABLE documents ADD COLUMN collection TEXT NOT NULL DEFAULT '{DEFAULT_COLLECTION}'"
+            )
+        except sqlite3.OperationalError:
+            # Another worker added it first
+            pass
+    connection.execute("CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection)")
+
+
+def _file_digest(path: Path) -> Optional[str]:
+    """SHA-256 of a file, or None if it does not exist."""
+    if not path.exists():
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def catalog_entry(
+    document_id: str,
+    document_data: Dict,
+    ingested_at: Optional[float] = None,
+    collection: str = DEFAULT_COLLECTION
+) -> Dict[str, Any]:
+    """Catalog row for a document from its embeddings metadata and original file."""
+    metadata = document_data.get("metadata") or {}
+    # Text documents created from request content are stored as .txt without a file type
+    file_type = metadata.get("file_type") or ".txt"
+    path = DOCUMENTS_DIR / f"{document_id}{file_type}"
+    chunks = document_data.get("chunks", [])
+    pages = {chunk.get("page_number") for chunk in chunks}
+    return {
+        "document_id": document_id,
+        "filename": metadata.get("filename") or f"{document_id}{file_type}",
+        "file_type": file_type,
+        "size": path.stat().st_size if path.exists() else None,
+        "sha256": _file_digest(path),
+        "pages": len(pages - {None}) or (1 if chunks else 0),
+        "chunks": len(chunks),
+        "ingested_at": ingested_at or time.time(),
+        "path": str(path) if path.exists() else None,
+        "collection": collection,
+    }
+
+
+def _upsert(connection: sqlite3.Connection, entry: Dict[str, Any]) -> None:
+    connection.execute(
+        f"INSERT OR REPLACE INTO documents ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+        [entry[column] for column in _COLUMNS]
+    )
+
+
+def _clear_chunks(connection: sqlite3.Connection, document_id: str) -> None:
+    for table in ("chunk_signatures", "signature_buckets", "chunk_duplicates"):
+        connection.execute(f"DELETE FROM {table} WHERE document_id = ?", (document_id,))
+
+
+def _record_chunks(connection: sqlite3.Connection, document_id: str, document_data: Dict) -> None:
+    """Store the signatures of a document's canonical chunks and its duplicate links."""
+    chunks = document_data.get("chunks", [])
+    for chunk_id, signature in chunk_signatures(chunks):
+        connection.execute(
+            "INSERT OR REPLACE INTO chunk_signatures (chunk_id, document_id, signature) VALUES (?, ?, ?)",
+            (chunk_id, document_id, signature_bytes(signature))
+        )
+        connection.executemany(
+            "INSERT INTO signature_buckets (bucket, chunk_id, document_id) VALUES (?, ?, ?)",
+            [(key, chunk_id, document_id) for key in band_keys(signature)]
+        )
+    connection.executemany(
+        "INSERT OR REPLACE INTO chunk_duplicates (chunk_id, document_id, canonical_chunk_id, canonical_document_id) "
+        "VALUES (?, ?, ?, ?)",
+        [
+            (chunk["chunk_id"], document_id, chunk["duplicate_of"], chunk.get("duplicate_document") or document_id)
+            for chunk in chunks if chunk.get("duplicate_of")
+        ]
+    )
+
+
+def record_document(document_id: str, document_data: Dict, collection: str = DEFAULT_COLLECTION) -> None:
+    """Add or update a document and its chunk signatures after its embeddings were written."""
+    entry = catalog_entry(document_id, document_data, collection=collection)
+    connection = _connect()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        _upsert(connection, entry)
+        _clear_chunks(connection, document_id)
+        _record_chunks(connection, document_id, document_data)
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def remove_document(document_id: str) -> bool:
+    """Remove a document and its chunk signatures. Returns False if it was not in the catalog."""
+    connection = _connect()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        removed = connection.execute("DELETE FROM documents WHERE document_id = ?", (document_id,)).rowcount > 0
+        _clear_chunks(connection, document_id)
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return removed
+
+
+def signature_candidates(keys: List[int], collection: Optional[str] = None) -> List[Tuple[str, str, bytes]]:
+    """Indexed chunks sharing at least one LSH bucket: (chunk_id, document_id, signature).
+
+    With ``collection`` set, only chunks of that collection's documents are returned.
+    """
+    query = (
+        "SELECT chunk_id, document_id, signature FROM chunk_signatures WHERE chunk_id IN "
+        f"(SELECT chunk_id FROM signature_buckets WHERE bucket IN ({', '.join('?' * len(keys))}))"
+    )
+    if collection is not None:
+        query += " AND document_id IN (SELECT document_id FROM documents WHERE collection = ?)"
+        return _connect().execute(query, [*keys, collection]).fetchall()
+    return _connect().execute(query, keys).fetchall()
+
+
+def duplicate_dependents(document_id: str) -> Dict[str, List[Tuple[str, str]]]:
+    """Chunks of other documents that use a chunk of this document as their canonical chunk.
+
+    Maps each dependent document id to its (chunk_id, canonical_chunk_id) pairs.
+    """
+    dependents: Dict[str, List[Tuple[str, str]]] = {}
+    for chunk_id, dependent_id, canonical_chunk_id in _connect().execute(
+        "SELECT chunk_id, document_id, canonical_chunk_id FROM chunk_duplicates "
+        "WHERE canonical_document_id = ? AND document_id != ?",
+        (document_id, document_id)
+    ):
+        dependents.setdefault(dependent_id, []).append((chunk_id, canonical_chunk_id))
+    return dependents
+
+
+def duplicate_stats() -> Dict[str, Any]:
+    """Chunks stored, chunks that reuse another chunk's vector, and the resulting index size."""
+    connection = _connect()
+    chunks = connection.execute("SELECT COALESCE(SUM(chunks), 0) FROM documents").fetchone()[0]
+    duplicates = connection.execute("SELECT COUNT(*) FROM chunk_duplicates").fetchone()[0]
+    cross_document = connection.execute(
+        "SELECT COUNT(*) FROM chunk_duplicates WHERE canonical_document_id != document_id"
+    ).fetchone()[0]
+    return {
+        "chunks": chunks,
+        "duplicates": duplicates,
+        "cross_document_duplicates": cross_document,
+        "index_rows": chunks - duplicates,
+        "index_reduction": duplicates / chunks if chunks else 0.0,
+    }
+
+
+def get_document(document_id: str) -> Optional[Dict[str, Any]]:
+    """A document's catalog entry, or None."""
+    row = _connect().execute("SELECT * FROM documents WHERE document_id = ?", (document_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_documents(
+    offset: int = 0,
+    limit: Optional[int] = None,
+    sort: str = "filename",
+    descending: bool = False,
+    collection: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], int]:
+    """A page of catalog entries in the requested order, and the total number of documents.
+
+    With ``collection`` set, only that collection's documents are listed and counted.
+    """
+    order = f"{SORT_COLUMNS[sort]} {'DESC' if descending else 'ASC'}, document_id"
+    where, params = ("WHERE collection = ?", [collection]) if collection is not None else ("", [])
+    connection = _connect()
+    rows = connection.execute(
+        f"SELECT * FROM documents {where} ORDER BY {order} LIMIT ? OFFSET ?",
+        [*params, -1 if limit is None else limit, offset]
+    ).fetchall()
+    total = connection.execute(f"SELECT COUNT(*) FROM documents {where}", params).fetchone()[0]
+    return [dict(row) for row in rows], total
+
+
+def collection_sizes() -> Dict[str, Tuple[int, int]]:
+    """Documents and chunks of each collection that has documents."""
+    return {
+        row[0]: (row[1], row[2]) for row in _connect().execute(
+            "SELECT collection, COUNT(*), COALESCE(SUM(chunks), 0) FROM documents GROUP BY collection"
+        )
+    }
+
+
+def backup_catalog(path: Path) -> None:
+    """Write a consistent copy of the catalog to ``path``."""
+    target = sqlite3.connect(path)
+    try:
+        _connect().backup(target)
+    finally:
+        target.close()
+
+
+def restore_catalog(path: Path) -> None:
+    """Replace the catalog's contents with the database at ``path``."""
+    source = sqlite3.connect(path)
+    try:
+        source.backup(_connect())
+    finally:
+        source.close()
+
+
+def ensure_catalog() -> int:
+    """Add documents ingested before the catalog existed. Returns the number added.
+
+    Chunk signatures of documents that are already in the catalog are added
+    as well. Safe to call from every worker at startup: the first one fills
+    the catalog inside a write transaction, the others find it already done.
+    """
+    connection = _connect()
+    if connection.execute("PRAGMA user_version").fetchone()[0] >= _BACKFILLED:
+        return 0
+    added = 0
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < _BACKFILLED:
+            known = {row[0] for row in connection.execute("SELECT document_id FROM documents")}
+            metadata_files = [
+                (collection, metadata_file)
+                for collection in list_collections()
+                for metadata_file in sorted(collection_dirs(collection)[0].glob("*.json"))
+            ]
+            for collection, metadata_file in metadata_files:
+                try:
+                    with open(metadata_file, "r") as f:
+                        document_data = json.load(f)
+                except Exception as e:
+                    print(f"Error reading metadata file {metadata_file}: {e}")
+                    continue
+                document_id = document_data.get("document_id")
+                if not document_id:
+                    continue
+                if document_id not in known:
+                    known.add(document_id)
+                    _upsert(connection, catalog_entry(
+                        document_id, document_data, metadata_file.stat().st_mtime, collection
+                    ))
+                    added += 1
+                _clear_chunks(connection, document_id)
+                _record_chunks(connection, document_id, document_data)
+            connection.execute(f"PRAGMA user_version = {_BACKFILLED}")
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    if added:
+        print(f"Added {added} existing documents to the catalog")
+    return added
@@ -0,0 +1,58 @@
+"""Environment, shared clients and deferred imports.
+
+Importing the API should be cheap: the OpenAI SDK, FAISS, NumPy, tiktoken and
+pdfplumber together cost well over a second at import time, and most of that is
+not needed to answer a health check. Modules therefore bind those dependencies
+with ``lazy_import`` and obtain clients through the cached factories below,
+which construct them on first use.
+"""
+import os
+import sys
+import importlib.util
+from functools import lru_cache
+from types import ModuleType
+
+from dotenv import load_dotenv
+
+# Load environment variables once, before any module reads its settings
+load_dotenv()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Bind a module whose body only runs on first attribute access."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def require_api_key() -> str:
+    """Return the OpenAI API key, failing if it is not configured."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    return api_key
+
+
+@lru_cache(maxsize=None)
+def get_openai_client():
+    """The process-wide async OpenAI client, created on first use."""
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=require_api_key())
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    """A tiktoken encoding, loaded on first use."""
+    import tiktoken
+
+    return tiktoken.get_encoding(name)
@@ -0,0 +1,144 @@
+"""Token-budgeted packing of the prompt sent to the completion model.
+
+Each model gets a prompt budget in tokens (``CONTEXT_TOKEN_BUDGET``, with
+per-model overrides). The prompt is filled in priority order:
+
+1. the system prompt and the question, which are always sent
+2. the user's meta information, up to ``CONTEXT_META_TOKENS``
+3. the conversation history, up to ``CONTEXT_HISTORY_TOKENS`` and at most half
+   of the room that is left, keeping its end
+4. the retrieved chunks in rank order, as long as they fit
+
+A chunk that no longer fits is trimmed to the remaining room if at least
+``CONTEXT_MIN_CHUNK_TOKENS`` are left, and it and every lower-ranked chunk are
+dropped otherwise. Prompt size, and with it completion latency and cost, no
+longer grows with ``top_k`` or the length of the conversation.
+"""
+import os
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import get_encoding
+
+# Prompt budget in tokens for models without an entry below
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Prompt budgets by model name prefix; CONTEXT_TOKEN_BUDGETS (JSON) adds or overrides entries
+MODEL_TOKEN_BUDGETS: Dict[str, int] = {
+    "gpt-4.1-nano": 4000,
+    "gpt-4.1-mini": 6000,
+    "gpt-4.1": 8000,
+    "gpt-4o-mini": 6000,
+    "gpt-4o": 8000,
+    **json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}")),
+}
+# Most tokens of meta information and conversation history included
+CONTEXT_META_TOKENS = int(os.getenv("CONTEXT_META_TOKENS", "300"))
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CONTEXT_HISTORY_TOKENS", "1500"))
+# A chunk is only trimmed to fit if at least this many tokens are left for it
+CONTEXT_MIN_CHUNK_TOKENS = int(os.getenv("CONTEXT_MIN_CHUNK_TOKENS", "64"))
+# Tokens the chat format adds per message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in a text."""
+    return len(get_encoding().encode_ordinary(text))
+
+
+def token_budget(model: str) -> int:
+    """Prompt budget for a model: the entry with the longest matching prefix, or the default."""
+    matches = [prefix for prefix in MODEL_TOKEN_BUDGETS if model.startswith(prefix)]
+    if not matches:
+        return CONTEXT_TOKEN_BUDGET
+    return MODEL_TOKEN_BUDGETS[max(matches, key=len)]
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_end: bool = False) -> Tuple[str, int]:
+    """Cut a text to at most ``max_tokens`` tokens, keeping its start (or its end)."""
+    encoding = get_encoding()
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    if max_tokens <= 0:
+        return "", 0
+    tokens = tokens[-max_tokens:] if keep_end else tokens[:max_tokens]
+    return encoding.decode(tokens), max_tokens
+
+
+def pack_context(
+    system_prompt: str,
+    query: str,
+    chunks: List[Dict],
+    model: str,
+    conversation_history: Optional[str] = None,
+    meta_information: Optional[str] = None
+) -> Dict[str, Any]:
+    """Build the completion messages within the model's token budget.
+
+    Returns the ``messages``, the ``chunks`` that were included (trimmed ones
+    carry the trimmed text) and the ``tokens`` used by each part.
+    """
+    budget = token_budget(model)
+    tokens = {
+        "system": count_tokens(system_prompt),
+        "query": count_tokens(query),
+        "meta_information": 0,
+        "history": 0,
+        "chunks": 0,
+    }
+    # Three messages: instructions, retrieved context, question
+    used = tokens["system"] + tokens["query"] + 3 * MESSAGE_OVERHEAD_TOKENS
+
+    if meta_information and meta_information.strip():
+        header = "\n\nAdditional context from the user:\n"
+        room = min(CONTEXT_META_TOKENS, budget - used - count_tokens(header))
+        meta_information, meta_tokens = truncate_tokens(meta_information, room)
+        if meta_tokens:
+            system_prompt += f"{header}{meta_information}"
+            tokens["meta_information"] = count_tokens(header) + meta_tokens
+            used += tokens["meta_information"]
+
+    if conversation_history:
+        header = "\n\nPrevious conversation:\n"
+        footer = "\n\nPlease consider the previous conversation when answering the current question."
+        framing = count_tokens(header) + count_tokens(footer)
+        room = min(CONTEXT_HISTORY_TOKENS, (budget - used) // 2 - framing)
+        # Keep the end of the history: the most recent turns matter most
+        conversation_history, history_tokens = truncate_tokens(conversation_history, room, keep_end=True)
+        if history_tokens:
+            system_prompt += f"{header}{conversation_history}{footer}"
+            tokens["history"] = framing + history_tokens
+            used += tokens["history"]
+
+    packed: List[Dict] = []
+    formatted: List[str] = []
+    used += count_tokens("Context:\n")
+    for chunk in chunks:
+        source = chunk.get("metadata", {}).get("filename", "Unknown source")
+        header = f"[Chunk {len(packed) + 1} - Source: {source}]\n"
+        # The header, plus the newlines separating chunks
+        framing = count_tokens(header) + 2
+        text, text_tokens = truncate_tokens(chunk["text"], budget - used - framing)
+        if text != chunk["text"]:
+            if text_tokens < CONTEXT_MIN_CHUNK_TOKENS:
+                break
+            chunk = {**chunk, "text": text}
+        packed.append(chunk)
+        formatted.append(f"{header}{text}\n")
+        chunk_tokens = framing + text_tokens
+        tokens["chunks"] += chunk_tokens
+        used += chunk_tokens
+
+    tokens["total"] = used
+    tokens["budget"] = budget
+    tokens["dropped_chunks"] = len(chunks) - len(packed)
+
+    return {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": "Context:\n" + "\n".join(formatted)},
+            {"role": "user", "content": query}
+        ],
+        "chunks": packed,
+        "tokens": tokens,
+    }
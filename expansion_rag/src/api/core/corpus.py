@@ -0,0 +1,1374 @@
+"""Resident corpus index shared between workers through memory-mapped files.
+
+The per-document ``.index``/``.json`` pairs in ``EMBEDDINGS_DIR`` remain the
+source of truth. From them we maintain an LSM-style segmented index under
+``CORPUS_DIR``:
+
+- ``segments/<name>/``: an immutable segment holding ``vectors.index`` (a
+  FAISS ``IndexFlatL2``), the chunk texts and ids as UTF-8 string tables
+  (``texts.bin``/``texts_offsets.npy``, ``chunk_ids.bin``/``chunk_ids_offsets.npy``),
+  per-chunk ``doc_rows.npy``/``pages.npy`` and a ``manifest.json`` with its
+  level, dimension and document metadata
+- ``generations/<name>.json``: a versioned, immutable list of live segments
+- ``CURRENT``: the name of the live generation
+
+Newly ingested documents are the mutable part of the index: they sit in their
+per-document files until the builder seals them into a small level-0 segment.
+Sealed segments are never modified. Once ``CORPUS_MERGE_FANOUT`` segments
+accumulate on a level, the background merger combines them into one segment on
+the next level, so both ingestion and query cost stay flat as the corpus grows.
+Queries search all live segments in parallel and merge the top-k.
+
+All workers map segment files read-only, so the corpus lives once in the page
+cache no matter how many workers serve it. The version file is replaced
+atomically under a file lock; workers notice a new generation by stat-ing it.
+
+Within a worker, searches pin the generation they started on with
+``acquire_corpus``. Swapping in a new generation only replaces the live
+reference; the old one is retired and released once the last in-flight search
+holding it finishes, and segments are unmapped when no generation uses them.
+Ingestion requests a sync with ``schedule_refresh``, which runs on a single
+background thread and coalesces bursts of uploads.
+
+Deleting a document does not wait for the builder. Instead a tombstone
+``{document_id: source_version}`` is written to ``tombstones.json`` and every
+search excludes rows of that document built from that version or older,
+through a FAISS ID selector. A replaced document's old version is tombstoned
+right after the generation holding its new version is published. Segments
+whose tombstoned rows pass ``CORPUS_COMPACTION_THRESHOLD`` are rewritten
+without them, and obsolete tombstones are dropped.
+
+Metadata filters (document ids, filename substrings, file types and a page
+range) are applied the same way: each segment keeps an attribute index of
+per-document row ranges, per-file-type row masks and the page array, turns a
+filter into a bitmap of matching live rows, and hands it to FAISS as an ID
+selector. Non-matching rows are never scored and segments without matches are
+skipped entirely.
+
+Optionally, searches are routed in two stages. Every segment stores centroid
+vectors for sections of ``ROUTING_SECTION_CHUNKS`` consecutive chunks of each
+document; a generation collects them into one small inner-product index. A
+query first picks the ``route_documents`` documents with the best-matching
+section, then searches only their chunks through the same ID selectors.
+Fewer routed documents mean less work per query at some cost in recall.
+
+For sharded serving (see ``shards``), ``SHARD_COUNT`` servers each keep a
+corpus of only the documents whose id hashes to their ``SHARD_INDEX``, under a
+corpus directory of their own.
+
+Documents are grouped into named collections, each with its own source files
+and segmented index (a ``CorpusStore``). The default collection keeps the
+layout above; a collection ``<name>`` lives in ``EMBEDDINGS_DIR/collections/<name>/``
+with its corpus directory inside. A worker maps a collection's segments on
+the first search of it, and once the collections it maps exceed
+``COLLECTIONS_MEMORY_MB``, unmaps the least recently searched ones. Each
+collection is also a consumer of the worker's memory budget (``memory.py``),
+which can unmap it when the worker as a whole runs short of memory.
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import mmap
+import time
+import fcntl
+import heapq
+import shutil
+import logging
+import zlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .config import lazy_import
+from .memory import get_budget, register_consumer
+
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+# Per-document embeddings written at ingestion time
+EMBEDDINGS_DIR = Path(os.getenv("EMBEDDINGS_DIR", "./src/api/data/embeddings"))
+# Number of shards the corpus is partitioned into, and the shard this server holds
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+# Name of the corpus directory inside a collection's embeddings directory
+CORPUS_DIR_NAME = "corpus" if SHARD_COUNT == 1 else f"corpus-shard{SHARD_INDEX}-of-{SHARD_COUNT}"
+# Directory holding the segmented corpus index of the default collection
+CORPUS_DIR = Path(os.getenv("CORPUS_DIR", str(EMBEDDINGS_DIR / CORPUS_DIR_NAME)))
+# Collection used when a request names none; its files stay directly in EMBEDDINGS_DIR
+DEFAULT_COLLECTION = "default"
+# Directory holding one subdirectory per named collection
+COLLECTIONS_DIR = EMBEDDINGS_DIR / "collections"
+COLLECTION_NAME = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+# Segment files a worker keeps mapped across collections before unmapping the
+# least recently searched ones (0 keeps every collection mapped)
+COLLECTIONS_MEMORY_MB = int(os.getenv("COLLECTIONS_MEMORY_MB", "2048"))
+# Number of most recent generations (and the segments they use) kept on disk
+KEEP_GENERATIONS = int(os.getenv("CORPUS_KEEP_GENERATIONS", "2"))
+# Fraction of tombstoned rows in a segment that triggers its compaction
+COMPACTION_THRESHOLD = float(os.getenv("CORPUS_COMPACTION_THRESHOLD", "0.1"))
+# Number of segments on one level that triggers a merge into the next level
+MERGE_FANOUT = int(os.getenv("CORPUS_MERGE_FANOUT", "4"))
+# Threads used to search segments in parallel
+SEARCH_THREADS = int(os.getenv("CORPUS_SEARCH_THREADS", str(min(8, os.cpu_count() or 1))))
+# Default number of documents a query is routed to (0 searches every document)
+ROUTING_TOP_DOCUMENTS = int(os.getenv("ROUTING_TOP_DOCUMENTS", "0"))
+# Consecutive chunks summarized by one routing centroid (0 means one per document)
+ROUTING_SECTION_CHUNKS = int(os.getenv("ROUTING_SECTION_CHUNKS", "16"))
+
+
+class StringTable:
+    """Read-only, memory-mapped table of UTF-8 strings."""
+
+    def __init__(self, directory: Path, name: str):
+        self.offsets = np.load(directory / f"{name}_offsets.npy", mmap_mode="r")
+        self._buffer = b""
+        path = directory / f"{name}.bin"
+        if path.stat().st_size > 0:
+            with open(path, "rb") as f:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self._buffer[start:end].decode("utf-8")
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+def write_string_table(directory: Path, name: str, strings: List[str]) -> None:
+    """Write strings as a contiguous blob plus an offsets array."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(directory / f"{name}.bin", "wb") as f:
+        for b in encoded:
+            f.write(b)
+    np.save(directory / f"{name}_offsets.npy", offsets)
+
+
+def read_index(path: Path) -> faiss.Index:
+    """Read a FAISS index, memory-mapping it (flat indexes need faiss-cpu 1.11 or newer)."""
+    return faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC)
+
+
+def is_tombstoned(document: Dict, tombstones: Dict[str, int]) -> bool:
+    """Whether a segment's copy of a document is hidden by a tombstone."""
+    return tombstones.get(document["document_id"], -1) >= document["version"]
+
+
+def normalize_filters(filters: Optional[Dict]) -> Optional[Dict]:
+    """Normalize metadata filters, dropping empty ones; None if nothing is filtered.
+
+    Supported keys: ``document_ids`` (exact ids), ``filenames`` (case-insensitive
+    substrings of the original filename), ``file_types`` (e.g. ``.pdf``) and an
+    inclusive ``page_from``/``page_to`` range.
+    """
+    if not filters:
+        return None
+    normalized: Dict = {}
+    if filters.get("document_ids"):
+        normalized["document_ids"] = sorted(set(filters["document_ids"]))
+    if filters.get("filenames"):
+        normalized["filenames"] = sorted({name.lower() for name in filters["filenames"]})
+    if filters.get("file_types"):
+        normalized["file_types"] = sorted({
+            t.lower() if t.startswith(".") else f".{t.lower()}" for t in filters["file_types"]
+        })
+    for bound in ("page_from", "page_to"):
+        if filters.get(bound) is not None:
+            normalized[bound] = int(filters[bound])
+    return normalized or None
+
+
+def filter_key(filters: Optional[Dict]) -> str:
+    """Stable string key for normalized filters."""
+    return json.dumps(filters, sort_keys=True) if filters else ""
+
+
+def document_matches(document: Dict, filters: Dict) -> bool:
+    """Whether a document passes the document-level filters (ids and filenames)."""
+    if "document_ids" in filters and document["document_id"] not in filters["document_ids"]:
+        return False
+    if "filenames" in filters:
+        filename = str(document["metadata"].get("filename") or "").lower()
+        return any(name in filename for name in filters["filenames"])
+    return True
+
+
+def section_centroids(vectors: np.ndarray, doc_starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean vector of each section of consecutive chunks, and the document row of each section."""
+    centroids, owners = [], []
+    for doc_row in range(len(doc_starts) - 1):
+        start, end = int(doc_starts[doc_row]), int(doc_starts[doc_row + 1])
+        step = ROUTING_SECTION_CHUNKS if ROUTING_SECTION_CHUNKS > 0 else max(end - start, 1)
+        for section_start in range(start, end, step):
+            centroids.append(vectors[section_start:min(section_start + step, end)].mean(axis=0))
+            owners.append(doc_row)
+    dimension = vectors.shape[1] if vectors.ndim == 2 else 0
+    return (
+        np.array(centroids, dtype=np.float32).reshape(len(centroids), dimension),
+        np.array(owners, dtype=np.int32)
+    )
+
+
+# Segment files by the part of the index they hold, for memory accounting
+_FILE_PARTS = {
+    "vectors": "vectors",
+    "centroids": "vectors",
+    "centroid_doc_rows": "vectors",
+    "texts": "chunk_text",
+    "chunk_ids": "chunk_text",
+}
+
+
+class Segment:
+    """An immutable, memory-mapped segment of the corpus index."""
+
+    def __init__(self, name: str, directory: Path, tombstones: Callable[[], Tuple[Tuple[int, int], Dict[str, int]]]):
+        self.name = name
+        self.directory = directory
+        # Returns the tombstones of the collection the segment belongs to
+        self._tombstones = tombstones
+        with open(directory / "manifest.json", "r") as f:
+            self.manifest = json.load(f)
+        self.level: int = self.manifest["level"]
+        self.documents: List[Dict] = self.manifest["documents"]
+        self.dimension: Optional[int] = self.manifest.get("dimension")
+        self.index = read_index(directory / "vectors.index") if self.manifest["chunks"] else None
+        self.doc_rows = np.load(directory / "doc_rows.npy", mmap_mode="r")
+        self.pages = np.load(directory / "pages.npy", mmap_mode="r")
+        # Rows of near-duplicate chunks, which only filtered searches return
+        self.duplicate_rows: int = self.manifest.get("duplicates", 0)
+        self.duplicates = np.load(directory / "duplicates.npy", mmap_mode="r") if self.duplicate_rows else None
+        self.texts = StringTable(directory, "texts")
+        self.chunk_ids = StringTable(directory, "chunk_ids")
+        # Bytes of the segment files by part, all of which may be mapped
+        self.file_bytes: Dict[str, int] = {}
+        for path in directory.iterdir():
+            part = _FILE_PARTS.get(path.name.split(".")[0].replace("_offsets", ""), "metadata")
+            self.file_bytes[part] = self.file_bytes.get(part, 0) + path.stat().st_size
+        self.nbytes = sum(self.file_bytes.values())
+        # Number of generations in this worker using the segment
+        self.refs = 0
+        # (tombstones key, live-row bitmap, dead row count), replaced as a whole
+        self._mask: Tuple[Optional[Tuple[int, int]], Optional[np.ndarray], int] = (None, None, 0)
+        # Attribute index for metadata filters, built on first use
+        self._attributes: Optional[Dict] = None
+        # Recent filter selections keyed by (filter key, tombstones key)
+        self._selections: Dict[Tuple[str, Tuple[int, int]], Tuple[np.ndarray, int]] = {}
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal if self.index is not None else 0
+
+    @property
+    def cache_bytes(self) -> int:
+        """Bytes of the tombstone bitmap, attribute index and filter selections built in memory."""
+        _, bitmap, _ = self._mask
+        total = bitmap.nbytes if bitmap is not None else 0
+        attributes = self._attributes
+        if attributes is not None:
+            total += attributes["doc_starts"].nbytes + sum(mask.nbytes for mask in attributes["file_types"].values())
+        total += sum(selected.nbytes for selected, _ in list(self._selections.values()))
+        return total
+
+    def chunk(self, row: int, score: float) -> Dict:
+        """Build the result dict for a chunk row."""
+        document = self.documents[int(self.doc_rows[row])]
+        metadata = dict(document["metadata"])
+        page = int(self.pages[row])
+        metadata["page_number"] = page if page >= 0 else None
+        return {
+            "document_id": document["document_id"],
+            "chunk_id": self.chunk_ids[row],
+            "text": self.texts[row],
+            "score": score,
+            "metadata": metadata
+        }
+
+    def live_bitmap(self) -> Optional[np.ndarray]:
+        """Bitmap of rows not hidden by tombstones, or None if every row is live."""
+        key, tombstones = self._tombstones()
+        mask_key, bitmap, _ = self._mask
+        if key == mask_key:
+            return bitmap
+        dead_docs = [row for row, document in enumerate(self.documents) if is_tombstoned(document, tombstones)]
+        bitmap, dead_rows = None, 0
+        if dead_docs:
+            live = ~np.isin(self.doc_rows, dead_docs)
+            dead_rows = int(len(live) - live.sum())
+            bitmap = np.packbits(live, bitorder="little")
+        self._mask = (key, bitmap, dead_rows)
+        return bitmap
+
+    @property
+    def dead_rows(self) -> int:
+        self.live_bitmap()
+        return self._mask[2]
+
+    def needs_compaction(self) -> bool:
+        """Whether enough of the segment is tombstoned to rewrite it."""
+        if self.ntotal:
+            return self.dead_rows / self.ntotal >= COMPACTION_THRESHOLD
+        _, tombstones = self._tombstones()
+        return any(is_tombstoned(document, tombstones) for document in self.documents)
+
+    def live_mask(self) -> Optional[np.ndarray]:
+        """Boolean mask of rows not hidden by tombstones, or None if every row is live."""
+        bitmap = self.live_bitmap()
+        if bitmap is None:
+            return None
+        return np.unpackbits(bitmap, count=self.ntotal, bitorder="little").astype(bool)
+
+    def live_rows(self) -> np.ndarray:
+        """Row numbers not hidden by tombstones."""
+        live = self.live_mask()
+        return np.arange(self.ntotal) if live is None else np.flatnonzero(live)
+
+    def routing_centroids(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Section centroids and their document rows, computed if the segment predates them."""
+        path = self.directory / "centroids.npy"
+        if path.exists():
+            return np.load(path, mmap_mode="r"), np.load(self.directory / "centroid_doc_rows.npy")
+        vectors = self.index.reconstruct_n(0, self.ntotal)
+        return section_centroids(vectors, self._attribute_index()["doc_starts"])
+
+    def _attribute_index(self) -> Dict:
+        """Per-document row ranges and per-file-type row masks."""
+        if self._attributes is None:
+            doc_starts = np.zeros(len(self.documents) + 1, dtype=np.int64)
+            np.cumsum([document["chunks"] for document in self.documents], out=doc_starts[1:])
+            file_types: Dict[str, np.ndarray] = {}
+            for doc_row, document in enumerate(self.documents):
+                file_type = str(document["metadata"].get("file_type") or "").lower()
+                mask = file_types.setdefault(file_type, np.zeros(self.ntotal, dtype=bool))
+                mask[doc_starts[doc_row]:doc_starts[doc_row + 1]] = True
+            self._attributes = {"doc_starts": doc_starts, "file_types": file_types}
+        return self._attributes
+
+    def selection(self, filters: Optional[Dict]) -> Tuple[Optional[np.ndarray], int]:
+        """Bitmap of live rows matching ``filters`` and how many rows it selects.
+
+        A None bitmap selects every row. Without filters, rows of near-duplicate
+        chunks are left out, since their canonical chunk answers for them.
+        """
+        if not filters and not self.duplicate_rows:
+            return self.live_bitmap(), self.ntotal - self.dead_rows
+        tombstones_key, _ = self._tombstones()
+        key = (filter_key(filters), tombstones_key)
+        cached = self._selections.get(key)
+        if cached is not None:
+            return cached
+
+        if not filters:
+            mask = ~np.asarray(self.duplicates, dtype=bool)
+            filters = {}
+        else:
+            attributes = self._attribute_index()
+            doc_starts = attributes["doc_starts"]
+            mask = np.zeros(self.ntotal, dtype=bool)
+            for doc_row, document in enumerate(self.documents):
+                if document_matches(document, filters):
+                    mask[doc_starts[doc_row]:doc_starts[doc_row + 1]] = True
+        if filters.get("file_types"):
+            type_mask = np.zeros(self.ntotal, dtype=bool)
+            for file_type in filters["file_types"]:
+                if file_type in attributes["file_types"]:
+                    type_mask |= attributes["file_types"][file_type]
+            mask &= type_mask
+        page_from, page_to = filters.get("page_from"), filters.get("page_to")
+        if page_from is not None or page_to is not None:
+            pages = np.asarray(self.pages)
+            mask &= pages >= max(page_from or 0, 0)
+            if page_to is not None:
+                mask &= pages <= page_to
+        live = self.live_mask()
+        if live is not None:
+            mask &= live
+
+        selected = (np.packbits(mask, bitorder="little"), int(mask.sum()))
+        if len(self._selections) >= 64:
+            self._selections.clear()
+        self._selections[key] = selected
+        return selected
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int,
+        bitmap: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the rows selected by ``bitmap`` (all rows if None), returning distances and row ids."""
+        # Keep the bitmap and selector referenced for the duration of the search
+        selector = faiss.IDSelectorBitmap(self.ntotal, faiss.swig_ptr(bitmap)) if bitmap is not None else None
+        params = faiss.SearchParameters(sel=selector) if selector is not None else None
+        return self.index.search(query_vectors, top_k, params=params)
+
+    def close(self) -> None:
+        """Release the memory maps held by this segment."""
+        self.texts.close()
+        self.chunk_ids.close()
+        self.index = None
+
+
+class _SegmentWriter:
+    """Accumulates documents and writes them as a new immutable segment."""
+
+    def __init__(self):
+        self.documents: List[Dict] = []
+        self.vector_blocks: List[np.ndarray] = []
+        self.texts: List[str] = []
+        self.chunk_ids: List[str] = []
+        self.doc_rows: List[int] = []
+        self.pages: List[int] = []
+        self.duplicates: List[bool] = []
+        self.dimension: Optional[int] = None
+
+    def add_document(
+        self,
+        document: Dict,
+        vectors: np.ndarray,
+        chunk_ids: List[str],
+        texts: List[str],
+        pages: List[int],
+        duplicates: Optional[List[bool]] = None
+    ) -> bool:
+        """Add a document and its rows; returns False on a dimension mismatch.
+
+        ``duplicates`` flags the rows of near-duplicate chunks (none by default).
+        """
+        if len(vectors):
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+            if vectors.shape[1] != self.dimension:
+                logger.error(
+                    f"Skipping {document['document_id']}: dimension {vectors.shape[1]} != {self.dimension}"
+                )
+                return False
+            self.vector_blocks.append(vectors)
+        doc_row = len(self.documents)
+        self.documents.append({**document, "chunks": len(texts)})
+        self.texts.extend(texts)
+        self.chunk_ids.extend(chunk_ids)
+        self.doc_rows.extend([doc_row] * len(texts))
+        self.pages.extend(pages)
+        self.duplicates.extend(duplicates if duplicates is not None else [False] * len(texts))
+        return True
+
+    def write(self, level: int, directory: Path) -> Optional[str]:
+        """Write the segment under ``directory`` and return its name, or None if it would be empty."""
+        if not self.documents:
+            return None
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"s{time.time_ns()}"
+        tmp_dir = directory / f".{name}.tmp"
+        tmp_dir.mkdir()
+        if self.texts:
+            vectors = np.ascontiguousarray(np.vstack(self.vector_blocks), dtype=np.float32)
+            index = faiss.IndexFlatL2(self.dimension)
+            index.add(vectors)
+            faiss.write_index(index, str(tmp_dir / "vectors.index"))
+            doc_starts = np.zeros(len(self.documents) + 1, dtype=np.int64)
+            np.cumsum([document["chunks"] for document in self.documents], out=doc_starts[1:])
+            centroids, centroid_doc_rows = section_centroids(vectors, doc_starts)
+            np.save(tmp_dir / "centroids.npy", centroids)
+            np.save(tmp_dir / "centroid_doc_rows.npy", centroid_doc_rows)
+        write_string_table(tmp_dir, "texts", self.texts)
+        write_string_table(tmp_dir, "chunk_ids", self.chunk_ids)
+        np.save(tmp_dir / "doc_rows.npy", np.array(self.doc_rows, dtype=np.int32))
+        np.save(tmp_dir / "pages.npy", np.array(self.pages, dtype=np.int32))
+        duplicate_rows = sum(self.duplicates)
+        if duplicate_rows:
+            np.save(tmp_dir / "duplicates.npy", np.array(self.duplicates, dtype=bool))
+        with open(tmp_dir / "manifest.json", "w") as f:
+            json.dump({
+                "level": level,
+                "dimension": self.dimension,
+                "chunks": len(self.texts),
+                "duplicates": duplicate_rows,
+                "documents": self.documents,
+                "created_at": time.time()
+            }, f)
+        os.rename(tmp_dir, directory / name)
+        logger.info(f"Wrote level-{level} segment {name}: {len(self.documents)} documents, {len(self.texts)} chunks")
+        return name
+
+
+# Search threads shared by all generations; FAISS releases the GIL while searching
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="corpus-search")
+
+
+class CorpusGeneration:
+    """A versioned, immutable set of live segments."""
+
+    def __init__(self, name: str, manifest: Dict, segments: List[Segment], store: "CorpusStore"):
+        self.name = name
+        self.manifest = manifest
+        self.version: int = manifest["version"]
+        self.segments = segments
+        self.store = store
+        self.refcount = 0
+        self.retired = False
+        self._ref_lock = threading.Lock()
+        # Routing index over section centroids, built on first routed query
+        self._router: Optional[Tuple[faiss.Index, List[Dict]]] = None
+        self._router_lock = threading.Lock()
+
+    @property
+    def ntotal(self) -> int:
+        return sum(segment.ntotal for segment in self.segments)
+
+    @property
+    def dead_rows(self) -> int:
+        return sum(segment.dead_rows for segment in self.segments)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of segment files this generation maps."""
+        return sum(segment.nbytes for segment in self.segments)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes by part: mapped vectors, chunk text and metadata files, and in-memory caches."""
+        usage: Dict[str, int] = {}
+        caches = 0
+        for segment in self.segments:
+            for part, size in segment.file_bytes.items():
+                usage[part] = usage.get(part, 0) + size
+            caches += segment.cache_bytes
+        router = self._router
+        if router is not None:
+            caches += router[0].ntotal * router[0].d * 4
+        usage["caches"] = caches
+        return usage
+
+    def live_documents(self) -> Dict[str, int]:
+        """Map each searchable document id to the source version it was built from."""
+        _, tombstones = self.store.current_tombstones()
+        return {
+            document["document_id"]: document["version"]
+            for segment in self.segments
+            for document in segment.documents
+            if not is_tombstoned(document, tombstones)
+        }
+
+    def _routing_index(self) -> Tuple[faiss.Index, List[Dict]]:
+        """Inner-product index over all segments' section centroids."""
+        with self._router_lock:
+            if self._router is None:
+                blocks, owners = [], []
+                for segment in self.segments:
+                    if not segment.ntotal:
+                        continue
+                    centroids, doc_rows = segment.routing_centroids()
+                    blocks.append(np.asarray(centroids, dtype=np.float32))
+                    owners.extend(segment.documents[int(row)] for row in doc_rows)
+                dimension = blocks[0].shape[1] if blocks else 1
+                index = faiss.IndexFlatIP(dimension)
+                if blocks:
+                    index.add(np.ascontiguousarray(np.vstack(blocks)))
+                self._router = (index, owners)
+            return self._router
+
+    def route(self, query_vector: np.ndarray, route_documents: int, filters: Optional[Dict] = None) -> List[str]:
+        """Ids of the documents whose best section best matches the query."""
+        index, owners = self._routing_index()
+        if not index.ntotal:
+            return []
+        _, tombstones = self.store.current_tombstones()
+        file_types = filters.get("file_types") if filters else None
+        # Several sections can belong to one document, so look further than N;
+        # with filters, rank every section since most may not qualify
+        k = index.ntotal if filters else min(index.ntotal, route_documents * max(ROUTING_SECTION_CHUNKS, 1) * 2)
+        _, rows = index.search(query_vector.reshape(1, -1), k)
+        routed: List[str] = []
+        for row in rows[0]:
+            if row < 0:
+                break
+            document = owners[row]
+            if document["document_id"] in routed or is_tombstoned(document, tombstones):
+                continue
+            if filters and not document_matches(document, filters):
+                continue
+            if file_types and str(document["metadata"].get("file_type") or "").lower() not in file_types:
+                continue
+            routed.append(document["document_id"])
+            if len(routed) == route_documents:
+                break
+        return routed
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int,
+        filters: Optional[Dict] = None,
+        route_documents: int = 0
+    ) -> List[List[Dict]]:
+        """Search all segments in parallel and merge the top-k per query (CPU-bound).
+
+        ``filters`` (see ``normalize_filters``) restrict the search to matching
+        rows inside FAISS; segments without matching rows are skipped. With
+        ``route_documents`` set, each query only searches the chunks of that
+        many routed documents.
+        """
+        if route_documents > 0 and len(self.live_documents()) > route_documents:
+            return [
+                self._search(
+                    query_vectors[q:q + 1],
+                    top_k,
+                    {**(filters or {}), "document_ids": self.route(query_vectors[q], route_documents, filters)}
+                )[0]
+                for q in range(len(query_vectors))
+            ]
+        return self._search(query_vectors, top_k, filters)
+
+    def _search(self, query_vectors: np.ndarray, top_k: int, filters: Optional[Dict]) -> List[List[Dict]]:
+        segments, bitmaps = [], []
+        for segment in self.segments:
+            if not segment.ntotal:
+                continue
+            bitmap, selected = segment.selection(filters)
+            if selected:
+                segments.append(segment)
+                bitmaps.append(bitmap)
+        if not segments:
+            return [[] for _ in range(len(query_vectors))]
+        if len(segments) == 1:
+            results = [segments[0].search(query_vectors, top_k, bitmaps[0])]
+        else:
+            results = list(_search_pool.map(
+                lambda pair: pair[0].search(query_vectors, top_k, pair[1]), zip(segments, bitmaps)
+            ))
+
+        merged = []
+        for q in range(len(query_vectors)):
+            candidates = (
+                (float(distances[q][i]), s, int(rows[q][i]))
+                for s, (distances, rows) in enumerate(results)
+                for i in range(len(rows[q]))
+                if rows[q][i] >= 0
+            )
+            best = heapq.nsmallest(top_k, candidates, key=lambda c: c[0])
+            merged.append([segments[s].chunk(row, score) for score, s, row in best])
+        return merged
+
+    def acquire(self) -> None:
+        with self._ref_lock:
+            self.refcount += 1
+
+    def release(self) -> None:
+        with self._ref_lock:
+            self.refcount -= 1
+            should_close = self.retired and self.refcount == 0
+        if should_close:
+            self.close()
+
+    def retire(self) -> None:
+        """Mark as replaced; close now or when the last holder releases it."""
+        with self._ref_lock:
+            self.retired = True
+            should_close = self.refcount == 0
+        if should_close:
+            self.close()
+
+    def close(self) -> None:
+        """Drop this generation's hold on its segments."""
+        self.store._release_segments(self.segments)
+        logger.info(f"Released corpus generation {self.name} of collection {self.store.name}")
+
+
+def shard_of(document_id: str, shard_count: int = SHARD_COUNT) -> int:
+    """Shard holding a document; stable across processes and hosts."""
+    return zlib.crc32(document_id.encode("utf-8")) % shard_count
+
+
+# Background maintenance: a single builder thread shared by all collections
+_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="corpus-builder")
+
+
+class CorpusStore:
+    """The source files, segmented index and worker state of one collection."""
+
+    def __init__(self, name: str, embeddings_dir: Path, corpus_dir: Path):
+        self.name = name
+        self.embeddings_dir = embeddings_dir
+        self.corpus_dir = corpus_dir
+        self.segments_dir = corpus_dir / "segments"
+        self.generations_dir = corpus_dir / "generations"
+        self.version_file = corpus_dir / "CURRENT"
+        self.lock_file = corpus_dir / "corpus.lock"
+        self.tombstones_file = corpus_dir / "tombstones.json"
+        # Whether this worker made sure the corpus covers the source files
+        self.ensured = False
+        # When a search last used the collection in this worker
+        self.last_used = 0.0
+        # Generation last checked against the worker's memory budget
+        self._budgeted: Optional[CorpusGeneration] = None
+        # Segments mapped by this worker, shared between the generations using them
+        self._open_segments: Dict[str, Segment] = {}
+        self._segments_lock = threading.Lock()
+        # Per-worker cache of the tombstones file
+        self._tombstones: Dict[str, int] = {}
+        self._tombstones_key: Tuple[int, int] = (0, 0)
+        self._tombstones_lock = threading.Lock()
+        # Per-worker view of the live generation
+        self._live: Optional[CorpusGeneration] = None
+        self._live_version: Optional[Tuple[int, int]] = None
+        self._live_lock = threading.Lock()
+        # Requests arriving while a refresh runs are folded into one follow-up pass
+        self._refresh_lock = threading.Lock()
+        self._refresh_future: Optional[Future] = None
+        self._refresh_requested = False
+
+    def _acquire_segments(self, names: List[str]) -> List[Segment]:
+        with self._segments_lock:
+            segments = []
+            for name in names:
+                segment = self._open_segments.get(name)
+                if segment is None:
+                    segment = Segment(name, self.segments_dir / name, self.current_tombstones)
+                    self._open_segments[name] = segment
+                segment.refs += 1
+                segments.append(segment)
+            return segments
+
+    def _release_segments(self, segments: List[Segment]) -> None:
+        with self._segments_lock:
+            for segment in segments:
+                segment.refs -= 1
+                if segment.refs == 0:
+                    self._open_segments.pop(segment.name, None)
+                    segment.close()
+
+    @contextmanager
+    def corpus_lock(self) -> Iterator[None]:
+        """Exclusive inter-process lock for building and publishing generations."""
+        self.corpus_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def source_versions(self) -> Dict[str, int]:
+        """Map each embedded document id of this shard to the mtime of its metadata file."""
+        if not self.embeddings_dir.exists():
+            return {}
+        versions = {}
+        for metadata_file in self.embeddings_dir.glob("*.json"):
+            if SHARD_COUNT > 1 and shard_of(metadata_file.stem) != SHARD_INDEX:
+                continue
+            if metadata_file.with_suffix(".index").exists():
+                versions[metadata_file.stem] = metadata_file.stat().st_mtime_ns
+        return versions
+
+    def read_version(self) -> Optional[str]:
+        """Name of the live generation, or None if none was published yet."""
+        try:
+            return self.version_file.read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _read_generation(self, name: Optional[str]) -> Dict:
+        """Read a generation manifest; the empty generation if there is none."""
+        try:
+            with open(self.generations_dir / f"{name}.json", "r") as f:
+                return json.load(f)
+        except (TypeError, FileNotFoundError):
+            return {"version": 0, "segments": []}
+
+    def _publish(self, segments: List[str]) -> str:
+        """Write a new generation listing ``segments`` and make it live."""
+        self.generations_dir.mkdir(parents=True, exist_ok=True)
+        version = self._read_generation(self.read_version())["version"] + 1
+        name = f"g{time.time_ns()}"
+        with open(self.generations_dir / f"{name}.json", "w") as f:
+            json.dump({"version": version, "segments": segments, "created_at": time.time()}, f)
+        tmp_path = self.version_file.with_suffix(".tmp")
+        tmp_path.write_text(name)
+        os.replace(tmp_path, self.version_file)
+        self._prune_files()
+        logger.info(
+            f"Published corpus generation {name} of collection {self.name} "
+            f"(version {version}, {len(segments)} segments)"
+        )
+        return name
+
+    def _prune_files(self) -> None:
+        """Remove old generations and the segments only they referenced.
+
+        Workers still mapping a removed segment keep their pages until they
+        unmap them, so removal never breaks an in-flight search.
+        """
+        names = sorted(p.stem for p in self.generations_dir.glob("g*.json"))
+        for name in names[:-KEEP_GENERATIONS]:
+            (self.generations_dir / f"{name}.json").unlink(missing_ok=True)
+        referenced = {
+            segment for name in names[-KEEP_GENERATIONS:] for segment in self._read_generation(name)["segments"]
+        }
+        for path in self.segments_dir.iterdir() if self.segments_dir.exists() else []:
+            if path.is_dir() and not path.name.startswith(".") and path.name not in referenced:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _read_document(self, document_id: str) -> Tuple[Dict, np.ndarray]:
+        """Read a per-document metadata file and the vectors of its index."""
+        metadata_file = self.embeddings_dir / f"{document_id}.json"
+        with open(metadata_file, "r") as f:
+            document_data = json.load(f)
+        index = faiss.read_index(str(metadata_file.with_suffix(".index")))
+        vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+        return document_data, vectors
+
+    def _canonical_vectors(self, document_id: str, document_data: Dict, vectors: np.ndarray) -> Dict[str, np.ndarray]:
+        """Vectors of the canonical chunks the document's near-duplicates point at, by chunk id."""
+        wanted: Dict[str, set] = {}
+        for chunk in document_data.get("chunks", []):
+            if chunk.get("embedding_index") is None and chunk.get("duplicate_of"):
+                wanted.setdefault(chunk.get("duplicate_document") or document_id, set()).add(chunk["duplicate_of"])
+        found: Dict[str, np.ndarray] = {}
+        for source_id, chunk_ids in wanted.items():
+            if source_id == document_id:
+                source_data, source_vectors = document_data, vectors
+            else:
+                try:
+                    source_data, source_vectors = self._read_document(source_id)
+                except Exception as e:
+                    logger.warning(f"Filtered searches skip the duplicates of {document_id} from {source_id}: {e}")
+                    continue
+            for chunk in source_data.get("chunks", []):
+                idx = chunk.get("embedding_index")
+                if chunk.get("chunk_id") in chunk_ids and idx is not None and 0 <= idx < len(source_vectors):
+                    found[chunk["chunk_id"]] = source_vectors[idx]
+        return found
+
+    def _load_document(
+        self, document_id: str, version: int
+    ) -> Optional[Tuple[Dict, np.ndarray, List[str], List[str], List[int], List[bool]]]:
+        """Load a per-document metadata file and the vectors of its chunks.
+
+        Near-duplicate chunks get a row holding their canonical chunk's vector,
+        flagged so that only filtered searches return it.
+        """
+        try:
+            document_data, vectors = self._read_document(document_id)
+        except Exception as e:
+            logger.error(f"Skipping {document_id} in corpus build: {e}")
+            return None
+        canonical = self._canonical_vectors(document_id, document_data, vectors)
+
+        rows, chunk_ids, texts, pages, duplicates = [], [], [], [], []
+        for i, chunk in enumerate(document_data.get("chunks", [])):
+            idx = chunk.get("embedding_index", i)
+            if idx is not None and 0 <= idx < len(vectors):
+                rows.append(vectors[idx])
+            elif idx is None and chunk.get("duplicate_of") in canonical:
+                rows.append(canonical[chunk["duplicate_of"]])
+            else:
+                continue
+            duplicates.append(idx is None)
+            chunk_ids.append(chunk.get("chunk_id") or f"{document_id}_{idx}")
+            texts.append(chunk.get("text", ""))
+            page = chunk.get("page_number")
+            pages.append(page if isinstance(page, int) else -1)
+        document = {
+            "document_id": document_data.get("document_id", document_id),
+            "version": version,
+            "metadata": document_data.get("metadata", {})
+        }
+        block = np.array(rows, dtype=np.float32).reshape(len(rows), vectors.shape[1])
+        return document, block, chunk_ids, texts, pages, duplicates
+
+    def _rewrite(self, segments: List[Segment], level: int, directory: Optional[Path] = None) -> Optional[str]:
+        """Write the live rows of ``segments`` into a single new segment.
+
+        The segment goes to the collection's segments unless another ``directory`` is given.
+        """
+        writer = _SegmentWriter()
+        _, tombstones = self.current_tombstones()
+        for segment in segments:
+            rows = segment.live_rows()
+            vectors = (
+                segment.index.reconstruct_n(0, segment.ntotal) if segment.ntotal
+                else np.zeros((0, 0), dtype=np.float32)
+            )
+            # Rows of a document are contiguous, so live rows group by document with a binary search
+            live_doc_rows = np.asarray(segment.doc_rows)[rows]
+            starts = np.searchsorted(live_doc_rows, np.arange(len(segment.documents)), side="left")
+            ends = np.searchsorted(live_doc_rows, np.arange(len(segment.documents)), side="right")
+            for doc_row, document in enumerate(segment.documents):
+                if is_tombstoned(document, tombstones):
+                    continue
+                document_rows = rows[starts[doc_row]:ends[doc_row]]
+                writer.add_document(
+                    {k: v for k, v in document.items() if k != "chunks"},
+                    vectors[document_rows],
+                    [segment.chunk_ids[int(r)] for r in document_rows],
+                    [segment.texts[int(r)] for r in document_rows],
+                    [int(segment.pages[int(r)]) for r in document_rows],
+                    [bool(segment.duplicates[int(r)]) for r in document_rows]
+                    if segment.duplicates is not None else None
+                )
+        return writer.write(level, directory or self.segments_dir)
+
+    def _flush_locked(self, generation: Optional[CorpusGeneration]) -> bool:
+        """Seal new or changed per-document files into a level-0 segment.
+
+        Documents that vanished from or changed in the source files are
+        tombstoned once the segment holding their new versions is published,
+        so a replaced document never disappears from search in between.
+        Returns True if a new generation was published. Caller holds the
+        corpus lock.
+        """
+        live = generation.live_documents() if generation is not None else {}
+        sources = self.source_versions()
+
+        published = False
+        changed = [document_id for document_id, version in sources.items() if live.get(document_id) != version]
+        if changed:
+            writer = _SegmentWriter()
+            for document_id in sorted(changed):
+                loaded = self._load_document(document_id, sources[document_id])
+                if loaded is not None:
+                    writer.add_document(*loaded)
+            name = writer.write(0, self.segments_dir)
+            if name is not None:
+                existing = generation.manifest["segments"] if generation is not None else []
+                self._publish(existing + [name])
+                published = True
+
+        tombstones = self._read_tombstones()
+        updated = dict(tombstones)
+        for document_id, version in live.items():
+            if sources.get(document_id) != version:
+                updated[document_id] = max(version, updated.get(document_id, -1))
+        if updated != tombstones:
+            self._write_tombstones(updated)
+        return published
+
+    def _compact_locked(self, generation: CorpusGeneration) -> bool:
+        """Rewrite the segments whose tombstoned rows pass the threshold."""
+        segments = list(generation.manifest["segments"])
+        compacted = False
+        for segment in generation.segments:
+            if not segment.needs_compaction():
+                continue
+            logger.info(f"Compacting segment {segment.name}: {segment.dead_rows}/{segment.ntotal} rows tombstoned")
+            replacement = self._rewrite([segment], segment.level)
+            position = segments.index(segment.name)
+            segments[position:position + 1] = [replacement] if replacement else []
+            compacted = True
+        if compacted:
+            self._publish(segments)
+        return compacted
+
+    def _merge_locked(self, generation: CorpusGeneration) -> bool:
+        """Merge the lowest level holding ``MERGE_FANOUT`` or more segments."""
+        by_level: Dict[int, List[Segment]] = {}
+        for segment in generation.segments:
+            by_level.setdefault(segment.level, []).append(segment)
+        for level in sorted(by_level):
+            if len(by_level[level]) < MERGE_FANOUT:
+                continue
+            merging = by_level[level]
+            merged = self._rewrite(merging, level + 1)
+            merged_names = {segment.name for segment in merging}
+            segments = [name for name in generation.manifest["segments"] if name not in merged_names]
+            self._publish(segments + ([merged] if merged else []))
+            return True
+        return False
+
+    def _prune_tombstones(self, generation: CorpusGeneration) -> None:
+        """Drop tombstones that no longer match any row of a live segment."""
+        tombstones = self._read_tombstones()
+        if not tombstones:
+            return
+        remaining = {
+            document_id: version for document_id, version in tombstones.items()
+            if any(
+                document["document_id"] == document_id and document["version"] <= version
+                for segment in generation.segments
+                for document in segment.documents
+            )
+        }
+        if remaining != tombstones:
+            self._write_tombstones(remaining)
+
+    def _read_tombstones(self) -> Dict[str, int]:
+        try:
+            with open(self.tombstones_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_tombstones(self, tombstones: Dict[str, int]) -> None:
+        tmp_path = self.tombstones_file.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(tombstones, f)
+        os.replace(tmp_path, self.tombstones_file)
+
+    def add_tombstone(self, document_id: str, version: int) -> None:
+        """Hide rows of a document built from ``version`` or older in every worker."""
+        with self.corpus_lock():
+            tombstones = self._read_tombstones()
+            tombstones[document_id] = max(version, tombstones.get(document_id, -1))
+            self._write_tombstones(tombstones)
+
+    def current_tombstones(self) -> Tuple[Tuple[int, int], Dict[str, int]]:
+        """Return the tombstones and a key identifying their version."""
+        try:
+            stat = self.tombstones_file.stat()
+            key = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            key = (0, 0)
+        with self._tombstones_lock:
+            if key != self._tombstones_key:
+                self._tombstones = self._read_tombstones() if key != (0, 0) else {}
+                self._tombstones_key = key
+            return self._tombstones_key, self._tombstones
+
+    def ensure_corpus(self) -> Optional[str]:
+        """Make sure the live generation covers all source files.
+
+        Safe to call from every worker at startup: the first one seals missing
+        documents under the lock, the others find nothing to do.
+        """
+        with self.corpus_lock():
+            with self._pinned() as generation:
+                self._flush_locked(generation)
+            self.ensured = True
+            return self.read_version()
+
+    def refresh_corpus(self) -> Optional[str]:
+        """Seal new documents, then compact and merge segments as needed."""
+        self.ensure_corpus()
+        # Compaction and merging can take a while on large levels, so each step
+        # takes the lock separately to let other workers publish in between
+        for step in (self._compact_locked, self._merge_locked):
+            while True:
+                with self.corpus_lock():
+                    with self._pinned() as generation:
+                        if generation is None or not step(generation):
+                            break
+        with self.corpus_lock():
+            with self._pinned() as generation:
+                if generation is not None:
+                    self._prune_tombstones(generation)
+            return self.read_version()
+
+    def export_segment(self, directory: Path) -> Optional[Path]:
+        """Write every live row of the corpus into one segment under ``directory``.
+
+        Pending source documents are sealed first. The segment is not published;
+        returns its path, or None if the corpus is empty.
+        """
+        with self.corpus_lock():
+            with self._pinned() as generation:
+                self._flush_locked(generation)
+            with self._pinned() as generation:
+                if generation is None or not generation.segments:
+                    return None
+                level = max(segment.level for segment in generation.segments)
+                name = self._rewrite(generation.segments, level, directory)
+        return directory / name if name else None
+
+    def install_segment(self, path: Path) -> Optional[str]:
+        """Publish a prebuilt segment directory as the whole corpus, e.g. one unpacked from a snapshot.
+
+        The segment is moved into the collection's segments (``path`` must be
+        on the same file system). Earlier segments and their tombstones are
+        dropped, and source documents the segment does not cover are sealed on
+        top. Returns the name of the live generation.
+        """
+        with self.corpus_lock():
+            self.segments_dir.mkdir(parents=True, exist_ok=True)
+            name = f"s{time.time_ns()}"
+            os.rename(path, self.segments_dir / name)
+            self._write_tombstones({})
+            self._publish([name])
+            with self._pinned() as generation:
+                self._flush_locked(generation)
+            return self.read_version()
+
+    def _reload_locked(self) -> Optional[CorpusGeneration]:
+        """Swap in the generation named by the version file if it changed. Caller holds ``_live_lock``."""
+        try:
+            stat = self.version_file.stat()
+        except FileNotFoundError:
+            return self._live
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if version == self._live_version:
+            return self._live
+        name = self.read_version()
+        if name is None:
+            return self._live
+        if self._live is None or self._live.name != name:
+            manifest = self._read_generation(name)
+            previous = self._live
+            self._live = CorpusGeneration(name, manifest, self._acquire_segments(manifest["segments"]), self)
+            logger.info(
+                f"Worker {os.getpid()} swapped in corpus generation {name} of collection {self.name} "
+                f"(version {self._live.version})"
+            )
+            if previous is not None:
+                previous.retire()
+        self._live_version = version
+        return self._live
+
+    def get_corpus(self) -> Optional[CorpusGeneration]:
+        """Return the live generation, reloading it when the version file changed.
+
+        The returned generation is not pinned; use ``acquire_corpus`` around
+        searches so a concurrent swap cannot release it mid-search.
+        """
+        with self._live_lock:
+            generation = self._reload_locked()
+        _touch(self)
+        return generation
+
+    @contextmanager
+    def _pinned(self) -> Iterator[Optional[CorpusGeneration]]:
+        with self._live_lock:
+            generation = self._reload_locked()
+            if generation is not None:
+                generation.acquire()
+        try:
+            yield generation
+        finally:
+            if generation is not None:
+                generation.release()
+
+    @contextmanager
+    def acquire_corpus(self) -> Iterator[Optional[CorpusGeneration]]:
+        """Pin the live generation for the duration of a search (blocking).
+
+        Pinning may map a new generation and evict other collections, so
+        coroutines use ``search`` in a thread rather than this.
+        """
+        with self._pinned() as generation:
+            _touch(self)
+            yield generation
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int,
+        filters: Optional[Dict] = None,
+        route_documents: int = 0
+    ) -> List[List[Dict]]:
+        """Pin the live generation and search it (blocking, see ``CorpusGeneration.search``)."""
+        with self.acquire_corpus() as generation:
+            if generation is None or generation.ntotal == 0:
+                return [[] for _ in range(len(query_vectors))]
+            return generation.search(query_vectors, top_k, filters, route_documents)
+
+    def unload(self) -> int:
+        """Unmap the live generation in this worker; returns the bytes it mapped.
+
+        Searches holding it finish first. The next search maps it again.
+        """
+        with self._live_lock:
+            generation, self._live, self._live_version = self._live, None, None
+        if generation is None:
+            return 0
+        generation.retire()
+        return generation.nbytes
+
+    @property
+    def resident_bytes(self) -> int:
+        """Bytes of segment files the live generation maps in this worker."""
+        generation = self._live
+        return generation.nbytes if generation is not None else 0
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes the live generation holds in this worker, by part."""
+        generation = self._live
+        return generation.memory_usage() if generation is not None else {}
+
+    def _refresh_loop(self) -> Optional[str]:
+        name = None
+        while True:
+            with self._refresh_lock:
+                if not self._refresh_requested:
+                    self._refresh_future = None
+                    return name
+                self._refresh_requested = False
+            try:
+                name = self.refresh_corpus()
+            except Exception as e:
+                logger.error(f"Background refresh of collection {self.name} failed: {e}")
+
+    def schedule_refresh(self) -> Future:
+        """Request a background sync and return a future for its completion."""
+        with self._refresh_lock:
+            self._refresh_requested = True
+            if self._refresh_future is None:
+                self._refresh_future = _builder.submit(self._refresh_loop)
+            return self._refresh_future
+
+    def maybe_compact(self) -> bool:
+        """Schedule a compaction if a segment's tombstoned rows pass the threshold."""
+        with self._live_lock:
+            generation = self._reload_locked()
+        if generation is None or not any(segment.needs_compaction() for segment in generation.segments):
+            return False
+        logger.info(
+            f"Scheduling compaction of collection {self.name}: "
+            f"{generation.dead_rows}/{generation.ntotal} rows tombstoned"
+        )
+        self.schedule_refresh()
+        return True
+
+
+def validate_collection(name: Optional[str]) -> str:
+    """Collection name, the default one for None; raises ValueError for an invalid one."""
+    name = name or DEFAULT_COLLECTION
+    if not COLLECTION_NAME.match(name):
+        raise ValueError(
+            f"Invalid collection name {name!r}: use 1-64 lowercase letters, digits, '-' or '_', "
+            "starting with a letter or digit"
+        )
+    return name
+
+
+def collection_dirs(name: str) -> Tuple[Path, Path]:
+    """Embeddings directory and corpus directory of a collection."""
+    if name == DEFAULT_COLLECTION:
+        return EMBEDDINGS_DIR, CORPUS_DIR
+    embeddings_dir = COLLECTIONS_DIR / name
+    return embeddings_dir, embeddings_dir / CORPUS_DIR_NAME
+
+
+# Collections this worker has opened, by name
+_stores: Dict[str, CorpusStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(collection: Optional[str] = None) -> CorpusStore:
+    """The store of a collection (the default one if None); raises ValueError for an invalid name."""
+    name = validate_collection(collection)
+    store = _stores.get(name)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(name)
+            if store is None:
+                store = CorpusStore(name, *collection_dirs(name))
+                _stores[name] = store
+                register_consumer(
+                    f"collection:{name}", "index", store.memory_usage, store.unload,
+                    lambda store=store: store.last_used
+                )
+    return store
+
+
+def open_stores() -> List[CorpusStore]:
+    """Stores of the collections this worker has opened."""
+    return list(_stores.values())
+
+
+def list_collections() -> List[str]:
+    """Names of the default collection and of every collection with a directory."""
+    names = {DEFAULT_COLLECTION}
+    if COLLECTIONS_DIR.exists():
+        names.update(
+            path.name for path in COLLECTIONS_DIR.iterdir()
+            if path.is_dir() and COLLECTION_NAME.match(path.name)
+        )
+    return sorted(names)
+
+
+def collection_exists(name: Optional[str]) -> bool:
+    """Whether a collection is the default one or has a directory."""
+    name = validate_collection(name)
+    return name == DEFAULT_COLLECTION or collection_dirs(name)[0].is_dir()
+
+
+def _touch(store: CorpusStore) -> None:
+    """Mark a collection as used and unmap the least recently used others above the memory ceiling.
+
+    A newly mapped generation is also checked against the worker's memory budget.
+    """
+    store.last_used = time.monotonic()
+    generation = store._live
+    if generation is not store._budgeted:
+        store._budgeted = generation
+        get_budget().enforce(keep=f"collection:{store.name}")
+    if COLLECTIONS_MEMORY_MB <= 0 or len(_stores) < 2:
+        return
+    limit = COLLECTIONS_MEMORY_MB * 1024 * 1024
+    victims = []
+    with _stores_lock:
+        resident = sum(other.resident_bytes for other in _stores.values())
+        for other in sorted(_stores.values(), key=lambda other: other.last_used):
+            if resident <= limit:
+                break
+            if other is store or not other.resident_bytes:
+                continue
+            victims.append(other)
+            resident -= other.resident_bytes
+    # Unmapping waits for searches pinning the generation; do it outside the lock
+    for other in victims:
+        released = other.unload()
+        logger.info(
+            f"Evicted collection {other.name} ({released / 1e6:.1f} MB) to stay under "
+            f"{COLLECTIONS_MEMORY_MB} MB of mapped indexes"
+        )
+
+
+def ensure_corpus(collection: Optional[str] = None) -> Optional[str]:
+    """Make sure a collection's live generation covers its source files (see ``CorpusStore.ensure_corpus``)."""
+    return get_store(collection).ensure_corpus()
+
+
+def refresh_corpus(collection: Optional[str] = None) -> Optional[str]:
+    """Seal, compact and merge a collection now (see ``CorpusStore.refresh_corpus``)."""
+    return get_store(collection).refresh_corpus()
+
+
+def read_version(collection: Optional[str] = None) -> Optional[str]:
+    """Name of a collection's live generation, or None if none was published yet."""
+    return get_store(collection).read_version()
+
+
+def get_corpus(collection: Optional[str] = None) -> Optional[CorpusGeneration]:
+    """A collection's live generation, not pinned (see ``CorpusStore.get_corpus``)."""
+    return get_store(collection).get_corpus()
+
+
+def acquire_corpus(collection: Optional[str] = None):
+    """Pin a collection's live generation for the duration of a search."""
+    return get_store(collection).acquire_corpus()
+
+
+def add_tombstone(document_id: str, version: int, collection: Optional[str] = None) -> None:
+    """Hide rows of a document built from ``version`` or older in every worker."""
+    get_store(collection).add_tombstone(document_id, version)
+
+
+def schedule_refresh(collection: Optional[str] = None) -> Future:
+    """Request a background sync of a collection and return a future for its completion."""
+    return get_store(collection).schedule_refresh()
+
+
+def maybe_compact(collection: Optional[str] = None) -> bool:
+    """Schedule a compaction of a collection if enough of a segment is tombstoned."""
+    return get_store(collection).maybe_compact()
+
+
+def export_segment(directory: Path, collection: Optional[str] = None) -> Optional[Path]:
+    """Write a collection's live rows into one unpublished segment (see ``CorpusStore.export_segment``)."""
+    return get_store(collection).export_segment(directory)
+
+
+def install_segment(path: Path, collection: Optional[str] = None) -> Optional[str]:
+    """Publish a prebuilt segment as a collection's whole corpus (see ``CorpusStore.install_segment``)."""
+    return get_store(collection).install_segment(path)
@@ -0,0 +1,176 @@
+"""Near-duplicate chunk detection with MinHash and LSH banding.
+
+Consolidated versions, amendments and re-uploads of the same act share many
+chunks with only a few words changed. Each chunk gets a MinHash signature of
+its word shingles. Signatures are split into ``DEDUP_BANDS`` bands, and chunks
+that share a band bucket are candidates. A candidate whose estimated Jaccard
+similarity reaches ``DEDUP_THRESHOLD`` makes the chunk a duplicate.
+
+A duplicate is not embedded. Its record keeps its own text and page and points
+at the canonical chunk (``duplicate_of``/``duplicate_document``), whose vector
+stands in for it, so the duplicate takes no row in its document's index. The
+corpus index gives it a row with a copy of that vector, flagged so that only
+filtered searches return it: unfiltered searches find the canonical chunk
+alone, and a filter that leaves the canonical chunk out still finds the passage
+in the documents it admits. A filter admitting both can return both copies.
+Translations are not textual near-duplicates and are not matched.
+
+With ``DEDUP_SCOPE=corpus`` (the default), chunks are compared with every
+indexed document through the signatures kept in the catalog. ``document`` only
+compares chunks within the same document, and ``off`` disables detection.
+"""
+import os
+import re
+import zlib
+import hashlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .config import lazy_import
+
+np = lazy_import("numpy")
+
+# Where duplicates are looked for: "corpus", "document" or "off"
+DEDUP_SCOPE = os.getenv("DEDUP_SCOPE", "corpus").lower()
+# Estimated Jaccard similarity of word shingles from which chunks count as duplicates
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+# MinHash permutations, and the LSH bands they are split into
+NUM_PERMUTATIONS = 64
+DEDUP_BANDS = 16
+# Words per shingle
+SHINGLE_WORDS = 3
+
+# Modulus of the universal hash family; a prime above 2**32
+_PRIME = 4294967311
+# Coefficients (a, b) of the hash functions, drawn with a fixed seed on first use
+_coefficients: Optional[Tuple["np.ndarray", "np.ndarray"]] = None
+
+
+def _permutations() -> Tuple["np.ndarray", "np.ndarray"]:
+    global _coefficients
+    if _coefficients is None:
+        rng = np.random.RandomState(20240501)
+        # a < 2**31 keeps a * hash + b within uint64
+        _coefficients = (
+            rng.randint(1, 2 ** 31, size=NUM_PERMUTATIONS).astype(np.uint64),
+            rng.randint(0, 2 ** 31, size=NUM_PERMUTATIONS).astype(np.uint64),
+        )
+    return _coefficients
+
+
+def minhash(text: str) -> Optional["np.ndarray"]:
+    """MinHash signature of a text's word shingles, or None if it is too short."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    a, b = _permutations()
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % _PRIME).min(axis=1)
+
+
+def band_keys(signature: "np.ndarray") -> List[int]:
+    """LSH bucket key of each band of a signature."""
+    rows = NUM_PERMUTATIONS // DEDUP_BANDS
+    keys = []
+    for band in range(DEDUP_BANDS):
+        digest = hashlib.blake2b(bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8)
+        keys.append(int.from_bytes(digest.digest(), "big", signed=True))
+    return keys
+
+
+def similarity(a: "np.ndarray", b: "np.ndarray") -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(a == b))
+
+
+def signature_bytes(signature: "np.ndarray") -> bytes:
+    """Signature as stored in the catalog."""
+    return signature.astype("<u8").tobytes()
+
+
+def signature_from_bytes(data: bytes) -> "np.ndarray":
+    """Inverse of ``signature_bytes``."""
+    return np.frombuffer(data, dtype="<u8").astype(np.uint64)
+
+
+# Looks up indexed chunks sharing a bucket: keys -> [(chunk_id, document_id, signature bytes)]
+CandidateLookup = Callable[[List[int]], Iterable[Tuple[str, str, bytes]]]
+
+
+class DuplicateDetector:
+    """Marks chunks of one document that nearly duplicate an earlier chunk."""
+
+    def __init__(self, document_id: str, lookup: Optional[CandidateLookup] = None, scope: str = DEDUP_SCOPE):
+        self.document_id = document_id
+        self.enabled = scope in ("corpus", "document")
+        self.lookup = lookup if scope == "corpus" else None
+        self._buckets: Dict[int, List[str]] = defaultdict(list)
+        self._signatures: Dict[str, "np.ndarray"] = {}
+
+    def check(self, chunk: Dict) -> bool:
+        """Mark ``chunk`` as a duplicate if it has a near-identical canonical chunk.
+
+        Returns True for duplicates. Other chunks become candidates for the
+        following ones.
+        """
+        if not self.enabled:
+            return False
+        signature = minhash(chunk["text"])
+        if signature is None:
+            return False
+        keys = band_keys(signature)
+        match = self._match(signature, keys)
+        if match is not None:
+            chunk["duplicate_of"], chunk["duplicate_document"] = match
+            chunk["embedding_index"] = None
+            return True
+        self._signatures[chunk["chunk_id"]] = signature
+        for key in keys:
+            self._buckets[key].append(chunk["chunk_id"])
+        return False
+
+    def _match(self, signature: "np.ndarray", keys: List[int]) -> Optional[Tuple[str, str]]:
+        best, best_score = None, DEDUP_THRESHOLD
+        seen = set()
+        for key in keys:
+            for chunk_id in self._buckets.get(key, ()):
+                if chunk_id not in seen:
+                    seen.add(chunk_id)
+                    score = similarity(signature, self._signatures[chunk_id])
+                    if score >= best_score:
+                        best, best_score = (chunk_id, self.document_id), score
+        if self.lookup is not None:
+            for chunk_id, document_id, data in self.lookup(keys):
+                if chunk_id not in seen and document_id != self.document_id:
+                    seen.add(chunk_id)
+                    score = similarity(signature, signature_from_bytes(data))
+                    if score >= best_score:
+                        best, best_score = (chunk_id, document_id), score
+        return best
+
+    def split(self, chunks: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """Split chunks into canonical chunks and duplicates."""
+        canonical, duplicates = [], []
+        for chunk in chunks:
+            (duplicates if self.check(chunk) else canonical).append(chunk)
+        return canonical, duplicates
+
+
+def restore_canonical(chunk: Dict) -> Dict:
+    """Turn a duplicate back into a chunk that needs its own vector."""
+    chunk.pop("duplicate_of", None)
+    chunk.pop("duplicate_document", None)
+    chunk.pop("embedding_index", None)
+    return chunk
+
+
+def chunk_signatures(chunks: Iterable[Dict]) -> List[Tuple[str, "np.ndarray"]]:
+    """Signatures of the canonical chunks of a document."""
+    signatures = []
+    for chunk in chunks:
+        if chunk.get("duplicate_of") is None:
+            signature = minhash(chunk.get("text", ""))
+            if signature is not None:
+                signatures.append((chunk["chunk_id"], signature))
+    return signatures
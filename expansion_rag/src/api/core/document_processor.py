@@ -1,12 +1,19 @@
 """Document processing for RAG system."""
 import os
+import re
 import uuid
-from typing import Dict, Optional, BinaryIO, List, Tuple, Any
+from typing import Dict, Optional, BinaryIO, Iterator, List, Tuple, Any, Union
 from pathlib import Path
 import shutil
-import pdfplumber
 import logging
 import time
+import threading
+import itertools
+from contextlib import contextmanager
+from .config import lazy_import
+from .memory import register_consumer
+
+pdfplumber = lazy_import("pdfplumber")
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +21,43 @@ logger = logging.getLogger(__name__)
 
 # Directory to store uploaded documents
 DOCUMENTS_DIR = Path(os.getenv("DOCUMENTS_DIR", "./src/api/data/documents"))
+# New versions of documents wait here until they replace the current one
+STAGING_DIR = DOCUMENTS_DIR / ".staging"
+# Extensions of the stored originals that can be ingested
+TEXT_EXTENSIONS = (".txt", ".md", ".csv")
+DOCUMENT_EXTENSIONS = TEXT_EXTENSIONS + (".pdf",)
+
+_DOCUMENT_ID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# Sizes of the PDFs being parsed, by extraction; pdfplumber's parsed objects grow with them
+_open_pdfs: Dict[int, int] = {}
+_open_pdfs_lock = threading.Lock()
+_pdf_ids = itertools.count()
+register_consumer("pdf_extraction", "ingestion", lambda: {"open_pdf_files": sum(list(_open_pdfs.values()))})
+
+
+@contextmanager
+def _accounted_pdf(document_path: Path) -> Iterator[None]:
+    """Count a PDF towards the memory report while it is open."""
+    key = next(_pdf_ids)
+    with _open_pdfs_lock:
+        _open_pdfs[key] = document_path.stat().st_size
+    try:
+        yield
+    finally:
+        with _open_pdfs_lock:
+            del _open_pdfs[key]
+
+def valid_document_id(document_id: str) -> bool:
+    """Whether a string has the form of a generated document id."""
+    return bool(_DOCUMENT_ID.match(document_id))
+
+def document_files(document_id: str) -> List[Path]:
+    """Stored original files of a document; none for an invalid id."""
+    if not valid_document_id(document_id):
+        return []
+    paths = (DOCUMENTS_DIR / f"{document_id}{ext}" for ext in DOCUMENT_EXTENSIONS)
+    return [path for path in paths if path.exists()]
 
 def process_text_document(
     file_content: str,
@@ -45,153 +89,234 @@ def process_text_document(
         "metadata": doc_metadata
     }
 
-def process_pdf_with_retry(document_path: Path, max_retries: int = 3) -> Optional[List[Tuple[int, str]]]:
-    """Process a PDF file with retries, returning text per page."""
-    for attempt in range(max_retries):
-        try:
-            with pdfplumber.open(document_path) as pdf:
-                logger.info(f"Processing PDF: {document_path} (attempt {attempt + 1}/{max_retries})")
-                page_texts: List[Tuple[int, str]] = []
-                
-                # Get total pages
-                total_pages = len(pdf.pages)
-                logger.info(f"PDF has {total_pages} pages")
+def iter_pdf_pages(document_path: Path, start_page: int = 1) -> Iterator[Tuple[int, str]]:
+    """Extract text per page from a PDF, yielding each page as soon as it is final.
+
+    A page is held back until the next page with text is extracted, because a
+    table continuing over the following pages is appended to it once it ends.
+    Each page's layout caches are released once it is processed, so memory use
+    does not grow with the page count. ``start_page`` skips earlier pages.
+    """
+    with _accounted_pdf(document_path), pdfplumber.open(document_path) as pdf:
+        # Get total pages
+        total_pages = len(pdf.pages)
+        logger.info(f"PDF has {total_pages} pages")
 
-                # Track multi-page tables
-                table_in_progress = False
-                table_buffer = []
+        # Track multi-page tables
+        table_in_progress = False
+        table_buffer = []
+        # Last extracted page, not yet yielded
+        previous: Optional[Tuple[int, str]] = None
+        # Tables of the next page, extracted early by the continuation heuristic
+        lookahead_tables: Dict[int, List] = {}
+        
+        for page_num, page in enumerate(pdf.pages[start_page - 1:], start_page):
+            extracted = None
+            try:
+                # Add a small delay between pages to avoid potential issues
+                if page_num > 1:
+                    time.sleep(0.1)
+                
+                # Extract tables first so we can process them properly
+                tables = lookahead_tables.pop(page_num) if page_num in lookahead_tables else page.extract_tables()
+                
+                # Process regular text
+                text = page.extract_text(x_tolerance=3, y_tolerance=3)
                 
-                for page_num, page in enumerate(pdf.pages, 1):
-                    try:
-                        # Add a small delay between pages to avoid potential issues
-                        if page_num > 1:
-                            time.sleep(0.1)
+                # If no text found, try with more permissive tolerances
+                if not text or len(text.strip()) == 0:
+                    text = page.extract_text(x_tolerance=5, y_tolerance=8)
+                
+                # Process tables with better formatting
+                if tables:
+                    table_texts = []
+                    for table in tables:
+                        header_row = table[0] if table and len(table) > 0 else None
                         
-                        # Extract tables first so we can process them properly
-                        tables = page.extract_tables()
+                        # Check if this looks like a header row (all fields non-empty and relatively short)
+                        is_header = header_row and all(cell and isinstance(cell, str) and len(cell) < 50 for cell in header_row if cell)
                         
-                        # Process regular text
-                        text = page.extract_text(x_tolerance=3, y_tolerance=3)
+                        table_text = ""
+                        if is_header:
+                            # Format with header
+                            headers = [str(cell).strip() if cell else "" for cell in header_row]
+                            table_text += " | ".join(headers) + "\n"
+                            table_text += "-" * (sum(len(h) for h in headers) + (len(headers) - 1) * 3) + "\n"
+                            
+                            # Format data rows
+                            for row in table[1:]:
+                                table_text += " | ".join([str(cell).strip() if cell else "" for cell in row]) + "\n"
+                        else:
+                            # Simple format for tables without clear headers
+                            for row in table:
+                                table_text += " | ".join([str(cell).strip() if cell else "" for cell in row]) + "\n"
                         
-                        # If no text found, try with more permissive tolerances
-                        if not text or len(text.strip()) == 0:
-                            text = page.extract_text(x_tolerance=5, y_tolerance=8)
+                        table_texts.append(table_text)
                         
-                        # Process tables with better formatting
-                        if tables:
-                            table_texts = []
-                            for table in tables:
-                                header_row = table[0] if table and len(table) > 0 else None
-                                
-                                # Check if this looks like a header row (all fields non-empty and relatively short)
-                                is_header = header_row and all(cell and isinstance(cell, str) and len(cell) < 50 for cell in header_row if cell)
-                                
-                                table_text = ""
-                                if is_header:
-                                    # Format with header
-                                    headers = [str(cell).strip() if cell else "" for cell in header_row]
-                                    table_text += " | ".join(headers) + "\n"
-                                    table_text += "-" * (sum(len(h) for h in headers) + (len(headers) - 1) * 3) + "\n"
-                                    
-                                    # Format data rows
-                                    for row in table[1:]:
-                                        table_text += " | ".join([str(cell).strip() if cell else "" for cell in row]) + "\n"
-                                else:
-                                    # Simple format for tables without clear headers
-                                    for row in table:
-                                        table_text += " | ".join([str(cell).strip() if cell else "" for cell in row]) + "\n"
-                                
-                                table_texts.append(table_text)
-                                
-                            # Check if table might continue to next page (heuristic)
-                            if page_num < total_pages:
-                                next_page_tables = pdf.pages[page_num].extract_tables()
-                                if next_page_tables and tables[-1] and next_page_tables[0]:
-                                    # Check column count match as a heuristic for continued table
-                                    if len(tables[-1][0]) == len(next_page_tables[0][0]):
-                                        table_in_progress = True
-                                        table_buffer.append("\n".join(table_texts))
-                                        continue
-                            
-                            # If we have a table buffer and this page doesn't continue it,
-                            # add the entire multi-page table to the previous page
-                            if table_in_progress:
+                    # Check if table might continue to next page (heuristic)
+                    if page_num < total_pages:
+                        next_page_tables = pdf.pages[page_num].extract_tables()
+                        lookahead_tables[page_num + 1] = next_page_tables
+                        if next_page_tables and tables[-1] and next_page_tables[0]:
+                            # Check column count match as a heuristic for continued table
+                            if len(tables[-1][0]) == len(next_page_tables[0][0]):
+                                table_in_progress = True
                                 table_buffer.append("\n".join(table_texts))
-                                full_table = "\n\n".join(table_buffer)
-                                
-                                # Append to the previous page's text
-                                if page_texts and page_num > 1:
-                                    prev_page_num, prev_text = page_texts[-1]
-                                    page_texts[-1] = (prev_page_num, f"{prev_text}\n\n{full_table}")
-                                else:
-                                    # If no previous page, add it to this page's text
-                                    text = (text or "") + "\n\n" + full_table
-                                
-                                # Reset the table tracking
-                                table_in_progress = False
-                                table_buffer = []
-                            else:
-                                # Add tables to this page's text
-                                text = (text or "") + "\n\n" + "\n\n".join(table_texts)
+                                continue
+                    
+                    # If we have a table buffer and this page doesn't continue it,
+                    # add the entire multi-page table to the previous page
+                    if table_in_progress:
+                        table_buffer.append("\n".join(table_texts))
+                        full_table = "\n\n".join(table_buffer)
                         
-                        # Add the processed text for this page
-                        if text:
-                            # Clean up the text - preserve paragraph structure but normalize whitespace
-                            text = "\n\n".join(" ".join(line.split()) for line in text.split("\n\n") if line.strip())
-                            page_texts.append((page_num, text))
-                            logger.info(f"Successfully extracted text from page {page_num}/{total_pages}")
+                        # Append to the previous page's text
+                        if previous and page_num > 1:
+                            prev_page_num, prev_text = previous
+                            previous = (prev_page_num, f"{prev_text}\n\n{full_table}")
                         else:
-                            logger.warning(f"No text extracted from page {page_num}/{total_pages}")
-                    except Exception as page_error:
-                        logger.error(f"Error extracting text from page {page_num}/{total_pages}: {str(page_error)}")
-                        continue
-                
-                if not page_texts:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"No text extracted in attempt {attempt + 1}, retrying...")
-                        time.sleep(1)  # Wait before retrying
-                        continue
+                            # If no previous page, add it to this page's text
+                            text = (text or "") + "\n\n" + full_table
+                        
+                        # Reset the table tracking
+                        table_in_progress = False
+                        table_buffer = []
                     else:
-                        raise ValueError("No text could be extracted from any page after all attempts")
-                
-                logger.info(f"Successfully extracted text from {len(page_texts)} pages in {document_path}")
-                return page_texts
+                        # Add tables to this page's text
+                        text = (text or "") + "\n\n" + "\n\n".join(table_texts)
                 
+                # Add the processed text for this page
+                if text:
+                    # Clean up the text - preserve paragraph structure but normalize whitespace
+                    text = "\n\n".join(" ".join(line.split()) for line in text.split("\n\n") if line.strip())
+                    extracted = (page_num, text)
+                    logger.info(f"Successfully extracted text from page {page_num}/{total_pages}")
+                else:
+                    logger.warning(f"No text extracted from page {page_num}/{total_pages}")
+            except Exception as page_error:
+                logger.error(f"Error extracting text from page {page_num}/{total_pages}: {str(page_error)}")
+                continue
+            finally:
+                # Drop the parsed layout of this page
+                page.close()
+
+            if extracted:
+                if previous:
+                    yield previous
+                previous = extracted
+
+        if previous:
+            yield previous
+
+def process_pdf_with_retry(document_path: Path, max_retries: int = 3) -> Optional[List[Tuple[int, str]]]:
+    """Process a PDF file with retries, returning text per page."""
+    page_texts = list(stream_pdf_with_retry(document_path, max_retries))
+    logger.info(f"Successfully extracted text from {len(page_texts)} pages in {document_path}")
+    return page_texts
+
+def stream_pdf_with_retry(document_path: Path, max_retries: int = 3) -> Iterator[Tuple[int, str]]:
+    """Stream text per page from a PDF with retries.
+
+    The last yielded page is checkpointed, so a retry reopens the file at the
+    page after it rather than starting over from page 1.
+    """
+    last_page = 0
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Processing PDF: {document_path} from page {last_page + 1} (attempt {attempt + 1}/{max_retries})")
+            for page_num, text in iter_pdf_pages(document_path, start_page=last_page + 1):
+                yield page_num, text
+                last_page = page_num
         except Exception as e:
             logger.error(f"Error processing PDF {document_path} (attempt {attempt + 1}/{max_retries}): {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(1)  # Wait before retrying
-                continue
-            else:
+            if attempt == max_retries - 1:
                 raise
-    
-    return None
+            time.sleep(1)  # Wait before retrying
+            continue
 
-def save_uploaded_file(
+        if last_page:
+            return
+        if attempt < max_retries - 1:
+            logger.warning(f"No text extracted in attempt {attempt + 1}, retrying...")
+            time.sleep(1)  # Wait before retrying
+    raise ValueError("No text could be extracted from any page after all attempts")
+
+def store_uploaded_file(
     file: BinaryIO,
     filename: str,
-    metadata: Optional[Dict] = None
+    metadata: Optional[Dict] = None,
+    document_id: Optional[str] = None,
+    staged: bool = False
 ) -> Dict:
-    """Save an uploaded file and return its information."""
-    # Create a unique document ID
-    document_id = str(uuid.uuid4())
+    """Store an uploaded file without processing it and return its information.
+
+    Pass ``document_id`` and ``staged`` to store the file as a new version of an
+    existing document; it is kept aside until ``install_staged_file``.
+    """
+    # Create a unique document ID unless replacing an existing document
+    document_id = document_id or str(uuid.uuid4())
+    if not valid_document_id(document_id):
+        raise ValueError(f"Invalid document id: {document_id}")
     
     # Create directory if it doesn't exist
-    DOCUMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    directory = STAGING_DIR if staged else DOCUMENTS_DIR
+    directory.mkdir(parents=True, exist_ok=True)
     
     # Get file extension
     _, ext = os.path.splitext(filename)
-    if not ext:
-        ext = ".txt"
+    ext = ext.lower() or ".txt"
     
-    # Save the file
-    document_path = DOCUMENTS_DIR / f"{document_id}{ext}"
+    # Save the file; staged versions of the same document must not collide
+    name = f"{document_id}-{uuid.uuid4().hex}{ext}" if staged else f"{document_id}{ext}"
+    document_path = directory / name
     with open(document_path, "wb") as f:
         shutil.copyfileobj(file, f)
     
+    # Prepare metadata
+    doc_metadata = metadata or {}
+    doc_metadata["filename"] = filename
+    doc_metadata["file_type"] = ext
+    
+    return {
+        "document_id": document_id,
+        "filename": filename,
+        "path": str(document_path),
+        "size": os.path.getsize(document_path),
+        "metadata": doc_metadata
+    }
+
+def stream_document_content(document_path: Path) -> Optional[Union[str, Iterator[Tuple[int, str]]]]:
+    """Open a stored document for streaming ingestion.
+
+    Returns the text of plain-text files, a lazy iterator of (page_num, text)
+    for PDFs (extraction happens as it is consumed), or None for unsupported
+    file types.
+    """
+    ext = document_path.suffix.lower()
+    if ext in TEXT_EXTENSIONS:
+        with open(document_path, "r", encoding="utf-8", errors="ignore") as f:
+            return f.read()
+    if ext == ".pdf":
+        return stream_pdf_with_retry(document_path)
+    return None
+
+def save_uploaded_file(
+    file: BinaryIO,
+    filename: str,
+    metadata: Optional[Dict] = None,
+    document_id: Optional[str] = None
+) -> Dict:
+    """Save an uploaded file and return its information with the processed content.
+
+    Pass ``document_id`` to store the file as a new version of an existing document.
+    """
+    document_info = store_uploaded_file(file, filename, metadata, document_id)
+    document_path = Path(document_info["path"])
+    ext = document_path.suffix
+    
     # Process different file types
     processed_content: Any = None
-    if ext.lower() in (".txt", ".md", ".csv"):
+    if ext.lower() in TEXT_EXTENSIONS:
         with open(document_path, "r", encoding="utf-8", errors="ignore") as f:
             processed_content = f.read()
     elif ext.lower() == ".pdf":
@@ -205,35 +330,39 @@ def save_uploaded_file(
     else:
         processed_content = f"Unsupported file type: {ext}"
     
-    # Prepare metadata
-    doc_metadata = metadata or {}
-    doc_metadata["filename"] = filename
-    doc_metadata["file_type"] = ext
-    
-    return {
-        "document_id": document_id,
-        "filename": filename,
-        "processed_content": processed_content,
-        "path": str(document_path),
-        "size": os.path.getsize(document_path),
-        "metadata": doc_metadata
-    }
+    document_info["processed_content"] = processed_content
+    return document_info
+
+def install_staged_file(document_id: str, staged_path: Path) -> Path:
+    """Make a staged file the stored original of a document, replacing its other versions."""
+    if not valid_document_id(document_id):
+        raise ValueError(f"Invalid document id: {document_id}")
+    document_path = DOCUMENTS_DIR / f"{document_id}{staged_path.suffix}"
+    for existing in document_files(document_id):
+        if existing != document_path:
+            existing.unlink(missing_ok=True)
+    os.replace(staged_path, document_path)
+    return document_path
+
+def delete_document_files(document_id: str) -> bool:
+    """Delete all stored original files of a document."""
+    deleted = False
+    for document_path in document_files(document_id):
+        document_path.unlink(missing_ok=True)
+        deleted = True
+    return deleted
 
 def get_document_content(document_id: str) -> Optional[Any]:
     """Retrieve the processed content of a stored document."""
-    # Look for the document in various extensions
-    for ext in [".txt", ".md", ".csv", ".pdf"]:
-        document_path = DOCUMENTS_DIR / f"{document_id}{ext}"
-        if document_path.exists():
-            if ext.lower() == ".pdf":
-                try:
-                    return process_pdf_with_retry(document_path)
-                except Exception as e:
-                    logger.error(f"Error reading PDF {document_path}: {str(e)}")
-                    return None
-            else:
-                with open(document_path, "r", encoding="utf-8", errors="ignore") as f:
-                    return f.read()
+    for document_path in document_files(document_id):
+        if document_path.suffix == ".pdf":
+            try:
+                return process_pdf_with_retry(document_path)
+            except Exception as e:
+                logger.error(f"Error reading PDF {document_path}: {str(e)}")
+                return None
+        with open(document_path, "r", encoding="utf-8", errors="ignore") as f:
+            return f.read()
     
     logger.error(f"Document not found: {document_id}")
     return None 
\ No newline at end of file
@@ -1,42 +1,64 @@
 """Document embedding using OpenAI API."""
 import os
-from typing import Dict, List, Optional, Any
-import numpy as np
-import tiktoken
-import openai
-from openai import OpenAI, AsyncOpenAI
-import faiss
-import pickle
+from typing import Dict, List, Optional, Any, Tuple
 import json
+import time
 from pathlib import Path
-from dotenv import load_dotenv
-from ..core.document_processor import get_document_content
+from functools import partial
+from .config import get_encoding, get_openai_client, lazy_import
+from ..core.document_processor import document_files, get_document_content
+from .singleflight import coalesce
+from .executors import run_io
+from .catalog import record_document, remove_document, signature_candidates, duplicate_dependents, get_document
+from .dedup import DuplicateDetector, restore_canonical
+from .shards import SHARD_URLS, scatter_search
+from .corpus import CorpusStore, get_store, list_collections, normalize_filters, ROUTING_TOP_DOCUMENTS
 import asyncio
 
-# Load environment variables
-load_dotenv()
-
-# Get OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
-
-# Initialize the Async OpenAI client
-client = AsyncOpenAI(api_key=api_key)
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
 
 # Default embedding model
 EMBEDDING_MODEL = "text-embedding-3-small"
-# Default encoding for token counting
-ENCODING = tiktoken.get_encoding("cl100k_base")
 # Maximum tokens for embedding model
 MAX_TOKENS = 8191
-# Path to store the FAISS index
+# Chunk size and overlap between consecutive chunks, in tokens
+CHUNK_SIZE = 512
+CHUNK_OVERLAP = 80
+# Chunks shorter than this are merged into the previous chunk of the same text
+MIN_CHUNK_TOKENS = 128
+# Chunks sent in one embedding request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Embedding requests in flight per document
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+# Threads used by tiktoken's batched encoder (1 tokenizes in the calling thread)
+TOKENIZER_THREADS = int(os.getenv("TOKENIZER_THREADS", str(min(8, os.cpu_count() or 1))))
+# Path to store the FAISS index of documents in the default collection
 EMBEDDINGS_DIR = Path(os.getenv("EMBEDDINGS_DIR", "./src/api/data/embeddings"))
 
+
+def __getattr__(name: str) -> Any:
+    # Default encoding for token counting, loaded on first access
+    if name == "ENCODING":
+        return get_encoding()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 async def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
     """Get embeddings for a text using OpenAI API."""
     text = text.replace("\n", " ")
-    
+    # Concurrent requests for the same text share one upstream call
+    return await coalesce(("embedding", model, text), lambda: _request_embedding(text, model))
+
+async def get_embeddings(texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """Get embeddings for a batch of texts in a single API request."""
+    return await _request_embeddings([text.replace("\n", " ") for text in texts], model)
+
+async def _request_embedding(text: str, model: str) -> List[float]:
+    """Request an embedding from the OpenAI API with retries."""
+    return (await _request_embeddings([text], model))[0]
+
+async def _request_embeddings(texts: List[str], model: str) -> List[List[float]]:
+    """Request embeddings for several texts from the OpenAI API with retries."""
     # Add retry logic
     max_retries = 3
     backoff_factor = 1.5
@@ -44,8 +66,8 @@ async def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
     
     while retry_count < max_retries:
         try:
-            response = await client.embeddings.create(input=[text], model=model)
-            return response.data[0].embedding
+            response = await get_openai_client().embeddings.create(input=texts, model=model)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
         except Exception as e:
             retry_count += 1
             if retry_count >= max_retries:
@@ -57,27 +79,60 @@ async def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
             print(f"Embedding API error: {str(e)}. Retrying in {wait_time:.1f} seconds...")
             await asyncio.sleep(wait_time)
 
-def chunk_text(text: str, chunk_size: int = 512, overlap: int = 80) -> List[str]:
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
     """Split text into overlapping chunks of tokens."""
-    tokens = ENCODING.encode(text)
-    chunks = []
-    
-    for i in range(0, len(tokens), chunk_size - overlap):
-        chunk_tokens = tokens[i:i + chunk_size]
-        if len(chunk_tokens) < 128:  # Skip chunks smaller than 128 tokens to maintain context
-            continue
-        chunks.append(ENCODING.decode(chunk_tokens))
-    
-    return chunks
+    return chunk_texts([text], chunk_size, overlap)[0]
+
+def token_windows(token_count: int, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int]]:
+    """(start, end) token offsets of the chunks of a text with ``token_count`` tokens.
+
+    A short tail is merged into the previous window instead of being dropped;
+    a text shorter than ``MIN_CHUNK_TOKENS`` still yields one window.
+    """
+    windows: List[Tuple[int, int]] = []
+    for start in range(0, token_count, chunk_size - overlap):
+        end = min(start + chunk_size, token_count)
+        if end - start < MIN_CHUNK_TOKENS and windows:
+            windows[-1] = (windows[-1][0], end)
+            break
+        windows.append((start, end))
+        if end == token_count:
+            break
+    return windows
+
+def chunk_texts(texts: List[str], chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[List[str]]:
+    """Split several texts into overlapping chunks of tokens at once.
+
+    All texts are tokenized in one multi-threaded batch, windows are sliced on
+    the token arrays, and only the kept windows are decoded.
+    """
+    encoding = get_encoding()
+    # Document text is never meant to contain special tokens, so skip the scan for them
+    if TOKENIZER_THREADS > 1 and len(texts) > 1:
+        token_lists = encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_THREADS)
+    else:
+        token_lists = [encoding.encode_ordinary(text) for text in texts]
+    # Decoding a window is cheaper than handing it to a thread pool, so decode inline
+    return [
+        [encoding.decode(tokens[start:end]) for start, end in token_windows(len(tokens), chunk_size, overlap)]
+        for tokens in token_lists
+    ]
 
 async def create_document_embeddings(
     document_id: str,
     # Accept processed_content which can be str or List[Tuple[int, str]]
     processed_content: Any, 
-    metadata: Optional[Dict] = None
+    metadata: Optional[Dict] = None,
+    publish: bool = True,
+    collection: Optional[str] = None
 ) -> Dict:
-    """Create embeddings for a document and store in FAISS index."""
-    EMBEDDINGS_DIR.mkdir(parents=True, exist_ok=True)
+    """Create embeddings for a document and store in FAISS index.
+
+    With ``publish`` set, a new corpus generation is built in the background and
+    swapped in once ready; bulk callers pass False and refresh once at the end.
+    The document is added to ``collection`` (the default collection if None).
+    """
+    store = get_store(collection)
     
     document_data = {
         "document_id": document_id,
@@ -86,90 +141,152 @@ async def create_document_embeddings(
     }
     
     embeddings = []
-    chunk_index_counter = 0
 
     # Handle based on content type
-    if isinstance(processed_content, str):
-        # Simple text document
-        chunks = chunk_text(processed_content)
-        for i, chunk in enumerate(chunks):
-            try:
-                embedding = await get_embedding(chunk)
-                embeddings.append(embedding)
-                document_data["chunks"].append({
-                    "chunk_id": f"{document_id}_t{i}", # Indicate text chunk
-                    "text": chunk,
-                    "embedding_index": chunk_index_counter,
-                    "page_number": None # No page number for plain text
-                })
-                chunk_index_counter += 1
-            except Exception as e:
-                print(f"Error embedding text chunk {i} for {document_id}: {e}")
-    elif isinstance(processed_content, list):
-        # List of (page_num, page_text) tuples (likely from PDF)
-        for page_num, page_text in processed_content:
-            if not page_text or not isinstance(page_text, str):
-                continue # Skip empty pages or invalid data
-                
-            page_chunks = chunk_text(page_text)
-            for i, chunk in enumerate(page_chunks):
-                try:
-                    embedding = await get_embedding(chunk)
-                    embeddings.append(embedding)
-                    document_data["chunks"].append({
-                        "chunk_id": f"{document_id}_p{page_num}_c{i}", # Include page and chunk index
-                        "text": chunk,
-                        "embedding_index": chunk_index_counter,
-                        "page_number": page_num # STORE THE PAGE NUMBER
-                    })
-                    chunk_index_counter += 1
-                except Exception as e:
-                    print(f"Error embedding chunk {i} from page {page_num} for {document_id}: {e}")
-    else:
+    if not isinstance(processed_content, (str, list)):
         # Handle error case or unsupported type
         error_message = f"Unsupported processed_content type: {type(processed_content)}"
         print(error_message)
         return {"success": False, "error": error_message}
-        
+
+    # Near-duplicates of chunks already indexed in the collection reuse their vectors instead of being embedded
+    detector = DuplicateDetector(document_id, partial(signature_candidates, collection=store.name))
+    chunks, duplicates = await asyncio.to_thread(detector.split, document_chunks(document_id, processed_content))
+    if not chunks and duplicates:
+        # A document made only of duplicates still needs one vector of its own
+        chunks.append(restore_canonical(duplicates.pop(0)))
+
+    # Embed in batches of EMBEDDING_BATCH_SIZE chunks, with at most
+    # EMBEDDING_CONCURRENCY requests in flight like the upload pipeline
+    batches = [chunks[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(chunks), EMBEDDING_BATCH_SIZE)]
+    slots = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def embed_batch(batch: List[Dict]) -> List[List[float]]:
+        async with slots:
+            return await get_embeddings([chunk["text"] for chunk in batch])
+
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches), return_exceptions=True)
+    for batch, vectors in zip(batches, results):
+        if isinstance(vectors, BaseException):
+            print(f"Error embedding chunks {batch[0]['chunk_id']}..{batch[-1]['chunk_id']} for {document_id}: {vectors}")
+            continue
+        for chunk, embedding in zip(batch, vectors):
+            embeddings.append(embedding)
+            chunk["embedding_index"] = len(document_data["chunks"])
+            document_data["chunks"].append(chunk)
+
     if not embeddings:
         # Check if content was just empty
         if not processed_content:
              return {"success": True, "document_id": document_id, "chunks": 0, "dimensions": None, "message": "Document was empty, skipping embedding."}
         return {"success": False, "error": "No valid embeddings created"}
     
-    # Ensure dimension is correctly calculated
-    dimension = len(embeddings[0]) if embeddings else 0
-    if dimension > 0:
-        embeddings_array = np.array(embeddings, dtype=np.float32)
-        index_path = EMBEDDINGS_DIR / f"{document_id}.index"
-        metadata_path = EMBEDDINGS_DIR / f"{document_id}.json"
-        
-        index = faiss.IndexFlatL2(dimension)
-        index.add(embeddings_array)
-        
-        faiss.write_index(index, str(index_path))
-        
-        with open(metadata_path, "w") as f:
-            json.dump(document_data, f)
-    else:
-        # Handle case where no embeddings were generated but content wasn't empty (e.g., all chunks failed)
-        return {"success": False, "error": "Embeddings could not be generated for any chunks."}
+    duplicate_count = attach_duplicates(document_id, document_data, duplicates)
+    dimension = await asyncio.to_thread(write_document_embeddings, document_id, document_data, embeddings, store.name)
+    if publish:
+        store.schedule_refresh()
 
     return {
         "success": True,
         "document_id": document_id,
         "chunks": len(document_data["chunks"]),
+        "duplicates": duplicate_count,
         "dimensions": dimension
     }
 
+def attach_duplicates(document_id: str, document_data: Dict, duplicates: List[Dict]) -> int:
+    """Append duplicate chunk records after the embedded chunks and report the savings.
+
+    Duplicates stay out of the vector rows, so row ``i`` of the index is still
+    ``chunks[i]``. Duplicates of a chunk of this document that failed to embed
+    are dropped. Returns the number of duplicates kept.
+    """
+    embedded = {chunk["chunk_id"] for chunk in document_data["chunks"]}
+    kept = [
+        chunk for chunk in duplicates
+        if chunk["duplicate_document"] != document_id or chunk["duplicate_of"] in embedded
+    ]
+    document_data["chunks"].extend(kept)
+    if kept:
+        total = len(document_data["chunks"])
+        cross_document = sum(1 for chunk in kept if chunk["duplicate_document"] != document_id)
+        print(
+            f"{document_id}: {len(kept)} of {total} chunks are near-duplicates "
+            f"({cross_document} of other documents); index {len(kept) / total:.0%} smaller"
+        )
+    return len(kept)
+
+def document_chunks(document_id: str, processed_content: Any) -> List[Dict]:
+    """Split processed content into chunk records, ready to be embedded.
+
+    ``processed_content`` is either plain text or a list of (page_num, page_text)
+    tuples (likely from a PDF).
+    """
+    if isinstance(processed_content, str):
+        # Simple text document
+        return page_chunks(document_id, [(None, processed_content)])
+    return page_chunks(document_id, processed_content)
+
+def page_chunks(document_id: str, pages: List[Tuple[Optional[int], str]]) -> List[Dict]:
+    """Chunk records for several pages, chunked in one batch.
+
+    A page number of None marks the text of a plain-text document.
+    """
+    # Skip empty pages or invalid data
+    pages = [(page_num, text) for page_num, text in pages if text and isinstance(text, str)]
+    chunks = []
+    for (page_num, _), page_texts in zip(pages, chunk_texts([text for _, text in pages])):
+        for i, chunk in enumerate(page_texts):
+            if page_num is None:
+                chunks.append({
+                    "chunk_id": f"{document_id}_t{i}", # Indicate text chunk
+                    "text": chunk,
+                    "page_number": None # No page number for plain text
+                })
+            else:
+                chunks.append({
+                    "chunk_id": f"{document_id}_p{page_num}_c{i}", # Include page and chunk index
+                    "text": chunk,
+                    "page_number": page_num # STORE THE PAGE NUMBER
+                })
+    return chunks
+
+def write_document_embeddings(
+    document_id: str,
+    document_data: Dict,
+    embeddings: List[List[float]],
+    collection: Optional[str] = None
+) -> int:
+    """Store a document's vectors and chunk metadata in a collection, returning the dimension.
+
+    The document is also added to the catalog.
+    """
+    store = get_store(collection)
+    store.embeddings_dir.mkdir(parents=True, exist_ok=True)
+    dimension = len(embeddings[0])
+    embeddings_array = np.array(embeddings, dtype=np.float32)
+    index_path = store.embeddings_dir / f"{document_id}.index"
+    metadata_path = store.embeddings_dir / f"{document_id}.json"
+    
+    index = faiss.IndexFlatL2(dimension)
+    index.add(embeddings_array)
+    
+    faiss.write_index(index, str(index_path))
+    
+    with open(metadata_path, "w") as f:
+        json.dump(document_data, f)
+    record_document(document_id, document_data, store.name)
+    return dimension
+
 async def search_embeddings(
     document_id: str, 
     query: str, 
     top_k: int = 3
 ) -> List[Dict]:
     """Search document embeddings for similar chunks (async version)."""
-    index_path = EMBEDDINGS_DIR / f"{document_id}.index"
-    metadata_path = EMBEDDINGS_DIR / f"{document_id}.json"
+    store = await run_io(document_store, document_id)
+    index_path = store.embeddings_dir / f"{document_id}.index"
+    metadata_path = store.embeddings_dir / f"{document_id}.json"
     
     if not await asyncio.to_thread(index_path.exists) or not await asyncio.to_thread(metadata_path.exists):
         return []
@@ -187,10 +304,8 @@ async def search_embeddings(
     query_embedding = await get_embedding(query)
     query_embedding_array = np.array([query_embedding], dtype=np.float32)
     
-    # FAISS search is CPU-bound, can run in thread executor if needed, but often fast enough.
-    # For simplicity, keeping it synchronous for now within the async function.
-    # If it becomes a bottleneck, wrap index.search in asyncio.to_thread.
-    distances, indices = index.search(query_embedding_array, top_k) 
+    # FAISS search is CPU-bound and releases the GIL, so keep it off the event loop
+    distances, indices = await asyncio.to_thread(index.search, query_embedding_array, top_k)
     
     # Prepare results
     results = []
@@ -207,74 +322,165 @@ async def search_embeddings(
             
     return results
 
-async def search_all_documents(query: str, top_k: int = 3) -> List[Dict]:
-    """Search across all document embeddings for similar chunks (async version)."""
-    if not await asyncio.to_thread(EMBEDDINGS_DIR.exists):
-        return []
-    
-    # Get all metadata files asynchronously
-    def list_json_files(path):
-        return list(path.glob("*.json"))
-        
-    metadata_files = await asyncio.to_thread(list_json_files, EMBEDDINGS_DIR)
-    if not metadata_files:
-        return []
-    
+async def search_all_documents(
+    query: str,
+    top_k: int = 3,
+    filters: Optional[Dict] = None,
+    route_documents: Optional[int] = None,
+    query_embedding: Optional[List[float]] = None,
+    collection: Optional[str] = None
+) -> List[Dict]:
+    """Search across all document embeddings of a collection for similar chunks (async version).
+
+    ``filters`` restrict the search to matching chunks before scoring (see
+    ``corpus.normalize_filters`` for the supported keys). ``route_documents``
+    limits the search to that many documents picked by their centroids
+    (defaults to ``ROUTING_TOP_DOCUMENTS``; 0 searches every document).
+    Pass ``query_embedding`` if the query has already been embedded.
+    """
     # Get query embedding asynchronously
-    query_embedding = await get_embedding(query)
-    query_embedding_array = np.array([query_embedding], dtype=np.float32)
-    
-    # --- Helper function to process a single document asynchronously ---
-    async def process_single_document(metadata_file: Path) -> List[Dict]:
-        document_id = metadata_file.stem
-        index_path = metadata_file.with_suffix(".index")
-        
-        if not await asyncio.to_thread(index_path.exists):
-            return []
-            
-        # Load index and metadata asynchronously
-        index = await asyncio.to_thread(faiss.read_index, str(index_path))
-        
-        def load_json(path):
-            with open(path, "r") as f:
-                return json.load(f)
-        document_data = await asyncio.to_thread(load_json, metadata_file)
-        
-        # Search (sync within this task for now, see comment in search_embeddings)
-        distances, indices = index.search(query_embedding_array, top_k)
-        
-        doc_results = []
-        chunks_data = document_data.get("chunks", [])
-        metadata_base = document_data.get("metadata", {}).copy()
-
-        for i, idx in enumerate(indices[0]):
-            if 0 <= idx < len(chunks_data):
-                chunk = chunks_data[idx]
-                
-                chunk_metadata = metadata_base.copy() # Start with base doc metadata
-                if "page_number" in chunk:
-                    chunk_metadata["page_number"] = chunk["page_number"]
-                
-                doc_results.append({
-                    "document_id": document_id,
-                    "chunk_id": chunk.get("chunk_id", f"{document_id}_{idx}"),
-                    "text": chunk.get("text", ""),
-                    "score": float(distances[0][i]), # Ensure float
-                    "metadata": chunk_metadata 
-                })
-        return doc_results
-    # --------------------------------------------------------------------
+    if query_embedding is None:
+        query_embedding = await get_embedding(query)
+    return (await search_vectors([query_embedding], top_k, filters, route_documents, collection))[0]
 
-    # Gather results from all documents concurrently
-    tasks = [process_single_document(mf) for mf in metadata_files]
-    results_list = await asyncio.gather(*tasks)
-    
-    # Flatten the list of lists
-    all_results = [item for sublist in results_list for item in sublist]
-    
-    # Sort by score (sync, fast operation)
-    all_results.sort(key=lambda x: x["score"])
-    return all_results[:top_k]
+async def search_vectors(
+    query_embeddings: List[List[float]],
+    top_k: int = 3,
+    filters: Optional[Dict] = None,
+    route_documents: Optional[int] = None,
+    collection: Optional[str] = None
+) -> List[List[Dict]]:
+    """Search for the top-k chunks of many query embeddings in one matrix search.
+
+    Uses the shard servers when ``SHARD_URLS`` is set, the local corpus otherwise.
+    """
+    if route_documents is None:
+        route_documents = ROUTING_TOP_DOCUMENTS
+    query_vectors = np.array(query_embeddings, dtype=np.float32)
+    if SHARD_URLS:
+        return await scatter_search(query_vectors, top_k, filters, route_documents, collection=collection)
+    return await search_corpus(query_vectors, top_k, filters, route_documents, collection)
+
+async def search_corpus(
+    query_vectors: "np.ndarray",
+    top_k: int,
+    filters: Optional[Dict] = None,
+    route_documents: int = 0,
+    collection: Optional[str] = None
+) -> List[List[Dict]]:
+    """Search the local corpus index of a collection for a batch of query vectors."""
+    store = get_store(collection)
+    if not store.ensured:
+        if not await asyncio.to_thread(store.embeddings_dir.is_dir):
+            return [[] for _ in range(len(query_vectors))]
+        # First search of the collection in this worker: seal documents added
+        # while no worker was running before mapping it
+        await asyncio.to_thread(store.ensure_corpus)
+    # One exact search over the resident corpus index replaces the per-document
+    # load-and-search loop; FAISS releases the GIL, so run it in a thread.
+    # Resolving the generation may map it and evict other collections, so it
+    # is pinned in the same thread and stays pinned until the search finishes,
+    # even if a newer one is swapped in meanwhile.
+    return await asyncio.to_thread(
+        store.search, query_vectors, top_k, normalize_filters(filters), route_documents
+    )
+
+def delete_document_embeddings(document_id: str) -> bool:
+    """Remove a document's embeddings and hide it from search immediately.
+
+    The document is tombstoned in the corpus index, so it disappears from
+    results without a rebuild; compaction is scheduled once enough rows
+    are tombstoned.
+    """
+    if not retire_document_embeddings(document_id, document_store(document_id).name):
+        return False
+    remove_document(document_id)
+    return True
+
+def retire_document_embeddings(document_id: str, collection: Optional[str] = None) -> bool:
+    """Tombstone and remove a document's embeddings from a collection, keeping its catalog entry.
+
+    Returns False if the collection has no embeddings of the document.
+    """
+    store = get_store(collection)
+    index_path = store.embeddings_dir / f"{document_id}.index"
+    metadata_path = store.embeddings_dir / f"{document_id}.json"
+    if not metadata_path.exists() and not index_path.exists():
+        return False
+
+    version = metadata_path.stat().st_mtime_ns if metadata_path.exists() else time.time_ns()
+    store.add_tombstone(document_id, version)
+    # Chunks of other documents that reuse this document's vectors get copies first
+    promoted = promote_duplicates(document_id, store.name)
+    index_path.unlink(missing_ok=True)
+    metadata_path.unlink(missing_ok=True)
+    if promoted:
+        store.schedule_refresh()
+    store.maybe_compact()
+    return True
+
+def document_store(document_id: str) -> CorpusStore:
+    """Store of the collection a document belongs to, by its catalog entry."""
+    entry = get_document(document_id)
+    return get_store(entry["collection"] if entry else None)
+
+def read_document_embeddings(document_id: str, collection: Optional[str] = None) -> Optional[Tuple[Dict, "np.ndarray"]]:
+    """A document's chunk metadata and vectors, or None if they cannot be read."""
+    embeddings_dir = get_store(collection).embeddings_dir
+    try:
+        with open(embeddings_dir / f"{document_id}.json", "r") as f:
+            document_data = json.load(f)
+        index = faiss.read_index(str(embeddings_dir / f"{document_id}.index"))
+    except Exception as e:
+        print(f"Error reading embeddings of {document_id}: {e}")
+        return None
+    return document_data, index.reconstruct_n(0, index.ntotal)
+
+def promote_duplicates(document_id: str, collection: Optional[str] = None) -> int:
+    """Copy this document's vectors into the documents whose duplicates point at them.
+
+    In each dependent document, the first duplicate of a chunk becomes canonical
+    with a copy of the vector, and further duplicates of the same chunk point at
+    it. Duplicates are only matched within a collection, so the dependents are
+    in the document's ``collection``. Returns the number of documents rewritten.
+    """
+    dependents = duplicate_dependents(document_id)
+    source = read_document_embeddings(document_id, collection) if dependents else None
+    if source is None:
+        return 0
+    source_data, source_vectors = source
+    vectors_by_chunk = {
+        chunk["chunk_id"]: source_vectors[chunk["embedding_index"]]
+        for chunk in source_data.get("chunks", [])
+        if chunk.get("embedding_index") is not None and chunk["embedding_index"] < len(source_vectors)
+    }
+
+    rewritten = 0
+    for dependent_id in dependents:
+        loaded = read_document_embeddings(dependent_id, collection)
+        if loaded is None:
+            continue
+        document_data, vectors = loaded
+        vectors = list(vectors)
+        promoted: Dict[str, str] = {}
+        canonical, duplicates = [], []
+        for chunk in document_data["chunks"]:
+            target = chunk.get("duplicate_of")
+            if chunk.get("duplicate_document") == document_id and target in vectors_by_chunk:
+                if target in promoted:
+                    chunk["duplicate_of"], chunk["duplicate_document"] = promoted[target], dependent_id
+                else:
+                    restore_canonical(chunk)
+                    chunk["embedding_index"] = len(vectors)
+                    vectors.append(vectors_by_chunk[target])
+                    promoted[target] = chunk["chunk_id"]
+            (duplicates if chunk.get("duplicate_of") else canonical).append(chunk)
+        canonical.sort(key=lambda chunk: chunk["embedding_index"])
+        document_data["chunks"] = canonical + duplicates
+        write_document_embeddings(dependent_id, document_data, vectors, collection)
+        rewritten += 1
+    print(f"Copied vectors of {document_id} into {rewritten} documents with duplicates of its chunks")
+    return rewritten
 
 def get_all_documents() -> List[Dict]:
     """Get list of all documents in the documents directory."""
@@ -294,14 +500,15 @@ def get_all_documents() -> List[Dict]:
     return documents
 
 def get_all_embedded_documents() -> List[str]:
-    """Get list of document IDs that have embeddings."""
-    if not EMBEDDINGS_DIR.exists():
-        return []
-    
+    """Get list of document IDs that have embeddings, in any collection."""
     embedded_docs = []
-    for metadata_file in EMBEDDINGS_DIR.glob("*.json"):
-        if metadata_file.with_suffix(".index").exists():
-            embedded_docs.append(metadata_file.stem)
+    for collection in list_collections():
+        embeddings_dir = get_store(collection).embeddings_dir
+        if not embeddings_dir.exists():
+            continue
+        for metadata_file in embeddings_dir.glob("*.json"):
+            if metadata_file.with_suffix(".index").exists():
+                embedded_docs.append(metadata_file.stem)
     return embedded_docs
 
 async def verify_document_embeddings() -> Dict[str, Any]:
@@ -310,8 +517,8 @@ async def verify_document_embeddings() -> Dict[str, Any]:
     if not await asyncio.to_thread(documents_dir.exists):
         return {"is_complete": True, "missing": [], "total": 0}
         
-    all_files = [p.stem for p in await asyncio.to_thread(list, documents_dir.glob("*")) if await asyncio.to_thread(p.is_file)]
-    embedded_files = get_all_embedded_documents()
+    all_files = await run_io(lambda: [p.stem for p in documents_dir.glob("*") if p.is_file()])
+    embedded_files = set(await run_io(get_all_embedded_documents))
     
     missing = [doc_id for doc_id in all_files if doc_id not in embedded_files]
     
@@ -331,12 +538,9 @@ async def process_missing_embeddings() -> Dict[str, Any]:
     failed_count = 0
     failed_docs = []
     
-    documents_dir = Path(os.getenv("DOCUMENTS_DIR", "./data/documents"))
-
     for doc_id in verification["missing"]:
-        # Reconstruct the expected path based on doc_id and potential extensions
-        # This assumes doc_id is the stem and we need to find the actual file
-        possible_files = list(documents_dir.glob(f"{doc_id}.*"))
+        # Stored originals are named after their document id
+        possible_files = await run_io(document_files, doc_id)
         if not possible_files:
             print(f"Warning: Could not find original file for missing document ID: {doc_id}")
             failed_count += 1
@@ -347,14 +551,18 @@ async def process_missing_embeddings() -> Dict[str, Any]:
         
         try:
             print(f"Processing missing embeddings for: {file_path.name}")
-            # Get content and metadata
-            content, metadata = get_document_content(str(file_path))
+            # Get content and metadata; PDF parsing blocks, so do it off the event loop
+            content = await run_io(get_document_content, doc_id)
+            if content is None:
+                raise ValueError(f"Could not read {file_path.name}")
+            metadata = {"filename": file_path.name, "file_type": file_path.suffix}
             
             # Create embeddings
             result = await create_document_embeddings(
                 doc_id,
                 content,
-                metadata
+                metadata,
+                publish=False
             )
             if result["success"]:
                 processed_count += 1
@@ -367,6 +575,10 @@ async def process_missing_embeddings() -> Dict[str, Any]:
             failed_docs.append(doc_id)
             print(f"Error processing document {doc_id}: {str(e)}")
             
+    # Publish all newly embedded documents in a single corpus generation
+    if processed_count:
+        get_store().schedule_refresh()
+
     # Re-verify after processing
     final_verification = await verify_document_embeddings()
     
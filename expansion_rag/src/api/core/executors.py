@@ -0,0 +1,24 @@
+"""Bounded thread pools for blocking work called from async handlers.
+
+Disk copies, JSON scans and file deletions run on their own small pool, so a
+burst of uploads or listings queues up there instead of stalling the event loop
+or starving the default executor that FAISS searches and PDF extraction use.
+"""
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+# Threads for blocking file-system work
+IO_THREADS = int(os.getenv("IO_THREADS", "4"))
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+
+async def run_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run blocking file-system work on the I/O pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_pool, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,337 @@
+"""Memory accounting and a per-worker memory budget.
+
+Components holding a significant amount of memory register a consumer with
+the budget: a function reporting their size by part (e.g. vectors, chunk text,
+caches) and, if they can give memory back, an eviction function. Collection
+indexes, their search caches and PDF extraction register here.
+
+Every ``MEMORY_CHECK_SECONDS``, and whenever an index is mapped, the worker's
+proportional set size (PSS) is compared with its budget: pages of the corpus
+files mapped by every worker count once, split between the workers, rather
+than once per worker. When PSS is over budget only because of clean pages of
+mapped files, nothing is evicted: the kernel drops those pages itself under
+memory pressure. Otherwise evictable consumers are evicted one by one, least
+recently used first (or largest first with ``MEMORY_EVICTION_POLICY=largest``),
+until the memory the kernel cannot drop is back under budget. The most
+recently used consumer is never evicted, so the collection being searched is
+not unmapped and mapped again on every check. Evicted indexes are mapped again
+on their next query.
+
+The budget is ``MEMORY_BUDGET_MB`` per worker, or by default
+``MEMORY_BUDGET_FRACTION`` of the container's memory limit split between the
+``WEB_CONCURRENCY`` workers; without either, memory is only reported.
+
+Sizes of memory-mapped files count the whole file; pages the kernel has not
+read in, or has dropped, are not actually resident.
+"""
+import os
+import gc
+import sys
+import time
+import ctypes
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of each worker; 0 derives it from the container limit
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+# Share of the container memory limit the workers may use together
+MEMORY_BUDGET_FRACTION = float(os.getenv("MEMORY_BUDGET_FRACTION", "0.8"))
+# Seconds between two budget checks
+MEMORY_CHECK_SECONDS = float(os.getenv("MEMORY_CHECK_SECONDS", "5"))
+# Which consumers are evicted first: "lru" (least recently used) or "largest"
+MEMORY_EVICTION_POLICY = os.getenv("MEMORY_EVICTION_POLICY", "lru").lower()
+
+# Memory limit files of cgroup v2 and v1; v1 reports "no limit" as a huge number
+_CGROUP_LIMITS = (Path("/sys/fs/cgroup/memory.max"), Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"))
+_CGROUP_USAGE = (Path("/sys/fs/cgroup/memory.current"), Path("/sys/fs/cgroup/memory/memory.usage_in_bytes"))
+_UNLIMITED = 1 << 60
+
+
+def _read_int(paths) -> Optional[int]:
+    for path in paths:
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < _UNLIMITED:
+            return int(value)
+        return None
+    return None
+
+
+def container_limit() -> Optional[int]:
+    """The container's memory limit in bytes, or None if there is none."""
+    return _read_int(_CGROUP_LIMITS)
+
+
+def container_usage() -> Optional[int]:
+    """Memory charged to the container (page cache included), or None outside a cgroup."""
+    return _read_int(_CGROUP_USAGE)
+
+
+def _statm() -> Optional[List[int]]:
+    """Fields of /proc/self/statm in bytes, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return [int(field) * os.sysconf("SC_PAGE_SIZE") for field in f.read().split()]
+    except (OSError, ValueError):
+        return None
+
+
+def _smaps_rollup() -> Dict[str, int]:
+    """Fields of /proc/self/smaps_rollup in bytes (Linux 4.14+), empty where unavailable."""
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                value = value.split()
+                if len(value) == 2 and value[1] == "kB" and value[0].isdigit():
+                    fields[key] = int(value[0]) * 1024
+    except OSError:
+        pass
+    return fields
+
+
+def resident_bytes() -> Optional[int]:
+    """Resident set size of this process, or None where /proc is unavailable."""
+    statm = _statm()
+    return statm[1] if statm and len(statm) > 1 else None
+
+
+def memory_usage() -> Optional[Tuple[int, int]]:
+    """Memory of this process as (proportional, unreclaimable) bytes, or None without /proc.
+
+    Proportional memory is PSS: shared pages count divided by the number of
+    processes mapping them, so the corpus mapped by every worker counts once
+    across the workers. Unreclaimable memory leaves out clean pages of mapped
+    files, which the kernel drops under memory pressure and reads again on use.
+    Without smaps_rollup, shared file pages are left out of the resident set.
+    """
+    rollup = _smaps_rollup()
+    if "Pss" in rollup:
+        if "Pss_Dirty" in rollup:
+            unreclaimable = rollup["Pss_Dirty"]
+        elif "Pss_Anon" in rollup:
+            unreclaimable = rollup["Pss_Anon"] + rollup.get("Pss_Shmem", 0)
+        else:
+            unreclaimable = rollup.get("Private_Dirty", 0) + rollup.get("Shared_Dirty", 0)
+        return rollup["Pss"], min(unreclaimable, rollup["Pss"])
+    statm = _statm()
+    if not statm or len(statm) < 3:
+        return None
+    private = max(0, statm[1] - statm[2])
+    return private, private
+
+
+def _malloc_trim() -> None:
+    """Return free heap pages to the system (glibc only, see PYTHONMALLOC in the dockerfile)."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def default_budget() -> Optional[int]:
+    """Budget of one worker from the settings and the container limit, or None."""
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB * 1024 * 1024
+    limit = container_limit()
+    if limit is None:
+        return None
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    return int(limit * MEMORY_BUDGET_FRACTION / workers)
+
+
+class MemoryConsumer:
+    """A component whose memory is accounted, and evicted if it supports it."""
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        sizes: Callable[[], Dict[str, int]],
+        evict: Optional[Callable[[], int]] = None,
+        last_used: Optional[Callable[[], float]] = None
+    ):
+        self.name = name
+        self.kind = kind
+        # Bytes by part, e.g. {"vectors": ..., "chunk_text": ...}
+        self.sizes = sizes
+        # Gives the memory back and returns the bytes released
+        self.evict = evict
+        # Monotonic time of last use; consumers without one count as never used
+        self.last_used = last_used or (lambda: 0.0)
+
+
+class MemoryBudget:
+    """Registry of memory consumers and the eviction policy over them."""
+
+    def __init__(self, budget: Optional[int] = None, policy: str = MEMORY_EVICTION_POLICY):
+        self.budget = budget
+        self.policy = policy
+        self.evictions = 0
+        self.evicted_bytes = 0
+        # Whether the last check found usage over budget with nothing to evict
+        self._exhausted = False
+        self._consumers: Dict[str, MemoryConsumer] = {}
+        self._lock = threading.Lock()
+        self._enforce_lock = threading.Lock()
+
+    def register(self, consumer: MemoryConsumer) -> MemoryConsumer:
+        with self._lock:
+            self._consumers[consumer.name] = consumer
+        return consumer
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._consumers.pop(name, None)
+
+    def consumers(self) -> List[MemoryConsumer]:
+        with self._lock:
+            return list(self._consumers.values())
+
+    def usage(self) -> Tuple[int, int]:
+        """Memory counted against the budget as (proportional, unreclaimable) bytes.
+
+        See ``memory_usage``; without /proc both are the accounted total.
+        """
+        usage = memory_usage()
+        if usage is not None:
+            return usage
+        accounted = sum(sum(consumer.sizes().values()) for consumer in self.consumers())
+        return accounted, accounted
+
+    def _eviction_order(self, keep: Optional[str]) -> List[MemoryConsumer]:
+        candidates = [
+            consumer for consumer in self.consumers()
+            if consumer.evict is not None and consumer.name != keep and sum(consumer.sizes().values())
+        ]
+        if not candidates:
+            return []
+        # The most recently used consumer stays, e.g. the collection that was
+        # just searched, or the only one mapped
+        latest = max(candidates, key=lambda consumer: consumer.last_used())
+        candidates.remove(latest)
+        if self.policy == "largest":
+            return sorted(candidates, key=lambda consumer: -sum(consumer.sizes().values()))
+        return sorted(candidates, key=lambda consumer: consumer.last_used())
+
+    def enforce(self, keep: Optional[str] = None) -> int:
+        """Evict consumers until unreclaimable memory is under budget; returns the bytes released.
+
+        ``keep`` names a consumer that is not evicted, e.g. the index a query
+        is about to search; the most recently used consumer is not evicted either.
+        """
+        if self.budget is None:
+            return 0
+        with self._enforce_lock:
+            usage, unreclaimable = self.usage()
+            if unreclaimable <= self.budget:
+                # Whatever is over budget is clean mapped pages the kernel can drop
+                self._exhausted = False
+                return 0
+            released_total = 0
+            for consumer in self._eviction_order(keep):
+                released = consumer.evict()
+                if not released:
+                    continue
+                released_total += released
+                self.evictions += 1
+                self.evicted_bytes += released
+                logger.warning(
+                    f"Memory at {usage / 1e6:.0f} MB ({unreclaimable / 1e6:.0f} MB unreclaimable) "
+                    f"of a {self.budget / 1e6:.0f} MB budget: evicted {consumer.name} ({released / 1e6:.1f} MB)"
+                )
+                usage, unreclaimable = self.usage()
+                if unreclaimable <= self.budget:
+                    break
+            if released_total:
+                # Free what the evicted consumers left in reference cycles and
+                # return the heap to the system before the next check
+                gc.collect()
+                _malloc_trim()
+            elif not self._exhausted:
+                self._exhausted = True
+                logger.warning(
+                    f"Memory at {usage / 1e6:.0f} MB ({unreclaimable / 1e6:.0f} MB unreclaimable) "
+                    f"of a {self.budget / 1e6:.0f} MB budget and nothing left to evict"
+                )
+            return released_total
+
+    def report(self) -> Dict:
+        """Sizes of all consumers and the process, for ``GET /debug/memory``."""
+        now = time.monotonic()
+        components = []
+        for consumer in self.consumers():
+            parts = consumer.sizes()
+            last_used = consumer.last_used()
+            components.append({
+                "name": consumer.name,
+                "kind": consumer.kind,
+                "bytes": sum(parts.values()),
+                "parts": parts,
+                "evictable": consumer.evict is not None,
+                "idle_seconds": round(now - last_used, 3) if last_used else None,
+            })
+        components.sort(key=lambda component: -component["bytes"])
+        usage = memory_usage()
+        return {
+            "resident_bytes": resident_bytes(),
+            "proportional_bytes": usage[0] if usage else None,
+            "unreclaimable_bytes": usage[1] if usage else None,
+            "budget_bytes": self.budget,
+            "policy": self.policy,
+            "container_limit_bytes": container_limit(),
+            "container_usage_bytes": container_usage(),
+            "accounted_bytes": sum(component["bytes"] for component in components),
+            "python_allocated_blocks": sys.getallocatedblocks(),
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "components": components,
+        }
+
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_budget() -> MemoryBudget:
+    """The memory budget of this worker."""
+    global _budget
+    if _budget is None:
+        with _budget_lock:
+            if _budget is None:
+                _budget = MemoryBudget(default_budget())
+    return _budget
+
+
+def register_consumer(
+    name: str,
+    kind: str,
+    sizes: Callable[[], Dict[str, int]],
+    evict: Optional[Callable[[], int]] = None,
+    last_used: Optional[Callable[[], float]] = None
+) -> MemoryConsumer:
+    """Account a component's memory with this worker's budget."""
+    return get_budget().register(MemoryConsumer(name, kind, sizes, evict, last_used))
+
+
+async def run_memory_budget() -> None:
+    """Check the budget every ``MEMORY_CHECK_SECONDS`` until cancelled."""
+    budget = get_budget()
+    if budget.budget is None:
+        logger.info("No memory budget (no MEMORY_BUDGET_MB and no container limit); memory is only reported")
+        return
+    logger.info(f"Memory budget of {budget.budget / 1e6:.0f} MB per worker ({budget.policy} eviction)")
+    while True:
+        await asyncio.sleep(MEMORY_CHECK_SECONDS)
+        try:
+            await asyncio.to_thread(budget.enforce)
+        except Exception as e:
+            logger.error(f"Memory budget check failed: {e}")
@@ -0,0 +1,288 @@
+"""Streaming ingestion: extraction, chunking and embedding run as overlapping stages.
+
+A document's pages flow through three stages connected by bounded queues:
+
+- extraction pulls pages from a (possibly lazy) page iterator in a worker thread
+- chunking splits the waiting pages into token windows, one tokenizer batch at a time
+- embedding groups chunks into batches and sends up to ``EMBEDDING_CONCURRENCY``
+  requests at a time
+
+While a batch is being embedded, the next pages are already being parsed, so
+ingesting a document takes roughly as long as the slower of parsing and
+embedding rather than their sum. When every request slot is busy the embedding
+stage stops taking chunks, the queues fill up and extraction pauses, so memory
+stays bounded however large the document is.
+"""
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .embeddings import (
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY, attach_duplicates, document_chunks, get_embeddings, page_chunks,
+    write_document_embeddings
+)
+from .catalog import signature_candidates
+from .dedup import DuplicateDetector, restore_canonical
+from .corpus import get_store
+
+logger = logging.getLogger(__name__)
+
+# Pages and chunk batches buffered between stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+# Short text records stored and published together by bulk text ingestion
+BULK_BATCH_RECORDS = int(os.getenv("BULK_BATCH_RECORDS", "256"))
+# Chunks sent in one embedding request by bulk text ingestion
+BULK_EMBEDDING_BATCH_SIZE = int(os.getenv("BULK_EMBEDDING_BATCH_SIZE", "512"))
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+async def _extract(pages: Iterator[Tuple[Optional[int], str]], out: asyncio.Queue, timings: Dict[str, float]) -> None:
+    """Pull pages from the iterator in a worker thread and queue them."""
+    while True:
+        start = time.perf_counter()
+        page = await asyncio.to_thread(next, pages, _DONE)
+        timings["extract"] += time.perf_counter() - start
+        await out.put(page)
+        if page is _DONE:
+            break
+
+
+async def _chunk(
+    document_id: str,
+    pages: asyncio.Queue,
+    out: asyncio.Queue,
+    counts: Dict[str, int],
+    duplicates: List[Dict],
+    collection: str
+) -> None:
+    """Split queued pages into chunks and queue them in embedding batches.
+
+    Pages that are already waiting are chunked together in one tokenizer batch.
+    Near-duplicate chunks of the collection go to ``duplicates`` instead of
+    being embedded.
+    """
+    detector = DuplicateDetector(document_id, partial(signature_candidates, collection=collection))
+    batch: List[Dict] = []
+    done = False
+    while not done:
+        ready = [await pages.get()]
+        while not pages.empty():
+            ready.append(pages.get_nowait())
+        if ready[-1] is _DONE:
+            done = True
+            ready.pop()
+        # Skip empty pages or invalid data
+        ready = [(page_num, text) for page_num, text in ready if text and isinstance(text, str)]
+        counts["pages"] += len(ready)
+        canonical, duplicate = await asyncio.to_thread(lambda: detector.split(page_chunks(document_id, ready)))
+        duplicates.extend(duplicate)
+        for chunk in canonical:
+            batch.append(chunk)
+            if len(batch) == EMBEDDING_BATCH_SIZE:
+                await out.put(batch)
+                batch = []
+    if batch:
+        await out.put(batch)
+    await out.put(_DONE)
+
+
+async def _embed(document_id: str, batches: asyncio.Queue, timings: Dict[str, float]) -> List[Tuple[List[Dict], Optional[List[List[float]]]]]:
+    """Embed queued batches with bounded concurrency, keeping their order."""
+    slots = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    requests: List[asyncio.Task] = []
+
+    async def embed_batch(batch: List[Dict]) -> Tuple[List[Dict], Optional[List[List[float]]]]:
+        start = time.perf_counter()
+        try:
+            return batch, await get_embeddings([chunk["text"] for chunk in batch])
+        except Exception as e:
+            print(f"Error embedding chunks {batch[0]['chunk_id']}..{batch[-1]['chunk_id']} for {document_id}: {e}")
+            return batch, None
+        finally:
+            timings["embed"] += time.perf_counter() - start
+            slots.release()
+
+    try:
+        while True:
+            # Wait for a free request slot before taking more work, so upstream
+            # stages block once the queues are full
+            await slots.acquire()
+            batch = await batches.get()
+            if batch is _DONE:
+                slots.release()
+                break
+            requests.append(asyncio.create_task(embed_batch(batch)))
+        return list(await asyncio.gather(*requests))
+    except BaseException:
+        for request in requests:
+            request.cancel()
+        raise
+
+
+async def ingest_document_stream(
+    document_id: str,
+    content: Union[str, Iterable[Tuple[int, str]]],
+    metadata: Optional[Dict] = None,
+    publish: bool = True,
+    collection: Optional[str] = None,
+    before_write: Optional[Callable[[], None]] = None
+) -> Dict:
+    """Chunk, embed and store a document while its pages are still being extracted.
+
+    ``content`` is either plain text or an iterable of (page_num, page_text)
+    tuples; a lazy iterator (see ``document_processor.stream_pdf_with_retry``)
+    is consumed in a worker thread as the pipeline makes room. Returns the same
+    result as ``embeddings.create_document_embeddings``. Errors raised by the
+    iterator propagate, and nothing is stored in that case.
+
+    ``before_write`` runs in a worker thread once the document is embedded,
+    right before its embeddings are written; replacing a document uses it to
+    swap in the new original file only when the new version is complete.
+    """
+    store = get_store(collection)
+    pages: Iterator[Tuple[Optional[int], str]] = iter([(None, content)] if isinstance(content, str) else content)
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    batch_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    timings = {"extract": 0.0, "embed": 0.0}
+    counts = {"pages": 0}
+    duplicates: List[Dict] = []
+
+    start = time.perf_counter()
+    stages = [
+        asyncio.create_task(_extract(pages, page_queue, timings)),
+        asyncio.create_task(_chunk(document_id, page_queue, batch_queue, counts, duplicates, store.name)),
+        asyncio.create_task(_embed(document_id, batch_queue, timings)),
+    ]
+    try:
+        _, _, results = await asyncio.gather(*stages)
+    except BaseException:
+        for stage in stages:
+            stage.cancel()
+        raise
+    if duplicates and not any(batch for batch, _ in results):
+        # A document made only of duplicates still needs one vector of its own
+        chunk = restore_canonical(duplicates.pop(0))
+        try:
+            results.append(([chunk], await get_embeddings([chunk["text"]])))
+        except Exception as e:
+            print(f"Error embedding chunk {chunk['chunk_id']} for {document_id}: {e}")
+    elapsed = time.perf_counter() - start
+
+    document_data: Dict[str, Any] = {
+        "document_id": document_id,
+        "chunks": [],
+        "metadata": metadata or {}
+    }
+    embeddings: List[List[float]] = []
+    for batch, vectors in results:
+        if vectors is None:
+            continue
+        for chunk, vector in zip(batch, vectors):
+            chunk["embedding_index"] = len(document_data["chunks"])
+            document_data["chunks"].append(chunk)
+            embeddings.append(vector)
+
+    logger.info(
+        f"Pipelined {document_id}: {counts['pages']} pages, {len(embeddings)} chunks in {elapsed:.2f}s "
+        f"(extraction {timings['extract']:.2f}s, embedding {timings['embed']:.2f}s)"
+    )
+
+    if not embeddings:
+        if not counts["pages"]:
+            return {"success": True, "document_id": document_id, "chunks": 0, "dimensions": None, "message": "Document was empty, skipping embedding."}
+        return {"success": False, "error": "No valid embeddings created"}
+
+    duplicate_count = attach_duplicates(document_id, document_data, duplicates)
+    if before_write is not None:
+        await asyncio.to_thread(before_write)
+    dimension = await asyncio.to_thread(write_document_embeddings, document_id, document_data, embeddings, store.name)
+    if publish:
+        store.schedule_refresh()
+
+    return {
+        "success": True,
+        "document_id": document_id,
+        "chunks": len(document_data["chunks"]),
+        "duplicates": duplicate_count,
+        "dimensions": dimension
+    }
+
+
+async def ingest_text_batch(records: List[Dict], collection: Optional[str] = None) -> List[Dict]:
+    """Chunk, embed and store a batch of text documents, then publish them together.
+
+    ``records`` hold the ``document_id``, ``content`` and ``metadata`` of each
+    document, all added to ``collection``. The chunks of the whole batch are
+    embedded in requests of up to ``BULK_EMBEDDING_BATCH_SIZE`` texts, and the
+    batch becomes searchable in a single corpus generation. Returns one result
+    per record, like ``embeddings.create_document_embeddings``.
+    """
+    corpus_store = get_store(collection)
+    lookup = partial(signature_candidates, collection=corpus_store.name)
+
+    def split_records() -> List[Tuple[List[Dict], List[Dict]]]:
+        prepared = []
+        for record in records:
+            detector = DuplicateDetector(record["document_id"], lookup)
+            chunks, duplicates = detector.split(document_chunks(record["document_id"], record["content"]))
+            if not chunks and duplicates:
+                # A document made only of duplicates still needs one vector of its own
+                chunks.append(restore_canonical(duplicates.pop(0)))
+            prepared.append((chunks, duplicates))
+        return prepared
+
+    prepared = await asyncio.to_thread(split_records)
+    texts = [chunk["text"] for chunks, _ in prepared for chunk in chunks]
+    start = time.perf_counter()
+    try:
+        batches = await asyncio.gather(*(
+            get_embeddings(texts[i:i + BULK_EMBEDDING_BATCH_SIZE])
+            for i in range(0, len(texts), BULK_EMBEDDING_BATCH_SIZE)
+        ))
+    except Exception as e:
+        print(f"Error embedding a batch of {len(records)} text records: {e}")
+        return [{"success": False, "error": f"Embedding failed: {e}"} for _ in records]
+    vectors = iter([vector for batch in batches for vector in batch])
+    embed_seconds = time.perf_counter() - start
+
+    def store() -> List[Dict]:
+        results = []
+        for record, (chunks, duplicates) in zip(records, prepared):
+            document_id = record["document_id"]
+            if not chunks:
+                results.append({"success": True, "document_id": document_id, "chunks": 0, "dimensions": None, "message": "Document was empty, skipping embedding."})
+                continue
+            embeddings = [next(vectors) for _ in chunks]
+            for i, chunk in enumerate(chunks):
+                chunk["embedding_index"] = i
+            document_data = {"document_id": document_id, "chunks": chunks, "metadata": record.get("metadata") or {}}
+            try:
+                duplicate_count = attach_duplicates(document_id, document_data, duplicates)
+                dimension = write_document_embeddings(document_id, document_data, embeddings, corpus_store.name)
+            except Exception as e:
+                print(f"Error storing embeddings for {document_id}: {e}")
+                results.append({"success": False, "error": f"Storing embeddings failed: {e}"})
+                continue
+            results.append({
+                "success": True,
+                "document_id": document_id,
+                "chunks": len(document_data["chunks"]),
+                "duplicates": duplicate_count,
+                "dimensions": dimension
+            })
+        return results
+
+    results = await asyncio.to_thread(store)
+    if any(result["success"] and result["chunks"] for result in results):
+        # Wait for the batch to be published, so reported records are searchable
+        await asyncio.wrap_future(corpus_store.schedule_refresh())
+    logger.info(
+        f"Stored {len(records)} text records: {len(texts)} chunks embedded in {len(batches)} requests "
+        f"({embed_seconds:.2f}s)"
+    )
+    return results
@@ -0,0 +1,251 @@
+"""On-demand sampling profiler producing flamegraph collapsed stacks.
+
+A sampler thread reads the stacks of all threads (``sys._current_frames``)
+every ``PROFILER_INTERVAL_MS`` and counts each distinct stack. The result is
+in the collapsed-stack format read by ``flamegraph.pl``, speedscope and
+inferno: one line per stack, frames from the thread down to the leaf separated
+by ``;``, then the number of samples.
+
+A profile either covers a fixed number of seconds, or the next requests to a
+route: then ``RequestProfilerMiddleware`` turns sampling on while at least one
+matching request is running. Other work running at the same time (other
+requests, background refreshes) shows up in the samples as well, since
+coroutines cannot be told apart from a stack sample.
+
+Nothing runs between profiles: the middleware only checks whether a capture is
+armed, so the cost when idle is one attribute lookup per request.
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Time between two stack samples
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL_MS", "10")) / 1000
+# Longest profile that can be requested, in seconds
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "300"))
+# Leaf frames of threads waiting for work; such samples are dropped unless idle stacks are requested
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+}
+
+# Pool threads are named like io_3 or asyncio_0; their stacks are merged by pool
+_THREAD_NUMBER = re.compile(r"[-_]\d+$")
+
+
+class ProfilerBusy(Exception):
+    """A profile is already being taken in this worker."""
+
+
+class StackSampler:
+    """Samples the stacks of every thread into collapsed-stack counts."""
+
+    def __init__(self, interval: float = PROFILER_INTERVAL, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        # Samples are only taken while this is set
+        self.enabled = threading.Event()
+        self._labels: Dict[object, str] = {}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.enabled.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.is_set():
+            if not self.enabled.wait(timeout=1.0) or self._stopped.is_set():
+                continue
+            started = time.perf_counter()
+            self._sample(own_id)
+            self._stopped.wait(max(0.0, self.interval - (time.perf_counter() - started)))
+
+    def _sample(self, own_id: int) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            code = frame.f_code
+            if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            thread_name = _THREAD_NUMBER.sub("", names.get(thread_id, str(thread_id)))
+            frames.append(thread_name)
+            self.stacks[";".join(reversed(frames))] += 1
+        self.samples += 1
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def collapsed(self) -> str:
+        """The samples in collapsed-stack format, most frequent stacks first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _short_path(filename: str) -> str:
+    """A source path relative to the import path entry it was loaded from."""
+    for entry in _path_prefixes():
+        if filename.startswith(entry):
+            return filename[len(entry):]
+    return filename
+
+
+@lru_cache(maxsize=1)
+def _path_prefixes() -> List[str]:
+    """Import path entries, longest first."""
+    entries = {os.path.join(os.path.abspath(entry), "") for entry in sys.path if entry}
+    return sorted(entries, key=len, reverse=True)
+
+
+class RequestCapture:
+    """Profiles the next ``count`` requests whose path starts with ``route``."""
+
+    def __init__(self, route: str, count: int, method: Optional[str], sampler: StackSampler):
+        self.route = route.rstrip("/") or "/"
+        self.method = method.upper() if method else None
+        self.remaining = count
+        self.active = 0
+        self.completed = 0
+        self.sampler = sampler
+        self.done = asyncio.Event()
+
+    def matches(self, method: str, path: str) -> bool:
+        if self.method is not None and method != self.method:
+            return False
+        return path == self.route or path.startswith(self.route + "/") or self.route == "/"
+
+    def begin(self) -> None:
+        self.remaining -= 1
+        self.active += 1
+        self.sampler.enabled.set()
+
+    def end(self) -> None:
+        self.active -= 1
+        self.completed += 1
+        if not self.active:
+            self.sampler.enabled.clear()
+        if not self.active and not self.remaining:
+            self.done.set()
+
+
+class Profiler:
+    """Runs one profile at a time in this worker."""
+
+    def __init__(self):
+        self.capture: Optional[RequestCapture] = None
+        self._busy = False
+
+    def _claim(self) -> None:
+        if self._busy:
+            raise ProfilerBusy("A profile is already running in this worker")
+        self._busy = True
+
+    async def profile_for(self, seconds: float, include_idle: bool = False, interval: float = PROFILER_INTERVAL) -> StackSampler:
+        """Sample every thread for ``seconds``."""
+        self._claim()
+        sampler = StackSampler(interval, include_idle)
+        sampler.enabled.set()
+        sampler.start()
+        try:
+            await asyncio.sleep(min(seconds, PROFILER_MAX_SECONDS))
+        finally:
+            await asyncio.to_thread(sampler.stop)
+            self._busy = False
+        logger.info(f"Profiled for {seconds:g}s: {sampler.samples} samples, {len(sampler.stacks)} distinct stacks")
+        return sampler
+
+    async def profile_requests(
+        self,
+        route: str,
+        count: int,
+        method: Optional[str] = None,
+        timeout: float = PROFILER_MAX_SECONDS,
+        include_idle: bool = False,
+        interval: float = PROFILER_INTERVAL
+    ) -> RequestCapture:
+        """Sample while the next ``count`` matching requests run, or until ``timeout``.
+
+        Returns the capture; ``completed`` tells how many requests finished.
+        """
+        self._claim()
+        sampler = StackSampler(interval, include_idle)
+        capture = RequestCapture(route, count, method, sampler)
+        sampler.start()
+        self.capture = capture
+        try:
+            await asyncio.wait_for(capture.done.wait(), min(timeout, PROFILER_MAX_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.capture = None
+            await asyncio.to_thread(sampler.stop)
+            self._busy = False
+        logger.info(
+            f"Profiled {capture.completed} requests to {capture.route}: "
+            f"{sampler.samples} samples, {len(sampler.stacks)} distinct stacks"
+        )
+        return capture
+
+
+class RequestProfilerMiddleware:
+    """ASGI middleware that samples stacks while requests picked by a capture run."""
+
+    def __init__(self, app, profiler: Optional["Profiler"] = None):
+        self.app = app
+        self.profiler = profiler or get_profiler()
+
+    async def __call__(self, scope, receive, send):
+        capture = self.profiler.capture
+        if (
+            capture is None
+            or scope["type"] != "http"
+            or capture.remaining <= 0
+            or not capture.matches(scope["method"], scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+        capture.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            capture.end()
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Profiler:
+    """The profiler of this worker."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
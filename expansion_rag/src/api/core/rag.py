@@ -1,41 +1,62 @@
 """RAG (Retrieval Augmented Generation) using OpenAI and FAISS."""
 import os
-from typing import Dict, List, Optional, Any
-from openai import AsyncOpenAI
-from dotenv import load_dotenv
-import threading
-from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Any, Tuple
 import asyncio
-from .embeddings import search_embeddings, search_all_documents
+import logging
+from .embeddings import get_embeddings, search_all_documents, search_vectors
+from .singleflight import coalesce, normalize_query
+from .corpus import filter_key, normalize_filters
+from .config import get_openai_client
+from .context import pack_context
 
-# Load environment variables
-load_dotenv()
-
-# Get OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
-
-# Initialize Async OpenAI client
-client = AsyncOpenAI(api_key=api_key)
+logger = logging.getLogger(__name__)
 
 # Default model for completions
 COMPLETION_MODEL = "gpt-4.1-mini-2025-04-14"
 # Model for query expansion (can use a smaller/faster model)
 EXPANSION_MODEL = "gpt-4.1-mini-2025-04-14"
+# Completions (and query expansions) in flight per batch request
+QA_BATCH_CONCURRENCY = int(os.getenv("QA_BATCH_CONCURRENCY", "8"))
+# Queries and expansions sent in one embedding request by batch question answering
+QA_BATCH_EMBEDDING_SIZE = int(os.getenv("QA_BATCH_EMBEDDING_SIZE", "512"))
+# Instructions for answer generation
+SYSTEM_PROMPT = """You are an expert assistant specialized in sustainability reporting, regulations, and technical standards.
 
-def format_context(chunks: List[Dict]) -> str:
-    """Format retrieved chunks into a context string."""
-    if not chunks:
-        return ""
-    
-    formatted_chunks = []
-    for i, chunk in enumerate(chunks):
-        metadata = chunk.get('metadata', 'Unknown source')
-        source = metadata.get('filename', 'Unknown source')
-        formatted_chunks.append(f"[Chunk {i+1} - Source: {source}]\n{chunk['text']}\n")
-    
-    return "\n".join(formatted_chunks)
+    CRITICAL INSTRUCTIONS:
+    1. ONLY use information directly from the provided context documents
+    2. Do NOT use prior knowledge that isn't in the provided documents
+    3. If the documents don't contain sufficient information, clearly state this limitation
+    4. ALWAYS cite sources by their exact designation and date in parentheses after relevant statements
+    5. NEVER make up citations or references
+    6. If you're asked about something not covered in the documents, say "I don't have specific information about that in my documents"
+    7. When presented with tables (marked by TABLE: and END TABLE):
+    - Display them in a clean, readable format using markdown tables
+    - Use proper column alignment
+    - Preserve column headers
+    - Do not use the original pipe delimiter formatting
+
+    IMPORTANT ABOUT DOCUMENTS:
+    - The source documents shown after your response MUST match what you actually used to answer
+    - If the documents don't contain information on the specific topic, acknowledge this limitation
+    - NEVER pretend to know something if it's not in the documents
+    - Prioritize official EU regulation documents over guidance documents
+    - For regulation questions, cite specific article numbers when available
+    - Pay special attention to any tables, as they often contain critical technical information
+
+    FORMATTING AND CONTENT:
+    - Structure your responses with clear headings and bullet points when appropriate
+    - Use plain language to explain complex concepts
+    - Provide comprehensive answers that address all aspects of the question
+    - Include specific dates, numbers, and metrics from the documents when relevant
+    - When appropriate, organize information chronologically or by relevance
+    - For table data, ALWAYS present it in a clean markdown table format
+    - Convert raw table content with pipe separators into proper markdown tables
+
+    CITATION FORMAT:
+    - Citation format: (Document-Designation-Date) - e.g., (CSRD-2022/2464-2022-12-14)
+    - Include the citation immediately after the information it supports
+    - For general information from multiple sources, cite all relevant documents
+    - Never invent citations or reference documents not in the provided context"""
 
 async def expand_query(query: str, num_expansions: int = 4) -> List[str]:
     """Generate expanded queries to improve retrieval."""
@@ -54,7 +75,7 @@ async def expand_query(query: str, num_expansions: int = 4) -> List[str]:
             {"role": "user", "content": f"Original query: '{query}'\n\nGenerate {num_expansions} alternative queries."}
         ]
         
-        response = await client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model=EXPANSION_MODEL,
             messages=messages,
             temperature=0.7
@@ -106,100 +127,214 @@ async def generate_answer(
     top_k: int = 3,
     model: str = COMPLETION_MODEL,
     temperature: float = 0.0,
-    meta_information: Optional[str] = None
+    meta_information: Optional[str] = None,
+    filters: Optional[Dict[str, Any]] = None,
+    route_documents: Optional[int] = None,
+    retrieved: Optional[Dict[str, Any]] = None,
+    query_embedding: Optional[List[float]] = None,
+    collection: Optional[str] = None
 ) -> Dict[str, Any]:
-    """Generate an answer using RAG."""
-    try:
-        # First, expand the query to improve retrieval
-        expanded_queries = await expand_query(query)
-        
-        # Include original query in the search
-        search_queries = [query] + expanded_queries
-        
-        # Search for relevant chunks concurrently
-        search_tasks = [search_all_documents(eq, top_k) for eq in search_queries]
-        list_of_chunk_lists = await asyncio.gather(*search_tasks)
-        
-        # Flatten the list of lists
-        all_chunks = [chunk for sublist in list_of_chunk_lists for chunk in sublist]
-
-        # Remove duplicates (use the existing deduplicate_chunks function)
-        # Sort by score before deduplicating to keep the best score for duplicates
-        all_chunks.sort(key=lambda x: x.get("score", float('inf')))
-        unique_chunks_dict = {}
-        for chunk in all_chunks:
-            # Deduplicate based on text content to avoid near-identical chunks from different queries
-            text_key = chunk.get("text", "")
-            if text_key not in unique_chunks_dict:
-                 unique_chunks_dict[text_key] = chunk
-        unique_chunks = list(unique_chunks_dict.values()) 
-        
-        # Select top_k unique chunks after deduplication
-        # Sorting again by score might be redundant if already sorted, but ensures order
-        unique_chunks.sort(key=lambda x: x.get("score", float('inf'))) 
-        top_unique_chunks = unique_chunks[:top_k]
-
-        # Format context from the top unique chunks
-        context = format_context(top_unique_chunks)
-        print(context)
-        
-        # Build the prompt
-        system_prompt = """You are an expert assistant specialized in sustainability reporting, regulations, and technical standards.
+    """Generate an answer using RAG over a collection (the default one if None).
 
-    CRITICAL INSTRUCTIONS:
-    1. ONLY use information directly from the provided context documents
-    2. Do NOT use prior knowledge that isn't in the provided documents
-    3. If the documents don't contain sufficient information, clearly state this limitation
-    4. ALWAYS cite sources by their exact designation and date in parentheses after relevant statements
-    5. NEVER make up citations or references
-    6. If you're asked about something not covered in the documents, say "I don't have specific information about that in my documents"
-    7. When presented with tables (marked by TABLE: and END TABLE):
-    - Display them in a clean, readable format using markdown tables
-    - Use proper column alignment
-    - Preserve column headers
-    - Do not use the original pipe delimiter formatting
+    Identical concurrent requests (same normalized query and parameters) are
+    coalesced into a single run whose result is shared by all callers.
+    ``retrieved`` (``chunks`` and ``expanded_queries`` of an earlier answer)
+    skips query expansion and retrieval; ``query_embedding`` is reused for the
+    search instead of embedding ``query`` again.
+    """
+    key = (
+        "generate_answer",
+        normalize_query(query),
+        conversation_history,
+        top_k,
+        model,
+        temperature,
+        meta_information,
+        filter_key(normalize_filters(filters)),
+        route_documents,
+        collection,
+        tuple(chunk.get("chunk_id") for chunk in retrieved["chunks"]) if retrieved else None,
+    )
+    result = await coalesce(key, lambda: _generate_answer(
+        query, conversation_history, top_k, model, temperature, meta_information, filters, route_documents,
+        retrieved, query_embedding, collection
+    ))
+    return dict(result)
 
-    IMPORTANT ABOUT DOCUMENTS:
-    - The source documents shown after your response MUST match what you actually used to answer
-    - If the documents don't contain information on the specific topic, acknowledge this limitation
-    - NEVER pretend to know something if it's not in the documents
-    - Prioritize official EU regulation documents over guidance documents
-    - For regulation questions, cite specific article numbers when available
-    - Pay special attention to any tables, as they often contain critical technical information
+async def retrieve_chunks(
+    query: str,
+    top_k: int = 3,
+    filters: Optional[Dict[str, Any]] = None,
+    route_documents: Optional[int] = None,
+    query_embedding: Optional[List[float]] = None,
+    collection: Optional[str] = None
+) -> Tuple[List[Dict], List[str]]:
+    """Expand the query, search all documents of a collection and return the top unique chunks and the expansions."""
+    # First, expand the query to improve retrieval
+    expanded_queries = await expand_query(query)
 
-    FORMATTING AND CONTENT:
-    - Structure your responses with clear headings and bullet points when appropriate
-    - Use plain language to explain complex concepts
-    - Provide comprehensive answers that address all aspects of the question
-    - Include specific dates, numbers, and metrics from the documents when relevant
-    - When appropriate, organize information chronologically or by relevance
-    - For table data, ALWAYS present it in a clean markdown table format
-    - Convert raw table content with pipe separators into proper markdown tables
+    # Search for relevant chunks concurrently, including the original query
+    search_tasks = [search_all_documents(query, top_k, filters, route_documents, query_embedding, collection)]
+    search_tasks += [
+        search_all_documents(eq, top_k, filters, route_documents, collection=collection) for eq in expanded_queries
+    ]
+    list_of_chunk_lists = await asyncio.gather(*search_tasks)
+    return merge_chunks(list_of_chunk_lists, top_k), expanded_queries
 
-    CITATION FORMAT:
-    - Citation format: (Document-Designation-Date) - e.g., (CSRD-2022/2464-2022-12-14)
-    - Include the citation immediately after the information it supports
-    - For general information from multiple sources, cite all relevant documents
-    - Never invent citations or reference documents not in the provided context"""
+def merge_chunks(chunk_lists: List[List[Dict]], top_k: int) -> List[Dict]:
+    """Merge the results of a query and its expansions into the top unique chunks."""
+    # Flatten the list of lists
+    all_chunks = [chunk for sublist in chunk_lists for chunk in sublist]
 
-        # Add meta information if available
-        if meta_information and meta_information.strip():
-            system_prompt += f"\n\nAdditional context from the user:\n{meta_information}"
-        
-        # Add conversation history if available
-        if conversation_history:
-            system_prompt += f"\n\nPrevious conversation:\n{conversation_history}\n\nPlease consider the previous conversation when answering the current question."
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"Context:\n{context}"},
-            {"role": "user", "content": query}
-        ]
+    # Sort by score before deduplicating to keep the best score for duplicates
+    all_chunks.sort(key=lambda x: x.get("score", float('inf')))
+    unique_chunks_dict = {}
+    for chunk in all_chunks:
+        # Deduplicate based on text content to avoid near-identical chunks from different queries
+        text_key = chunk.get("text", "")
+        if text_key not in unique_chunks_dict:
+            unique_chunks_dict[text_key] = chunk
+    unique_chunks = list(unique_chunks_dict.values())
+
+    # Select top_k unique chunks after deduplication
+    return unique_chunks[:top_k]
+
+async def retrieve_batch(
+    queries: List[str],
+    top_k: int = 3,
+    filters: Optional[Dict[str, Any]] = None,
+    route_documents: Optional[int] = None,
+    concurrency: int = QA_BATCH_CONCURRENCY,
+    collection: Optional[str] = None
+) -> List[Tuple[List[Dict], List[str]]]:
+    """Retrieve the top unique chunks and the expansions of many queries at once.
+
+    Queries are expanded ``concurrency`` at a time. The queries and all their
+    expansions are then embedded in requests of up to ``QA_BATCH_EMBEDDING_SIZE``
+    texts and searched together as one matrix of query vectors.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def expand(query: str) -> List[str]:
+        async with slots:
+            return await expand_query(query)
+
+    expansions = await asyncio.gather(*(expand(query) for query in queries))
+    texts = [text for query, expanded in zip(queries, expansions) for text in [query, *expanded]]
+    batches = await asyncio.gather(*(
+        get_embeddings(texts[i:i + QA_BATCH_EMBEDDING_SIZE]) for i in range(0, len(texts), QA_BATCH_EMBEDDING_SIZE)
+    ))
+    results = await search_vectors(
+        [vector for batch in batches for vector in batch], top_k, filters, route_documents, collection
+    )
+
+    retrieved = []
+    start = 0
+    for expanded in expansions:
+        end = start + 1 + len(expanded)
+        retrieved.append((merge_chunks(results[start:end], top_k), expanded))
+        start = end
+    return retrieved
+
+async def answer_batch(
+    queries: List[str],
+    top_k: int = 3,
+    model: str = COMPLETION_MODEL,
+    temperature: float = 0.0,
+    filters: Optional[Dict[str, Any]] = None,
+    route_documents: Optional[int] = None,
+    concurrency: int = QA_BATCH_CONCURRENCY,
+    collection: Optional[str] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Answer many questions, yielding (index, result) as each answer completes.
+
+    Retrieval runs once for the whole batch (see ``retrieve_batch``), then at
+    most ``concurrency`` completions are in flight. Completions still running
+    are cancelled if the consumer stops early.
+    """
+    retrieved = await retrieve_batch(queries, top_k, filters, route_documents, concurrency, collection)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer(index: int) -> Tuple[int, Dict[str, Any]]:
+        chunks, expanded_queries = retrieved[index]
+        async with slots:
+            return index, await generate_answer(
+                queries[index],
+                top_k=top_k,
+                model=model,
+                temperature=temperature,
+                filters=filters,
+                route_documents=route_documents,
+                retrieved={"chunks": chunks, "expanded_queries": expanded_queries},
+                collection=collection
+            )
+
+    tasks = [asyncio.create_task(answer(index)) for index in range(len(queries))]
+    try:
+        for next_answer in asyncio.as_completed(tasks):
+            yield await next_answer
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def summarize_conversation(summary: str, messages: List[Dict[str, str]], max_tokens: int = 400) -> str:
+    """Fold older conversation turns into a running summary."""
+    transcript = "\n".join(
+        f"{'Assistant' if message['role'] == 'assistant' else 'User'}: {message['content']}" for message in messages
+    )
+    prompt = f"Summary so far:\n{summary}\n\nNew turns:\n{transcript}" if summary else transcript
+    response = await get_openai_client().chat.completions.create(
+        model=EXPANSION_MODEL,
+        messages=[
+            {"role": "system", "content": (
+                "You maintain a running summary of a conversation between a user and an assistant about "
+                "sustainability reporting documents. Update the summary with the new turns. Keep the questions "
+                "asked, the facts, figures and citations given in the answers, and any open points. "
+                "Return ONLY the updated summary, in the language of the conversation."
+            )},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.0,
+        max_tokens=max_tokens
+    )
+    return response.choices[0].message.content.strip()
+
+async def _generate_answer(
+    query: str,
+    conversation_history: Optional[str],
+    top_k: int,
+    model: str,
+    temperature: float,
+    meta_information: Optional[str],
+    filters: Optional[Dict[str, Any]] = None,
+    route_documents: Optional[int] = None,
+    retrieved: Optional[Dict[str, Any]] = None,
+    query_embedding: Optional[List[float]] = None,
+    collection: Optional[str] = None
+) -> Dict[str, Any]:
+    """Run query expansion, retrieval and generation for a single request."""
+    try:
+        if retrieved:
+            # Follow-up answered from the chunks retrieved for an earlier turn
+            top_unique_chunks = retrieved["chunks"]
+            expanded_queries = retrieved.get("expanded_queries", [])
+        else:
+            top_unique_chunks, expanded_queries = await retrieve_chunks(
+                query, top_k, filters, route_documents, query_embedding, collection
+            )
+
+        # Pack the prompt into the model's token budget, dropping or trimming
+        # the lowest-ranked chunks that do not fit
+        packed = pack_context(
+            SYSTEM_PROMPT, query, top_unique_chunks, model, conversation_history, meta_information
+        )
+        top_unique_chunks = packed["chunks"]
+        logger.debug("Prompt tokens: %s", packed["tokens"])
         
         # Generate response
-        response = await client.chat.completions.create(
+        response = await get_openai_client().chat.completions.create(
             model=model,
-            messages=messages,
+            messages=packed["messages"],
             temperature=temperature
         )
         
@@ -208,6 +343,7 @@ async def generate_answer(
             "chunks": top_unique_chunks,
             "expanded_queries": expanded_queries,
             "sources": [chunk.get("metadata", {}).get("filename", "Unknown source") for chunk in top_unique_chunks],
+            "context_tokens": packed["tokens"],
             "success": True
         }
         
@@ -218,6 +354,7 @@ async def generate_answer(
             "chunks": [],
             "expanded_queries": [],
             "sources": [],
+            "context_tokens": None,
             "success": False
         } 
 
@@ -0,0 +1,332 @@
+"""Server-side chat sessions with a bounded conversation history.
+
+Each session keeps its last ``SESSION_RECENT_MESSAGES`` messages verbatim and
+folds older ones into a running summary, so the history sent with every
+question stays roughly constant in size however long the conversation gets.
+Token counts are stored per message and updated as messages are added or
+summarized, so nothing is re-tokenized on later turns.
+
+A session also remembers the last retrieval: the query vector, the chunks it
+returned and the search parameters. A follow-up whose embedding stays close to
+that query reuses those chunks instead of expanding and searching again.
+
+Sessions are JSON files under ``SESSIONS_DIR``, so every worker sees them.
+A turn holds the session's lock file (``<session_id>.lock``) from loading the
+session to saving it, so turns of one session sent to different workers are
+applied one after the other. Summarization runs without the lock and merges
+its result under it, so it never holds up a turn or overwrites one.
+"""
+import os
+import re
+import fcntl
+import json
+import math
+import time
+import uuid
+import asyncio
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set
+
+from .context import count_tokens
+from .executors import run_io
+from .rag import summarize_conversation
+
+# Directory holding one JSON file per session
+SESSIONS_DIR = Path(os.getenv("SESSIONS_DIR", "./src/api/data/sessions"))
+# Messages kept verbatim; older ones are folded into the summary
+SESSION_RECENT_MESSAGES = int(os.getenv("SESSION_RECENT_MESSAGES", "6"))
+# Upper bound for the running summary, in tokens
+SESSION_SUMMARY_TOKENS = int(os.getenv("SESSION_SUMMARY_TOKENS", "400"))
+# Follow-ups at least this similar to the last retrieval query reuse its chunks
+SESSION_REUSE_SIMILARITY = float(os.getenv("SESSION_REUSE_SIMILARITY", "0.8"))
+# Sessions idle for longer than this are deleted
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_HOURS", "24")) * 3600
+
+_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# Per-session locks, so turns of one session in this worker wait for each
+# other before taking the lock file; a lock goes away with the last turn
+# holding or waiting for it
+_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+# Background summarization tasks, kept referenced until they finish
+_compactions: Set[asyncio.Task] = set()
+
+
+def valid_session_id(session_id: str) -> bool:
+    """Whether a string has the form of a session id."""
+    return bool(_SESSION_ID.match(session_id))
+
+
+def _session_path(session_id: str) -> Optional[Path]:
+    if not valid_session_id(session_id):
+        return None
+    return SESSIONS_DIR / f"{session_id}.json"
+
+
+def _lock_file(session_id: str, blocking: bool = True) -> Optional[int]:
+    """Open and lock a session's lock file; None if ``blocking`` is False and it is held.
+
+    A session being deleted removes its lock file while holding it, so the
+    lock only counts if the file is still in place once it is acquired.
+    """
+    path = SESSIONS_DIR / f"{session_id}.lock"
+    SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+@contextmanager
+def session_file_lock(session_id: str) -> Iterator[None]:
+    """Exclusive inter-process lock of one session (blocking); raises ValueError for an invalid id."""
+    if not valid_session_id(session_id):
+        raise ValueError(f"Invalid session id: {session_id}")
+    fd = _lock_file(session_id)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def create_session() -> Dict[str, Any]:
+    """Create and store an empty session."""
+    SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+    prune_sessions()
+    now = time.time()
+    session = {
+        "session_id": uuid.uuid4().hex,
+        "created_at": now,
+        "updated_at": now,
+        "summary": "",
+        "summary_tokens": 0,
+        "summarized_messages": 0,
+        "messages": [],
+        "history_tokens": 0,
+        "retrieval": None,
+    }
+    save_session(session)
+    return session
+
+
+def load_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Load a session, or None if it does not exist."""
+    path = _session_path(session_id)
+    if path is None or not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_session(session: Dict[str, Any]) -> None:
+    """Store a session atomically."""
+    session["updated_at"] = time.time()
+    path = _session_path(session["session_id"])
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(session, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_locked(session_id: str) -> bool:
+    """Remove a session and its lock file; the caller holds the lock."""
+    (SESSIONS_DIR / f"{session_id}.lock").unlink(missing_ok=True)
+    path = _session_path(session_id)
+    if not path.exists():
+        return False
+    path.unlink()
+    return True
+
+
+def delete_session(session_id: str) -> bool:
+    """Delete a session once no turn is using it. Returns False if it did not exist."""
+    path = _session_path(session_id)
+    if path is None or not path.exists():
+        return False
+    with session_file_lock(session_id):
+        return _remove_locked(session_id)
+
+
+def prune_sessions() -> int:
+    """Delete sessions idle for longer than ``SESSION_TTL_SECONDS``, skipping those in use."""
+    cutoff = time.time() - SESSION_TTL_SECONDS
+    removed = 0
+    for path in SESSIONS_DIR.glob("*.json"):
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        fd = _lock_file(path.stem, blocking=False) if valid_session_id(path.stem) else None
+        if fd is None:
+            continue
+        try:
+            removed += _remove_locked(path.stem)
+        finally:
+            os.close(fd)
+    return removed
+
+
+def session_lock(session_id: str) -> asyncio.Lock:
+    """Lock serializing the turns of one session in this worker; raises ValueError for an invalid id."""
+    if not valid_session_id(session_id):
+        raise ValueError(f"Invalid session id: {session_id}")
+    lock = _locks.get(session_id)
+    if lock is None:
+        lock = _locks[session_id] = asyncio.Lock()
+    return lock
+
+
+@asynccontextmanager
+async def locked_session(session_id: str) -> AsyncIterator[None]:
+    """Hold a session exclusively across workers for a load-modify-save.
+
+    Turns in this worker queue on the session's ``asyncio.Lock`` first, so
+    only one of them waits for the lock file in a thread.
+    """
+    async with session_lock(session_id):
+        acquiring = asyncio.ensure_future(run_io(_lock_file, session_id))
+        try:
+            fd = await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The thread still takes the lock; release it once it has
+            acquiring.add_done_callback(lambda done: done.exception() is None and os.close(done.result()))
+            raise
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+
+def add_message(session: Dict[str, Any], role: str, content: str) -> None:
+    """Append a message and update the session's token count."""
+    tokens = count_tokens(content)
+    session["messages"].append({"role": role, "content": content, "tokens": tokens})
+    session["history_tokens"] += tokens
+
+
+def format_history(session: Dict[str, Any]) -> Optional[str]:
+    """The session's history as sent to the model: the summary, then the recent messages."""
+    parts = []
+    if session["summary"]:
+        parts.append(f"Summary of the earlier conversation:\n{session['summary']}\n")
+    for message in session["messages"]:
+        role = "Assistant" if message["role"] == "assistant" else "User"
+        parts.append(f"{role}: {message['content']}")
+    return "\n".join(parts) if parts else None
+
+
+def needs_compaction(session: Dict[str, Any]) -> bool:
+    """Whether the session holds more verbatim messages than it keeps."""
+    return len(session["messages"]) > SESSION_RECENT_MESSAGES
+
+
+async def compact_session(session_id: str) -> bool:
+    """Fold the messages beyond the recent window into the running summary.
+
+    The summary is generated from a copy of the session without holding its
+    lock; it is then merged into the session as stored at that point, under
+    the lock, so turns saved in between are kept. If another compaction got
+    there first or the summary cannot be generated, nothing changes and
+    folding is retried after the next turn. Returns True if the session was
+    compacted.
+    """
+    session = await run_io(load_session, session_id)
+    if session is None or not needs_compaction(session):
+        return False
+    cut = len(session["messages"]) - SESSION_RECENT_MESSAGES
+    older = session["messages"][:cut]
+    try:
+        summary = await summarize_conversation(session["summary"], older, SESSION_SUMMARY_TOKENS)
+    except Exception as e:
+        print(f"Error summarizing session {session_id}: {e}")
+        return False
+    summary_tokens = count_tokens(summary)
+
+    async with locked_session(session_id):
+        current = await run_io(load_session, session_id)
+        if (
+            current is None
+            or current["summarized_messages"] != session["summarized_messages"]
+            or current["messages"][:cut] != older
+        ):
+            return False
+        current["history_tokens"] += summary_tokens - current["summary_tokens"] - sum(m["tokens"] for m in older)
+        current["summary"] = summary
+        current["summary_tokens"] = summary_tokens
+        current["summarized_messages"] += cut
+        current["messages"] = current["messages"][cut:]
+        await run_io(save_session, current)
+    return True
+
+
+def schedule_compaction(session_id: str) -> None:
+    """Summarize older messages of a session in the background, after the reply is sent."""
+    task = asyncio.get_running_loop().create_task(compact_session(session_id))
+    _compactions.add(task)
+    task.add_done_callback(_compactions.discard)
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def retrieval_params(
+    top_k: int,
+    filters: Optional[Dict],
+    route_documents: Optional[int],
+    collection: Optional[str] = None
+) -> Dict[str, Any]:
+    """Search parameters a stored retrieval must match to be reused."""
+    return {"top_k": top_k, "filters": filters, "route_documents": route_documents, "collection": collection}
+
+
+def reusable_retrieval(
+    session: Dict[str, Any],
+    query_embedding: List[float],
+    params: Dict[str, Any],
+    reuse: Optional[bool] = None
+) -> Optional[Dict[str, Any]]:
+    """The session's last retrieval if it can answer this follow-up, else None.
+
+    ``reuse`` forces the decision (True reuses whenever the search parameters
+    match, False never reuses); by default the follow-up must be at least
+    ``SESSION_REUSE_SIMILARITY`` similar to the query that was searched.
+    """
+    retrieval = session.get("retrieval")
+    if reuse is False or not retrieval or not retrieval["chunks"] or retrieval["params"] != params:
+        return None
+    if reuse or _cosine(query_embedding, retrieval["vector"]) >= SESSION_REUSE_SIMILARITY:
+        return retrieval
+    return None
+
+
+def remember_retrieval(
+    session: Dict[str, Any],
+    query: str,
+    query_embedding: List[float],
+    chunks: List[Dict],
+    expanded_queries: List[str],
+    params: Dict[str, Any]
+) -> None:
+    """Store a fresh retrieval so follow-ups can reuse it."""
+    session["retrieval"] = {
+        "query": query,
+        "vector": query_embedding,
+        "chunks": chunks,
+        "expanded_queries": expanded_queries,
+        "params": params,
+    }
@@ -0,0 +1,152 @@
+"""Scatter-gather search over a corpus partitioned across shard servers.
+
+Each shard is an ordinary API server started with ``SHARD_COUNT`` and its own
+``SHARD_INDEX``. It indexes only the documents whose id hashes to that index
+(see ``corpus.shard_of``) and answers ``POST /shard/search``. The shards read
+the same ``EMBEDDINGS_DIR``, such as a shared volume, and pick up new or deleted
+documents every ``SHARD_SYNC_SECONDS``, or right away on ``POST /shard/refresh``.
+
+A server with ``SHARD_URLS`` set acts as coordinator: it sends each batch of
+query vectors to every shard at once and merges their top-k lists. Shards that
+have not answered within ``SHARD_DEADLINE_MS`` are skipped, so a slow or missing
+shard costs some recall instead of stalling the query.
+
+Query vectors travel as base64-encoded little-endian float32 arrays.
+"""
+import os
+import time
+import heapq
+import base64
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from .config import lazy_import
+from .corpus import get_store, list_collections
+
+httpx = lazy_import("httpx")
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+# Base URLs of the shard servers; set on the coordinator only
+SHARD_URLS = [url.strip().rstrip("/") for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
+# Time to wait for shards before merging whatever has arrived
+SHARD_DEADLINE = float(os.getenv("SHARD_DEADLINE_MS", "500")) / 1000
+# How often a shard server syncs its corpus with the embeddings directory
+SHARD_SYNC_SECONDS = float(os.getenv("SHARD_SYNC_SECONDS", "5"))
+
+# Coordinator counters, exported by /metrics
+shard_stats = {"searches": 0, "partial": 0, "timeouts": 0, "errors": 0}
+
+
+def encode_vectors(vectors: "np.ndarray") -> str:
+    """Query vectors as base64 of little-endian float32."""
+    return base64.b64encode(np.ascontiguousarray(vectors, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_vectors(data: str, dimension: int) -> "np.ndarray":
+    """Inverse of ``encode_vectors``."""
+    return np.frombuffer(base64.b64decode(data), dtype="<f4").reshape(-1, dimension).astype(np.float32)
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> "httpx.AsyncClient":
+    """Shared HTTP client keeping connections to the shards open."""
+    return httpx.AsyncClient(
+        timeout=SHARD_DEADLINE,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+
+
+async def _search_shard(url: str, payload: Dict[str, Any]) -> List[List[Dict]]:
+    response = await get_http_client().post(f"{url}/shard/search", json=payload)
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+async def scatter_search(
+    query_vectors: "np.ndarray",
+    top_k: int,
+    filters: Optional[Dict] = None,
+    route_documents: int = 0,
+    deadline: float = SHARD_DEADLINE,
+    collection: Optional[str] = None
+) -> List[List[Dict]]:
+    """Search a collection on every shard for a batch of query vectors and merge the top-k per query.
+
+    Shards that fail or miss the deadline are left out of the merge. With
+    ``route_documents`` set, every shard routes to that many of its own
+    documents.
+    """
+    payload = {
+        "vectors": encode_vectors(query_vectors),
+        "dimension": int(query_vectors.shape[1]),
+        "top_k": top_k,
+        "filters": filters,
+        "route_documents": route_documents,
+        "collection": collection,
+    }
+    start = time.perf_counter()
+    tasks = {asyncio.create_task(_search_shard(url, payload)): url for url in SHARD_URLS}
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    shard_stats["searches"] += 1
+    answered: List[List[List[Dict]]] = []
+    missing = []
+    for task, url in tasks.items():
+        if task in pending:
+            shard_stats["timeouts"] += 1
+            missing.append(f"{url} (deadline)")
+        elif task.exception() is not None:
+            shard_stats["errors"] += 1
+            missing.append(f"{url} ({task.exception()!r})")
+        else:
+            answered.append(task.result())
+    if missing:
+        shard_stats["partial"] += 1
+        logger.warning(
+            f"Merged {len(answered)}/{len(tasks)} shards after {(time.perf_counter() - start) * 1000:.0f} ms; "
+            f"missing: {', '.join(missing)}"
+        )
+
+    # Every document lives on exactly one shard, so the lists hold no duplicates
+    return [
+        heapq.nsmallest(top_k, (chunk for shard in answered for chunk in shard[q]), key=lambda chunk: chunk["score"])
+        for q in range(len(query_vectors))
+    ]
+
+
+async def run_shard_sync() -> None:
+    """Periodically sync this shard's corpus of every collection with the embeddings directories."""
+    while True:
+        await asyncio.sleep(SHARD_SYNC_SECONDS)
+        for collection in await asyncio.to_thread(list_collections):
+            get_store(collection).schedule_refresh()
+
+
+async def close_http_client() -> None:
+    """Close the shard connections if any were opened."""
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+        get_http_client.cache_clear()
+
+
+def render_metrics() -> str:
+    """Coordinator counters in Prometheus text format."""
+    lines = []
+    for name, help_text in [
+        ("searches", "Scatter-gather searches sent to the shards."),
+        ("partial", "Searches merged without every shard."),
+        ("timeouts", "Shard requests that missed the deadline."),
+        ("errors", "Shard requests that failed."),
+    ]:
+        lines += [
+            f"# HELP shard_{name}_total {help_text}",
+            f"# TYPE shard_{name}_total counter",
+            f"shard_{name}_total {shard_stats[name]}",
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,42 @@
+"""Single-flight coalescing of identical in-flight async calls."""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# In-flight tasks keyed by (event loop, call key)
+_in_flight: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Task] = {}
+
+
+def _release(entry_key: Tuple[asyncio.AbstractEventLoop, Hashable], task: asyncio.Task) -> None:
+    """Forget a finished task and mark its exception as retrieved."""
+    if _in_flight.get(entry_key) is task:
+        del _in_flight[entry_key]
+    if not task.cancelled():
+        task.exception()
+
+
+async def coalesce(key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """Run ``factory()`` once for all concurrent callers sharing the same key.
+
+    The first caller starts the work as a task; later callers with the same key
+    await that task instead of starting their own. The task is shielded, so a
+    cancelled caller (e.g. a disconnected client) does not cancel the work for
+    the others.
+    """
+    loop = asyncio.get_running_loop()
+    entry_key = (loop, key)
+    task = _in_flight.get(entry_key)
+    if task is None:
+        task = loop.create_task(factory())
+        _in_flight[entry_key] = task
+        task.add_done_callback(lambda t: _release(entry_key, t))
+    return await asyncio.shield(task)
+
+
+def in_flight_count() -> int:
+    """Number of distinct calls currently in flight."""
+    return len(_in_flight)
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for use in a coalescing key."""
+    return " ".join(query.lower().split())
@@ -0,0 +1,343 @@
+"""Portable single-file snapshots of the corpus for fast replica cold starts.
+
+A snapshot bundles everything a replica needs to serve without re-ingesting,
+for every collection:
+
+- ``<collection>/segment/*``: the collection's corpus merged into one segment
+  (vectors, chunk texts and ids, attributes, routing centroids)
+- ``<collection>/embeddings/*``: the per-document ``.json``/``.index`` pairs
+  the corpus is built from, with their modification times
+- ``catalog.sqlite3``: the document catalog of all collections, chunk
+  signatures included
+
+Format 1 snapshots, which held the default collection only as ``segment/*``
+and ``embeddings/*``, can still be imported.
+
+File layout::
+
+    header   magic, format, TOC offset, TOC length, SHA-256 of the TOC (padded to 4 KiB)
+    members  the files, each starting on a 4 KiB boundary
+    TOC      JSON: snapshot info and name, offset, length, SHA-256 of each member
+
+Members are page-aligned, so a reader can memory-map the snapshot and use
+members in place (``SnapshotReader.view``). Importing checks the checksums,
+unpacks the members and publishes the segments as the live corpus; nothing is
+parsed, chunked or embedded again. Restoring is still linear in the snapshot
+size: every member is hashed (unless verification is off) and copied out,
+because a live corpus must outlive the snapshot file and segments are only
+served from the collection's own directory. Members are copied with
+``copy_file_range``, which file systems with reflinks serve by sharing the
+aligned blocks instead of copying them.
+
+With ``CORPUS_SNAPSHOT`` set, the app imports that snapshot at startup when the
+corpus has never been built, so replicas can be baked or shipped with a
+snapshot instead of their embeddings directory.
+"""
+import os
+import json
+import errno
+import mmap
+import time
+import fcntl
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .corpus import CORPUS_DIR, DEFAULT_COLLECTION, get_store, list_collections, validate_collection
+from .catalog import backup_catalog, restore_catalog
+
+logger = logging.getLogger(__name__)
+
+# Snapshot imported at startup if the corpus has not been built yet
+CORPUS_SNAPSHOT = os.getenv("CORPUS_SNAPSHOT")
+# Whether member checksums are verified on import
+SNAPSHOT_VERIFY = os.getenv("SNAPSHOT_VERIFY", "1").lower() in ("1", "true", "yes")
+
+MAGIC = b"RAGSNAP\x00"
+FORMAT_VERSION = 2
+# Formats this version can import
+_READABLE_FORMATS = (1, 2)
+# Magic, format version, TOC offset, TOC length, TOC SHA-256
+_HEADER = struct.Struct("<8sIQQ32s")
+# Members start on page boundaries so they can be memory-mapped in place
+ALIGNMENT = 4096
+_COPY_BLOCK = 1 << 20
+
+
+class SnapshotError(Exception):
+    """A snapshot file is malformed or fails its checksums."""
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(path: Path, members: List[Tuple[str, Path]], info: Dict[str, Any]) -> Dict[str, Any]:
+    """Write files into a snapshot at ``path``; returns its table of contents."""
+    toc: Dict[str, Any] = {**info, "format": FORMAT_VERSION, "members": []}
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as out:
+        offset = ALIGNMENT
+        for name, source in members:
+            out.seek(offset)
+            digest = hashlib.sha256()
+            length = 0
+            with open(source, "rb") as f:
+                for block in iter(lambda: f.read(_COPY_BLOCK), b""):
+                    digest.update(block)
+                    out.write(block)
+                    length += len(block)
+            toc["members"].append({
+                "name": name,
+                "offset": offset,
+                "length": length,
+                "sha256": digest.hexdigest(),
+                "mtime_ns": source.stat().st_mtime_ns,
+            })
+            offset = _align(offset + length)
+        toc_bytes = json.dumps(toc).encode("utf-8")
+        out.seek(offset)
+        out.write(toc_bytes)
+        out.seek(0)
+        out.write(_HEADER.pack(MAGIC, FORMAT_VERSION, offset, len(toc_bytes), hashlib.sha256(toc_bytes).digest()))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+    return toc
+
+
+class SnapshotReader:
+    """Memory-mapped, read-only view of a snapshot file."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.toc = self._read_toc()
+        except Exception:
+            self._map.close()
+            raise
+        self.members = {member["name"]: member for member in self.toc["members"]}
+
+    def _read_toc(self) -> Dict[str, Any]:
+        if len(self._map) < _HEADER.size:
+            raise SnapshotError(f"{self.path} is too short to be a snapshot")
+        magic, version, offset, length, checksum = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise SnapshotError(f"{self.path} is not a corpus snapshot")
+        if version not in _READABLE_FORMATS:
+            raise SnapshotError(f"Unsupported snapshot format {version}")
+        toc_bytes = self._map[offset:offset + length]
+        if len(toc_bytes) != length or hashlib.sha256(toc_bytes).digest() != checksum:
+            raise SnapshotError(f"{self.path} has a corrupt table of contents")
+        return json.loads(toc_bytes)
+
+    def view(self, name: str) -> memoryview:
+        """A member's bytes, mapped in place."""
+        member = self.members[name]
+        return memoryview(self._map)[member["offset"]:member["offset"] + member["length"]]
+
+    def verify(self) -> None:
+        """Check every member against its checksum."""
+        for name, member in self.members.items():
+            view = self.view(name)
+            digest = hashlib.sha256()
+            for start in range(0, len(view), _COPY_BLOCK):
+                digest.update(view[start:start + _COPY_BLOCK])
+            view.release()
+            if digest.hexdigest() != member["sha256"]:
+                raise SnapshotError(f"Checksum mismatch for {name} in {self.path}")
+
+    def extract(self, name: str, target: Path) -> None:
+        """Write a member to ``target`` atomically, restoring its modification time."""
+        tmp_path = target.with_name(f".{target.name}.tmp")
+        member = self.members[name]
+        with open(tmp_path, "wb") as f:
+            if not self._copy_range(member["offset"], member["length"], f.fileno()):
+                f.seek(0)
+                f.truncate()
+                view = self.view(name)
+                for start in range(0, len(view), _COPY_BLOCK):
+                    f.write(view[start:start + _COPY_BLOCK])
+                view.release()
+        mtime = member["mtime_ns"]
+        os.utime(tmp_path, ns=(mtime, mtime))
+        os.replace(tmp_path, target)
+
+    def _copy_range(self, offset: int, length: int, fd: int) -> bool:
+        """Copy bytes of the snapshot into ``fd`` in the kernel; False if the file systems do not support it."""
+        if not hasattr(os, "copy_file_range"):
+            return False
+        with open(self.path, "rb") as source:
+            copied = 0
+            while copied < length:
+                try:
+                    count = os.copy_file_range(source.fileno(), fd, length - copied, offset + copied, copied)
+                except OSError as e:
+                    if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        return False
+                    raise
+                if count == 0:
+                    raise SnapshotError(f"{self.path} is truncated")
+                copied += count
+        return True
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __enter__(self) -> "SnapshotReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def export_snapshot(path: Path) -> Dict[str, Any]:
+    """Write the corpus of every collection, its source embeddings and the catalog to a snapshot file.
+
+    Returns the snapshot info (documents, chunks, dimension, collections, size).
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=path.parent, prefix=".snapshot-") as tmp:
+        members: List[Tuple[str, Path]] = []
+        collections: Dict[str, Dict[str, int]] = {}
+        dimension = None
+        for collection in list_collections():
+            store = get_store(collection)
+            segment = store.export_segment(Path(tmp) / collection / "segment")
+            if segment is None:
+                continue
+            with open(segment / "manifest.json", "r") as f:
+                manifest = json.load(f)
+            if dimension is not None and manifest["dimension"] != dimension:
+                raise SnapshotError(
+                    f"Collection {collection} has dimension {manifest['dimension']}, not {dimension}"
+                )
+            dimension = manifest["dimension"]
+            collections[collection] = {"documents": len(manifest["documents"]), "chunks": manifest["chunks"]}
+
+            members.extend((f"{collection}/segment/{file.name}", file) for file in sorted(segment.iterdir()))
+            for document in manifest["documents"]:
+                for suffix in (".json", ".index"):
+                    source = store.embeddings_dir / f"{document['document_id']}{suffix}"
+                    if source.exists():
+                        members.append((f"{collection}/embeddings/{source.name}", source))
+                    else:
+                        logger.warning(f"{source} disappeared during export; the replica will drop its document")
+        if not collections:
+            raise SnapshotError("The corpus is empty; nothing to export")
+        catalog = Path(tmp) / "catalog.sqlite3"
+        backup_catalog(catalog)
+        members.append(("catalog.sqlite3", catalog))
+
+        toc = write_snapshot(path, members, {
+            "created_at": time.time(),
+            "documents": sum(counts["documents"] for counts in collections.values()),
+            "chunks": sum(counts["chunks"] for counts in collections.values()),
+            "dimension": dimension,
+            "collections": collections,
+        })
+    info = {key: value for key, value in toc.items() if key != "members"}
+    info["size"] = path.stat().st_size
+    logger.info(
+        f"Exported {info['documents']} documents ({info['chunks']} chunks) of {len(collections)} "
+        f"collections to {path} ({info['size'] / 1e6:.1f} MB) in {time.perf_counter() - start:.2f}s"
+    )
+    return info
+
+
+def _member_path(name: str) -> Tuple[Optional[str], str, str]:
+    """Collection, folder and file name of a member; no collection for the catalog."""
+    parts = name.split("/")
+    if len(parts) == 2:
+        # Format 1: members of the default collection without a prefix
+        parts.insert(0, DEFAULT_COLLECTION)
+    if len(parts) != 3 or parts[1] not in ("segment", "embeddings"):
+        return None, "", name
+    try:
+        collection = validate_collection(parts[0])
+    except ValueError as e:
+        raise SnapshotError(f"Invalid member {name}: {e}") from None
+    if parts[2] in ("", ".", ".."):
+        raise SnapshotError(f"Invalid member {name}")
+    return collection, parts[1], parts[2]
+
+
+@contextmanager
+def _import_lock() -> Iterator[None]:
+    """Inter-process lock so that only one worker imports a snapshot."""
+    CORPUS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CORPUS_DIR / "snapshot.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def import_snapshot(path: Path, verify: bool = SNAPSHOT_VERIFY, only_if_empty: bool = False) -> Optional[Dict[str, Any]]:
+    """Install a snapshot as the live corpus of its collections, with their source embeddings and the catalog.
+
+    Documents with the same id are overwritten; other documents already in a
+    collection's embeddings directory are kept and sealed on top. The corpus
+    of collections the snapshot does not hold is left as it is. With
+    ``only_if_empty``, nothing happens if the corpus of any collection was
+    already built. Returns the snapshot info, or None if it was skipped. Run
+    it before serving or with the service stopped: the whole catalog is
+    replaced in place.
+    """
+    start = time.perf_counter()
+    with _import_lock():
+        if only_if_empty and any(get_store(name).read_version() is not None for name in list_collections()):
+            return None
+        with SnapshotReader(path) as reader:
+            if verify:
+                reader.verify()
+            with tempfile.TemporaryDirectory(dir=CORPUS_DIR, prefix=".snapshot-") as tmp:
+                catalog = Path(tmp) / "catalog.sqlite3"
+                segments: Dict[str, Path] = {}
+                for name in reader.members:
+                    collection, folder, file_name = _member_path(name)
+                    if collection is None:
+                        if name == "catalog.sqlite3":
+                            reader.extract(name, catalog)
+                        continue
+                    store = get_store(collection)
+                    if folder == "segment":
+                        if collection not in segments:
+                            # Next to the collection's segments, so that installing is a rename
+                            store.corpus_dir.mkdir(parents=True, exist_ok=True)
+                            segments[collection] = Path(tempfile.mkdtemp(dir=store.corpus_dir, prefix=".snapshot-"))
+                        reader.extract(name, segments[collection] / file_name)
+                    else:
+                        store.embeddings_dir.mkdir(parents=True, exist_ok=True)
+                        reader.extract(name, store.embeddings_dir / file_name)
+                if catalog.exists():
+                    restore_catalog(catalog)
+                generations = {}
+                for collection, segment in segments.items():
+                    try:
+                        generations[collection] = get_store(collection).install_segment(segment)
+                    finally:
+                        shutil.rmtree(segment, ignore_errors=True)
+            info = {key: value for key, value in reader.toc.items() if key != "members"}
+    logger.info(
+        f"Imported snapshot {path}: {info['documents']} documents, {info['chunks']} chunks "
+        f"in {time.perf_counter() - start:.2f}s (generations {generations})"
+    )
+    return info
+
+
+def load_startup_snapshot() -> Optional[Dict[str, Any]]:
+    """Import ``CORPUS_SNAPSHOT`` if it is set and no corpus was built yet."""
+    if not CORPUS_SNAPSHOT:
+        return None
+    return import_snapshot(Path(CORPUS_SNAPSHOT), only_if_empty=True)
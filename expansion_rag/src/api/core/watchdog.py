@@ -0,0 +1,150 @@
+"""Opt-in event-loop watchdog: measures loop lag and reports blocking code.
+
+A probe task sleeps for ``LOOP_WATCHDOG_INTERVAL_MS`` and records how late it
+wakes up; that delay is the time other callbacks kept the loop busy. A monitor
+thread watches the probe's heartbeat, and when the loop has not come back for
+longer than ``LOOP_LAG_THRESHOLD_MS`` it logs the loop thread's current stack,
+which points at the coroutine doing blocking work, once per stall.
+
+Enable it with ``LOOP_WATCHDOG=1``; lag statistics are served in Prometheus
+text format by ``GET /metrics``.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Whether the app starts the watchdog
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "0").lower() in ("1", "true", "yes")
+# Loop stalls longer than this are logged with a stack trace
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000
+# How often the probe measures the loop
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", "50")) / 1000
+# Histogram bucket bounds for loop lag, in seconds
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LoopWatchdog:
+    """Measures lag on one event loop and logs the stacks of blocking calls."""
+
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.lag_sum = 0.0
+        self.samples = 0
+        self.stalls = 0
+        self.buckets: List[int] = [0] * len(LAG_BUCKETS)
+        self._heartbeat = time.perf_counter()
+        self._reported = False
+        self._loop_thread_id: Optional[int] = None
+        self._probe: Optional[asyncio.Task] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Start probing the running loop and monitoring it from a thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        self._probe = asyncio.get_running_loop().create_task(self._run_probe())
+        self._monitor = threading.Thread(target=self._run_monitor, name="loop-watchdog", daemon=True)
+        self._monitor.start()
+        logger.info(f"Event-loop watchdog started (threshold {self.threshold * 1000:.0f} ms)")
+
+    async def stop(self) -> None:
+        """Stop the probe and the monitor thread."""
+        self._stopped.set()
+        if self._probe is not None:
+            self._probe.cancel()
+            try:
+                await self._probe
+            except asyncio.CancelledError:
+                pass
+        if self._monitor is not None:
+            self._monitor.join(timeout=1)
+
+    async def _run_probe(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._record(max(0.0, now - start - self.interval))
+            self._heartbeat = now
+            self._reported = False
+
+    def _record(self, lag: float) -> None:
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.lag_sum += lag
+        self.samples += 1
+        for i, bound in enumerate(LAG_BUCKETS):
+            if lag <= bound:
+                self.buckets[i] += 1
+        if lag > self.threshold:
+            self.stalls += 1
+
+    def _run_monitor(self) -> None:
+        while not self._stopped.wait(self.interval):
+            blocked_for = time.perf_counter() - self._heartbeat - self.interval
+            if blocked_for <= self.threshold or self._reported:
+                continue
+            self._reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(stack unavailable)\n"
+            logger.warning(f"Event loop blocked for {blocked_for * 1000:.0f} ms; loop thread stack:\n{stack}")
+
+    def render_metrics(self) -> str:
+        """Lag statistics in Prometheus text format."""
+        lines = [
+            "# HELP event_loop_lag_seconds Delay of event-loop wakeups behind schedule.",
+            "# TYPE event_loop_lag_seconds histogram",
+        ]
+        for bound, count in zip(LAG_BUCKETS, self.buckets):
+            lines.append(f'event_loop_lag_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [
+            f'event_loop_lag_seconds_bucket{{le="+Inf"}} {self.samples}',
+            f"event_loop_lag_seconds_sum {self.lag_sum:.6f}",
+            f"event_loop_lag_seconds_count {self.samples}",
+            "# HELP event_loop_lag_last_seconds Most recent event-loop lag sample.",
+            "# TYPE event_loop_lag_last_seconds gauge",
+            f"event_loop_lag_last_seconds {self.last_lag:.6f}",
+            "# HELP event_loop_lag_max_seconds Largest event-loop lag seen.",
+            "# TYPE event_loop_lag_max_seconds gauge",
+            f"event_loop_lag_max_seconds {self.max_lag:.6f}",
+            "# HELP event_loop_stalls_total Lag samples above the blocking threshold.",
+            "# TYPE event_loop_stalls_total counter",
+            f"event_loop_stalls_total {self.stalls}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+# Watchdog of this worker, if enabled
+_watchdog: Optional[LoopWatchdog] = None
+
+
+def start_watchdog() -> LoopWatchdog:
+    """Start the watchdog on the running loop."""
+    global _watchdog
+    _watchdog = LoopWatchdog()
+    _watchdog.start()
+    return _watchdog
+
+
+async def stop_watchdog() -> None:
+    """Stop the watchdog if it is running."""
+    global _watchdog
+    if _watchdog is not None:
+        await _watchdog.stop()
+        _watchdog = None
+
+
+def get_watchdog() -> Optional[LoopWatchdog]:
+    """The running watchdog, or None when it is disabled."""
+    return _watchdog
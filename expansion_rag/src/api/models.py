@@ -3,6 +3,8 @@ from typing import Dict, List, Optional, Any
 from pydantic import BaseModel, Field
 from datetime import datetime
 
+from .core.corpus import COLLECTION_NAME
+
 
 class DocumentResponse(BaseModel):
     """Response for document processing."""
@@ -13,17 +15,51 @@ class DocumentResponse(BaseModel):
     message: Optional[str] = None
 
 
+class DocumentDeleteResponse(BaseModel):
+    """Response for document deletion."""
+    document_id: str
+    success: bool = True
+    message: Optional[str] = None
+
+
 class TextDocumentRequest(BaseModel):
     """Request for processing a text document."""
     content: str = Field(..., description="The text content of the document")
     filename: Optional[str] = Field(None, description="Optional filename")
     metadata: Optional[Dict[str, Any]] = Field(None, description="Optional metadata")
+    collection: Optional[str] = Field(None, pattern=COLLECTION_NAME.pattern, description="Collection to add the document to (the default collection if omitted)")
+
+
+class BulkTextRecordStatus(BaseModel):
+    """Outcome of one record of a bulk text upload."""
+    line: int = Field(..., description="Line number of the record in the request body (1-based)")
+    document_id: Optional[str] = Field(None, description="ID of the stored document")
+    filename: Optional[str] = Field(None, description="Filename of the stored document")
+    success: bool
+    chunks: int = Field(0, description="Chunks stored for the document")
+    duplicates: int = Field(0, description="Chunks that reuse the vector of a near-identical chunk")
+    error: Optional[str] = Field(None, description="Why the record was not indexed")
+
+
+class BulkTextResponse(BaseModel):
+    """Per-record results of a bulk text upload."""
+    records: List[BulkTextRecordStatus]
+    indexed: int = Field(..., description="Records stored and searchable")
+    failed: int = Field(..., description="Records that were invalid or could not be indexed")
+    batches: int = Field(..., description="Batches the records were embedded and published in")
 
 
 # Define a model for a single file entry
 class FileEntry(BaseModel):
     id: str = Field(..., description="Unique document ID")
     name: str = Field(..., description="Original file name")
+    file_type: Optional[str] = Field(None, description="File extension, e.g. '.pdf'")
+    size: Optional[int] = Field(None, description="Size of the original file in bytes")
+    sha256: Optional[str] = Field(None, description="SHA-256 of the original file")
+    pages: Optional[int] = Field(None, description="Pages with extracted text")
+    chunks: Optional[int] = Field(None, description="Embedded chunks")
+    ingested_at: Optional[datetime] = Field(None, description="When the embeddings were written")
+    collection: str = Field("default", description="Collection the document belongs to")
 
 
 class FileListResponse(BaseModel):
@@ -31,6 +67,59 @@ class FileListResponse(BaseModel):
     # Update the files field to use the new FileEntry model
     files: List[FileEntry] = Field(..., description="List of file entries with id and name")
     total_files: int = Field(..., description="Total number of files")
+    offset: int = Field(0, description="Index of the first returned file")
+    limit: Optional[int] = Field(None, description="Maximum number of files returned")
+
+
+class CollectionInfo(BaseModel):
+    """A collection of documents and its index in this worker."""
+    name: str
+    documents: int = Field(0, description="Documents in the collection")
+    chunks: int = Field(0, description="Chunks stored for its documents")
+    generation: Optional[str] = Field(None, description="Live corpus generation, if the index was built")
+    loaded: bool = Field(False, description="Whether this worker has the index mapped")
+    resident_bytes: int = Field(0, description="Bytes of index files this worker maps for the collection")
+
+
+class CollectionListResponse(BaseModel):
+    """All collections and the memory ceiling their mapped indexes share."""
+    collections: List[CollectionInfo]
+    memory_limit_bytes: Optional[int] = Field(None, description="Mapped index bytes above which least recently used collections are unmapped")
+
+
+class MemoryComponent(BaseModel):
+    """Memory held by one registered component of a worker."""
+    name: str = Field(..., description="Component, e.g. collection:default or pdf_extraction")
+    kind: str = Field(..., description="index, cache or ingestion")
+    bytes: int = Field(..., description="Total bytes accounted to the component")
+    parts: Dict[str, int] = Field(default_factory=dict, description="Bytes by part, e.g. vectors, chunk_text, caches")
+    evictable: bool = Field(..., description="Whether the memory budget can evict it")
+    idle_seconds: Optional[float] = Field(None, description="Seconds since it was last used, if tracked")
+
+
+class MemoryReport(BaseModel):
+    """Memory use of a worker by component, and its budget."""
+    resident_bytes: Optional[int] = Field(None, description="Resident set size of the worker process")
+    proportional_bytes: Optional[int] = Field(None, description="Proportional set size: shared pages split between the processes mapping them")
+    unreclaimable_bytes: Optional[int] = Field(None, description="Proportional memory other than clean pages of mapped files")
+    budget_bytes: Optional[int] = Field(None, description="Memory budget of the worker; None if memory is only reported")
+    policy: str = Field(..., description="Eviction order: lru or largest")
+    container_limit_bytes: Optional[int] = Field(None, description="Memory limit of the container")
+    container_usage_bytes: Optional[int] = Field(None, description="Memory charged to the container, page cache included")
+    accounted_bytes: int = Field(..., description="Sum of the components")
+    python_allocated_blocks: int = Field(..., description="Memory blocks allocated by the Python interpreter")
+    evictions: int = Field(0, description="Components evicted to stay under budget")
+    evicted_bytes: int = Field(0, description="Bytes released by evictions")
+    components: List[MemoryComponent]
+
+
+class DuplicateStatsResponse(BaseModel):
+    """Near-duplicate chunks found at ingestion and the index rows they saved."""
+    chunks: int = Field(..., description="Chunks stored across all documents")
+    duplicates: int = Field(..., description="Chunks that reuse the vector of a near-identical chunk")
+    cross_document_duplicates: int = Field(..., description="Duplicates whose canonical chunk is in another document")
+    index_rows: int = Field(..., description="Vectors in the index")
+    index_reduction: float = Field(..., description="Fraction of chunks that take no index row")
 
 
 class Message(BaseModel):
@@ -48,6 +137,15 @@ class ChunkResponse(BaseModel):
     metadata: Dict[str, Any] = Field(default_factory=dict, description="Chunk metadata, may include 'filename', 'file_type', 'page_number', etc.")
 
 
+class SearchFilters(BaseModel):
+    """Metadata filters applied inside the vector search."""
+    document_ids: Optional[List[str]] = Field(None, description="Only search these documents")
+    filenames: Optional[List[str]] = Field(None, description="Only search documents whose filename contains one of these substrings (case-insensitive), e.g. 'ESRS'")
+    file_types: Optional[List[str]] = Field(None, description="Only search these file types, e.g. '.pdf'")
+    page_from: Optional[int] = Field(None, ge=1, description="First page to search (inclusive)")
+    page_to: Optional[int] = Field(None, ge=1, description="Last page to search (inclusive)")
+
+
 class ChatRequest(BaseModel):
     """A chat request with optional conversation history."""
     message: str
@@ -56,6 +154,11 @@ class ChatRequest(BaseModel):
     model: Optional[str] = "gpt-4.1-mini-2025-04-14"
     temperature: Optional[float] = 0.0
     meta_information: Optional[str] = None
+    filters: Optional[SearchFilters] = None
+    route_documents: Optional[int] = Field(None, ge=0, description="Search only the N documents whose centroids best match the query (0 searches all; defaults to ROUTING_TOP_DOCUMENTS)")
+    collection: Optional[str] = Field(None, pattern=COLLECTION_NAME.pattern, description="Collection to search (the default collection if omitted)")
+    session_id: Optional[str] = Field(None, description="Server-side session to continue; its stored history replaces 'history'")
+    reuse_retrieval: Optional[bool] = Field(None, description="Reuse the session's last retrieved chunks (true), search again (false), or decide by query similarity (default)")
 
 
 class ChatResponse(BaseModel):
@@ -64,6 +167,19 @@ class ChatResponse(BaseModel):
     chunks: List[ChunkResponse]
     expanded_queries: List[str]
     success: bool
+    session_id: Optional[str] = None
+    reused_retrieval: bool = False
+    history_tokens: Optional[int] = Field(None, description="Tokens in the session history sent with this turn")
+    context_tokens: Optional[Dict[str, int]] = Field(None, description="Prompt tokens used by each part, the total and the model's budget")
+
+
+class ChatSessionResponse(BaseModel):
+    """State of a server-side chat session."""
+    session_id: str
+    summary: str = Field("", description="Summary of the messages no longer kept verbatim")
+    messages: List[Message] = Field(default_factory=list, description="Recent messages kept verbatim")
+    summarized_messages: int = Field(0, description="Number of messages folded into the summary")
+    history_tokens: int = Field(0, description="Tokens in the summary and recent messages")
 
 
 class QARequest(BaseModel):
@@ -72,6 +188,9 @@ class QARequest(BaseModel):
     top_k: Optional[int] = Field(3, description="Number of chunks to retrieve")
     model: Optional[str] = Field("gpt-4.1-mini-2025-04-14", description="OpenAI model to use for generation")
     temperature: Optional[float] = Field(0.0, description="Sampling temperature")
+    filters: Optional[SearchFilters] = Field(None, description="Restrict retrieval to matching documents and pages")
+    route_documents: Optional[int] = Field(None, ge=0, description="Search only the N documents whose centroids best match the query (0 searches all; defaults to ROUTING_TOP_DOCUMENTS)")
+    collection: Optional[str] = Field(None, pattern=COLLECTION_NAME.pattern, description="Collection to search (the default collection if omitted)")
 
 
 class QAResponse(BaseModel):
@@ -79,4 +198,38 @@ class QAResponse(BaseModel):
     answer: str
     chunks: List[ChunkResponse]
     expanded_queries: Optional[List[str]] = Field(default_factory=list, description="Expanded queries used for retrieval")
-    success: bool 
\ No newline at end of file
+    success: bool
+    context_tokens: Optional[Dict[str, int]] = Field(None, description="Prompt tokens used by each part, the total and the model's budget")
+
+
+class BatchQARequest(BaseModel):
+    """Request for answering many questions with shared retrieval settings."""
+    queries: List[str] = Field(..., min_length=1, max_length=1000, description="The questions to answer")
+    top_k: Optional[int] = Field(3, description="Number of chunks to retrieve per question")
+    model: Optional[str] = Field("gpt-4.1-mini-2025-04-14", description="OpenAI model to use for generation")
+    temperature: Optional[float] = Field(0.0, description="Sampling temperature")
+    filters: Optional[SearchFilters] = Field(None, description="Restrict retrieval to matching documents and pages")
+    route_documents: Optional[int] = Field(None, ge=0, description="Search only the N documents whose centroids best match each query (0 searches all; defaults to ROUTING_TOP_DOCUMENTS)")
+    collection: Optional[str] = Field(None, pattern=COLLECTION_NAME.pattern, description="Collection to search (the default collection if omitted)")
+
+
+class BatchQAResult(QAResponse):
+    """One answer of a batch, streamed as a line of NDJSON."""
+    index: int = Field(..., description="Position of the question in the request")
+    query: str = Field(..., description="The question answered")
+
+
+class ShardSearchRequest(BaseModel):
+    """Batch of query vectors sent by the coordinator to a shard."""
+    vectors: str = Field(..., description="Query vectors as base64 of little-endian float32")
+    dimension: int = Field(..., ge=1, description="Vector dimension")
+    top_k: int = Field(3, ge=1, description="Number of chunks to return per query")
+    filters: Optional[SearchFilters] = Field(None, description="Restrict the search to matching documents and pages")
+    route_documents: int = Field(0, ge=0, description="Search only the N best-matching documents of this shard (0 searches all)")
+    collection: Optional[str] = Field(None, pattern=COLLECTION_NAME.pattern, description="Collection to search (the default collection if omitted)")
+
+
+class ShardSearchResponse(BaseModel):
+    """Top-k chunks of one shard for each query vector."""
+    shard: int
+    results: List[List[ChunkResponse]]
@@ -1,8 +1,12 @@
 """Chat routes for RAG system."""
 from typing import List, Optional
 from fastapi import APIRouter, HTTPException
-from ..models import Message, ChatRequest, ChatResponse
+from ..models import Message, ChatRequest, ChatResponse, ChatSessionResponse
 from ..core.rag import generate_answer
+from ..core.embeddings import get_embedding
+from ..core.executors import run_io
+from ..core import sessions
+from .collections import require_collection
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
@@ -18,6 +22,9 @@ def format_conversation_history(messages: List[Message]) -> str:
 @router.post("/process", response_model=ChatResponse)
 async def process_chat(request: ChatRequest):
     """Process a chat message with conversation history."""
+    collection = await run_io(require_collection, request.collection)
+    if request.session_id:
+        return await process_session_chat(request, collection)
     try:
         # Format conversation history if available
         conversation_history = None
@@ -33,7 +40,10 @@ async def process_chat(request: ChatRequest):
             top_k=request.top_k,
             model=request.model,
             temperature=request.temperature,
-            meta_information=request.meta_information
+            meta_information=request.meta_information,
+            filters=request.filters.model_dump() if request.filters else None,
+            route_documents=request.route_documents,
+            collection=collection
         )
         
         # Create the assistant message
@@ -47,9 +57,99 @@ async def process_chat(request: ChatRequest):
             message=assistant_message,
             chunks=response["chunks"],  # Use the full chunk objects
             expanded_queries=response["expanded_queries"],
-            success=response["success"]
+            success=response["success"],
+            context_tokens=response.get("context_tokens")
         )
         
     except Exception as e:
         print(f"Error in process_chat: {e}")  # Add this to see the actual error
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def process_session_chat(request: ChatRequest, collection: str) -> ChatResponse:
+    """Answer a message in a server-side session and record the turn."""
+    if not sessions.valid_session_id(request.session_id):
+        raise HTTPException(status_code=404, detail=f"Session {request.session_id} not found")
+    # Held from loading the session to saving the turn, across workers
+    async with sessions.locked_session(request.session_id):
+        session = await run_io(sessions.load_session, request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Session {request.session_id} not found")
+        try:
+            filters = request.filters.model_dump() if request.filters else None
+            params = sessions.retrieval_params(request.top_k, filters, request.route_documents, collection)
+            # Embed the message once: it decides whether the last retrieval can be
+            # reused, and is used for the search if it cannot
+            query_embedding = await get_embedding(request.message)
+            retrieved = sessions.reusable_retrieval(session, query_embedding, params, request.reuse_retrieval)
+            history_tokens = session["history_tokens"]
+
+            response = await generate_answer(
+                query=request.message,
+                conversation_history=sessions.format_history(session),
+                top_k=request.top_k,
+                model=request.model,
+                temperature=request.temperature,
+                meta_information=request.meta_information,
+                filters=filters,
+                route_documents=request.route_documents,
+                retrieved=retrieved,
+                query_embedding=query_embedding,
+                collection=collection
+            )
+
+            if response["success"]:
+                sessions.add_message(session, "user", request.message)
+                sessions.add_message(session, "assistant", response["answer"])
+                if retrieved is None:
+                    sessions.remember_retrieval(
+                        session, request.message, query_embedding,
+                        response["chunks"], response["expanded_queries"], params
+                    )
+                await run_io(sessions.save_session, session)
+        except Exception as e:
+            print(f"Error in process_session_chat: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    if sessions.needs_compaction(session):
+        sessions.schedule_compaction(session["session_id"])
+
+    return ChatResponse(
+        message=Message(role="assistant", content=response["answer"]),
+        chunks=response["chunks"],
+        expanded_queries=response["expanded_queries"],
+        success=response["success"],
+        session_id=session["session_id"],
+        reused_retrieval=retrieved is not None,
+        history_tokens=history_tokens,
+        context_tokens=response.get("context_tokens")
+    )
+
+def session_response(session: dict) -> ChatSessionResponse:
+    """API view of a stored session."""
+    return ChatSessionResponse(
+        session_id=session["session_id"],
+        summary=session["summary"],
+        messages=[Message(role=m["role"], content=m["content"]) for m in session["messages"]],
+        summarized_messages=session["summarized_messages"],
+        history_tokens=session["history_tokens"]
+    )
+
+@router.post("/sessions", response_model=ChatSessionResponse)
+async def create_chat_session():
+    """Start a server-side chat session."""
+    return session_response(await run_io(sessions.create_session))
+
+@router.get("/sessions/{session_id}", response_model=ChatSessionResponse)
+async def get_chat_session(session_id: str):
+    """Get the summary and recent messages of a chat session."""
+    session = await run_io(sessions.load_session, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return session_response(session)
+
+@router.delete("/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    """Delete a chat session."""
+    if not await run_io(sessions.delete_session, session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"session_id": session_id, "success": True}
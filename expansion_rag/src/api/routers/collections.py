@@ -0,0 +1,54 @@
+"""Collection routes: the named document sets and their indexes in this worker."""
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException
+
+from ..models import CollectionInfo, CollectionListResponse
+from ..core.corpus import COLLECTIONS_MEMORY_MB, DEFAULT_COLLECTION, collection_exists, get_store, list_collections
+from ..core.executors import run_io
+from ..core import catalog
+
+router = APIRouter(prefix="/collections", tags=["collections"])
+
+
+def require_collection(name: Optional[str]) -> str:
+    """Name of an existing collection (the default one for None), or a 404."""
+    if not collection_exists(name):
+        raise HTTPException(status_code=404, detail=f"Collection {name} not found")
+    return name or DEFAULT_COLLECTION
+
+
+def collection_infos(names: List[str]) -> List[CollectionInfo]:
+    """Catalog counts of collections and the state of their indexes in this worker (blocking)."""
+    sizes = catalog.collection_sizes()
+    infos = []
+    for name in names:
+        documents, chunks = sizes.get(name, (0, 0))
+        store = get_store(name)
+        infos.append(CollectionInfo(
+            name=name,
+            documents=documents,
+            chunks=chunks,
+            generation=store.read_version(),
+            loaded=store.resident_bytes > 0,
+            resident_bytes=store.resident_bytes
+        ))
+    return infos
+
+
+@router.get("", response_model=CollectionListResponse)
+async def get_collections():
+    """List the collections with their document counts and whether their index is mapped."""
+    return CollectionListResponse(
+        collections=await run_io(lambda: collection_infos(list_collections())),
+        memory_limit_bytes=COLLECTIONS_MEMORY_MB * 1024 * 1024 if COLLECTIONS_MEMORY_MB > 0 else None
+    )
+
+
+@router.get("/{name}", response_model=CollectionInfo)
+async def get_collection(name: str):
+    """Get one collection's document counts and index state."""
+    try:
+        name = await run_io(require_collection, name)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return (await run_io(collection_infos, [name]))[0]
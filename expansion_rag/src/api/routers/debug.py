@@ -0,0 +1,81 @@
+"""Admin-only diagnostics of this worker; disabled unless ``ADMIN_TOKEN`` is set."""
+import os
+import hmac
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from ..models import MemoryReport
+from ..core.memory import get_budget
+from ..core.executors import run_io
+from ..core.profiler import PROFILER_INTERVAL, PROFILER_MAX_SECONDS, ProfilerBusy, StackSampler, get_profiler
+
+# Token expected in the X-Admin-Token header of admin routes
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Reject requests without the admin token; the routes do not exist without one."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/debug", tags=["debug"], dependencies=[Depends(require_admin)])
+
+
+def collapsed_response(sampler: StackSampler, **headers: str) -> PlainTextResponse:
+    """Collapsed stacks with the sample counts in headers."""
+    return PlainTextResponse(sampler.collapsed(), headers={
+        "X-Profile-Samples": str(sampler.samples),
+        "X-Profile-Interval-Ms": f"{sampler.interval * 1000:g}",
+        **headers
+    })
+
+
+@router.post("/profile", response_class=PlainTextResponse)
+async def profile(
+    seconds: float = Query(10.0, gt=0, le=PROFILER_MAX_SECONDS, description="How long to sample"),
+    interval_ms: float = Query(PROFILER_INTERVAL * 1000, ge=1, le=1000, description="Time between samples"),
+    idle: bool = Query(False, description="Keep samples of threads waiting for work")
+):
+    """Sample the stacks of all threads of this worker for a while.
+
+    Returns flamegraph collapsed stacks (``flamegraph.pl``, speedscope).
+    """
+    try:
+        sampler = await get_profiler().profile_for(seconds, idle, interval_ms / 1000)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return collapsed_response(sampler)
+
+
+@router.post("/profile/requests", response_class=PlainTextResponse)
+async def profile_requests(
+    route: str = Query(..., description="Path prefix of the requests to profile, e.g. /qa"),
+    count: int = Query(10, ge=1, le=10000, description="Number of requests to profile"),
+    method: Optional[str] = Query(None, description="Only requests with this method"),
+    timeout: float = Query(60.0, gt=0, le=PROFILER_MAX_SECONDS, description="Longest wait for the requests"),
+    interval_ms: float = Query(PROFILER_INTERVAL * 1000, ge=1, le=1000, description="Time between samples"),
+    idle: bool = Query(False, description="Keep samples of threads waiting for work")
+):
+    """Sample the stacks of all threads while the next requests to a route run.
+
+    Returns once ``count`` requests finished or after ``timeout``, with the
+    number of profiled requests in ``X-Profile-Requests``.
+    """
+    try:
+        capture = await get_profiler().profile_requests(route, count, method, timeout, idle, interval_ms / 1000)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return collapsed_response(capture.sampler, **{"X-Profile-Requests": str(capture.completed)})
+
+
+@router.get("/memory", response_model=MemoryReport)
+async def memory(enforce: bool = Query(False, description="Check the memory budget now, evicting if over it")):
+    """Memory held by each registered component of this worker: indexes, caches, PDF extraction."""
+    budget = get_budget()
+    if enforce:
+        await run_io(budget.enforce)
+    return MemoryReport(**await run_io(budget.report))
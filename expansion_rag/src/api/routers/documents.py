@@ -1,119 +1,145 @@
 """Document handling routes."""
 import os
 import json
-from typing import List
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+import asyncio
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Query, Request
 from fastapi.responses import JSONResponse, FileResponse
 from pathlib import Path
 import mimetypes
 
-from ..models import DocumentResponse, TextDocumentRequest, FileListResponse, FileEntry
-from ..core.document_processor import process_text_document, save_uploaded_file, get_document_content
-from ..core.embeddings import create_document_embeddings, verify_document_embeddings, process_missing_embeddings
+from ..models import (
+    DocumentResponse, DocumentDeleteResponse, TextDocumentRequest, FileListResponse, FileEntry, DuplicateStatsResponse,
+    BulkTextRecordStatus, BulkTextResponse
+)
+from ..core.document_processor import (
+    process_text_document, store_uploaded_file, stream_document_content, get_document_content, delete_document_files,
+    install_staged_file, document_files, valid_document_id
+)
+from ..core.embeddings import (
+    create_document_embeddings, verify_document_embeddings, process_missing_embeddings, delete_document_embeddings,
+    document_store, promote_duplicates, retire_document_embeddings
+)
+from ..core.corpus import COLLECTION_NAME, get_store
+from ..core.pipeline import ingest_document_stream, ingest_text_batch, BULK_BATCH_RECORDS
+from ..core.executors import run_io
+from ..core import catalog
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 # Get the documents directory from environment or default
 DOCUMENTS_DIR = Path(os.getenv("DOCUMENTS_DIR", "./data/documents"))
 
 
+def file_entry(entry: Dict) -> FileEntry:
+    """API view of a catalog entry."""
+    return FileEntry(
+        id=entry["document_id"],
+        name=entry["filename"],
+        file_type=entry["file_type"],
+        size=entry["size"],
+        sha256=entry["sha256"],
+        pages=entry["pages"],
+        chunks=entry["chunks"],
+        ingested_at=datetime.fromtimestamp(entry["ingested_at"], tz=timezone.utc) if entry["ingested_at"] else None,
+        collection=entry["collection"]
+    )
+
+
 @router.get("/files", response_model=FileListResponse)
-async def get_all_files():
-    """Get list of all files in the embeddings directory."""
+async def get_all_files(
+    offset: int = Query(0, ge=0, description="Number of files to skip"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Maximum number of files to return (all by default)"),
+    sort: Literal["filename", "file_type", "size", "pages", "chunks", "ingested_at"] = Query("filename", description="Field to sort by"),
+    order: Literal["asc", "desc"] = Query("asc", description="Sort order"),
+    collection: Optional[str] = Query(None, pattern=COLLECTION_NAME.pattern, description="Only list the files of this collection")
+):
+    """Get a page of the ingested files from the document catalog."""
     try:
-        embeddings_dir = Path(os.getenv("EMBEDDINGS_DIR", "./data/embeddings"))
-        if not embeddings_dir.exists():
-            return FileListResponse(files=[], total_files=0)
-        
-        # Change to list of FileEntry
-        file_entries: List[FileEntry] = []
-        seen_files = set()  # Track unique files by document_id
-        
-        for metadata_file in embeddings_dir.glob("*.json"):
-            try:
-                with open(metadata_file, "r") as f:
-                    metadata = json.load(f)
-                    document_id = metadata.get("document_id")
-                    
-                    if not document_id or document_id in seen_files:
-                        continue
-                    
-                    seen_files.add(document_id)
-                    
-                    filename = (metadata.get("metadata", {}).get("filename") or 
-                              f"{document_id}{metadata.get('metadata', {}).get('file_type', '')}")
-                    
-                    # Append FileEntry object
-                    file_entries.append(FileEntry(id=document_id, name=filename))
-            except Exception as e:
-                # Log error but continue if possible
-                print(f"Error processing metadata file {metadata_file}: {e}") 
-        
+        entries, total = await run_io(catalog.list_documents, offset, limit, sort, order == "desc", collection)
         return FileListResponse(
-            files=file_entries, # Return list of FileEntry objects
-            total_files=len(file_entries)
+            files=[file_entry(entry) for entry in entries],
+            total_files=total,
+            offset=offset,
+            limit=limit
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting file list: {str(e)}")
 
 
+@router.get("/duplicates", response_model=DuplicateStatsResponse)
+async def get_duplicate_stats():
+    """Report how many chunks reuse a near-identical chunk's vector, and how much smaller the index is."""
+    return DuplicateStatsResponse(**await run_io(catalog.duplicate_stats))
+
+
 @router.get("/embedding-status")
 async def get_embedding_status():
     """Get the status of document embeddings."""
-    return verify_document_embeddings()
+    return await verify_document_embeddings()
 
 
 @router.post("/process-missing-embeddings")
 async def process_missing():
     """Process embeddings for any documents that are missing them."""
-    return process_missing_embeddings()
+    return await process_missing_embeddings()
 
 
-@router.post("/upload", response_model=DocumentResponse)
-async def upload_document(file: UploadFile = File(...)):
-    """Upload a document file and process it."""
+async def ingest_upload(file: UploadFile, document_id: Optional[str] = None, collection: Optional[str] = None) -> DocumentResponse:
+    """Save an uploaded file and create its embeddings in a collection.
+
+    Pages are chunked and embedded while the rest of the file is still being
+    extracted (see ``core.pipeline``).
+    """
     try:
         # Log upload attempt
         print(f"Processing upload for file: {file.filename}")
         
-        document_info = save_uploaded_file(file.file, file.filename)
+        # Copying the upload and reading text files block, so do it off the event loop
+        document_info = await run_io(store_uploaded_file, file.file, file.filename, document_id=document_id)
+        content = await run_io(stream_document_content, Path(document_info["path"]))
         
-        # Process embeddings
-        processed_content = document_info.get("processed_content") 
+        if content is None:
+            print(f"Skipping embedding of unsupported file type: {document_info['metadata']['file_type']}")
+            # Only originals that can be ingested are kept
+            await run_io(lambda: Path(document_info["path"]).unlink(missing_ok=True))
+            return DocumentResponse(
+                document_id=document_info["document_id"],
+                filename=document_info["filename"],
+                size=document_info["size"],
+                success=False,
+                message=f"Unsupported file type: {document_info['metadata']['file_type']}. The file was not stored."
+            )
         
-        if processed_content:
-            print(f"Creating embeddings for document: {document_info['document_id']}")
-            
-            # Check content type for debugging
-            content_type = type(processed_content)
-            print(f"Content type: {content_type}")
-            
-            if isinstance(processed_content, str) and processed_content.startswith("Error"):
-                # Don't attempt embedding if there was a processing error
-                print(f"Skipping embedding due to processing error: {processed_content}")
-                return DocumentResponse(
-                    document_id=document_info["document_id"],
-                    filename=document_info["filename"],
-                    size=document_info["size"],
-                    success=True,
-                    message="Document uploaded but processing had errors. Embeddings not created."
-                )
-                
-            embedding_result = await create_document_embeddings(
+        print(f"Creating embeddings for document: {document_info['document_id']}")
+        try:
+            embedding_result = await ingest_document_stream(
                 document_info["document_id"],
-                processed_content,
-                document_info["metadata"]
+                content,
+                document_info["metadata"],
+                collection=collection
+            )
+        except Exception as e:
+            # Don't keep partial embeddings if the document could not be processed
+            print(f"Skipping embedding due to processing error: {str(e)}")
+            return DocumentResponse(
+                document_id=document_info["document_id"],
+                filename=document_info["filename"],
+                size=document_info["size"],
+                success=True,
+                message="Document uploaded but processing had errors. Embeddings not created."
+            )
+        
+        if not embedding_result.get("success"):
+            error_msg = f"Document {document_info['document_id']} uploaded but embedding failed: {embedding_result.get('error')}"
+            print(f"Warning: {error_msg}")
+            return DocumentResponse(
+                document_id=document_info["document_id"],
+                filename=document_info["filename"],
+                size=document_info["size"],
+                success=True,
+                message=error_msg
             )
-            
-            if not embedding_result.get("success"):
-                error_msg = f"Document {document_info['document_id']} uploaded but embedding failed: {embedding_result.get('error')}"
-                print(f"Warning: {error_msg}")
-                return DocumentResponse(
-                    document_id=document_info["document_id"],
-                    filename=document_info["filename"],
-                    size=document_info["size"],
-                    success=True,
-                    message=error_msg
-                )
         
         return DocumentResponse(
             document_id=document_info["document_id"],
@@ -129,37 +155,231 @@ async def upload_document(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=error_msg)
 
 
+@router.post("/upload", response_model=DocumentResponse)
+async def upload_document(
+    file: UploadFile = File(...),
+    collection: Optional[str] = Form(None, pattern=COLLECTION_NAME.pattern, description="Collection to add the document to (the default collection if omitted)")
+):
+    """Upload a document file and process it."""
+    return await ingest_upload(file, collection=collection)
+
+
+def document_exists(document_id: str) -> bool:
+    """Whether a document has embeddings or a stored original file (blocking)."""
+    if not valid_document_id(document_id):
+        return False
+    store = document_store(document_id)
+    return (store.embeddings_dir / f"{document_id}.json").exists() or bool(document_files(document_id))
+
+
+@router.put("/{document_id}", response_model=DocumentResponse)
+async def replace_document(
+    document_id: str,
+    file: UploadFile = File(...),
+    collection: Optional[str] = Form(None, pattern=COLLECTION_NAME.pattern, description="Collection to move the document to (its current collection if omitted)")
+):
+    """Replace a document with a new version, keeping its ID.
+
+    The new version is embedded before anything of the old one is touched; if
+    it cannot be processed the request fails and the old version stays. The
+    generation that publishes the new version also tombstones the old one, so
+    searches find one version or the other.
+    """
+    if not await run_io(document_exists, document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    previous = (await run_io(document_store, document_id)).name
+    collection = collection or previous
+
+    document_info = await run_io(store_uploaded_file, file.file, file.filename, document_id=document_id, staged=True)
+    staged_path = Path(document_info["path"])
+    file_type = document_info["metadata"]["file_type"]
+
+    def install() -> None:
+        # Chunks of other documents reusing the old version's vectors get
+        # copies before its embeddings are overwritten
+        promote_duplicates(document_id, previous)
+        install_staged_file(document_id, staged_path)
+
+    try:
+        content = await run_io(stream_document_content, staged_path)
+        if content is None:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Unsupported file type: {file_type}. The previous version is kept."
+            )
+        try:
+            result = await ingest_document_stream(
+                document_id, content, document_info["metadata"],
+                publish=False, collection=collection, before_write=install
+            )
+        except Exception as e:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Error processing document: {str(e)}. The previous version is kept."
+            )
+        if not result.get("success"):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Embedding failed: {result.get('error')}. The previous version is kept."
+            )
+        if not result["chunks"]:
+            # An empty new version has no embeddings to replace the old ones with
+            await run_io(install)
+            await run_io(delete_document_embeddings, document_id)
+        else:
+            # Publish the new version, which tombstones the old one in the same step
+            await asyncio.wrap_future(get_store(collection).schedule_refresh())
+            if collection != previous:
+                await run_io(retire_document_embeddings, document_id, previous)
+    finally:
+        await run_io(lambda: staged_path.unlink(missing_ok=True))
+
+    return DocumentResponse(
+        document_id=document_id,
+        filename=document_info["filename"],
+        size=document_info["size"],
+        success=True
+    )
+
+
+@router.delete("/{document_id}", response_model=DocumentDeleteResponse)
+async def delete_document(document_id: str):
+    """Delete a document, its embeddings and its original file."""
+    if not valid_document_id(document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    embeddings_deleted = await run_io(delete_document_embeddings, document_id)
+    files_deleted = await run_io(delete_document_files, document_id)
+    if not embeddings_deleted and not files_deleted:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return DocumentDeleteResponse(document_id=document_id, message="Document deleted")
+
+
 @router.post("/text", response_model=DocumentResponse)
 async def process_text(request: TextDocumentRequest):
     """Process a text document directly."""
     try:
-        document_info = process_text_document(
+        document_info = await run_io(
+            process_text_document,
             request.content,
             request.filename,
             request.metadata
         )
         
         # Process embeddings
-        create_document_embeddings(
+        embedding_result = await create_document_embeddings(
             document_info["document_id"],
             request.content,
-            document_info["metadata"]
+            document_info["metadata"],
+            collection=request.collection
         )
         
         return DocumentResponse(
             document_id=document_info["document_id"],
             filename=document_info["filename"],
             size=document_info["size"],
-            success=True
+            success=True,
+            message=None if embedding_result.get("success") else
+                f"Document stored but embedding failed: {embedding_result.get('error')}"
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing text: {str(e)}")
 
 
+async def ndjson_lines(request: Request) -> AsyncIterator[Tuple[int, bytes]]:
+    """Non-empty lines of a request body with their line numbers, read as the body arrives."""
+    buffer = b""
+    line_number = 0
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+
+def store_text_records(records: List[Tuple[int, TextDocumentRequest]]) -> List[Tuple[int, TextDocumentRequest, Optional[Dict], Optional[str]]]:
+    """Save each record's text as a document: (line, record, document info or None, error)."""
+    stored = []
+    for line_number, record in records:
+        try:
+            info = process_text_document(record.content, record.filename, record.metadata)
+            stored.append((line_number, record, info, None))
+        except Exception as e:
+            stored.append((line_number, record, None, f"Error storing text: {str(e)}"))
+    return stored
+
+
+@router.post("/text/bulk", response_model=BulkTextResponse)
+async def process_text_bulk(
+    request: Request,
+    collection: Optional[str] = Query(None, pattern=COLLECTION_NAME.pattern, description="Collection of records that name none (the default collection if omitted)")
+):
+    """Store and embed many text documents sent as NDJSON.
+
+    Each line of the body is a ``TextDocumentRequest`` object. The body is read
+    incrementally; every ``BULK_BATCH_RECORDS`` records are embedded together in
+    a few large requests and published to the index at once, one batch per
+    collection. The response reports the outcome of every record by line number.
+    """
+    statuses: List[BulkTextRecordStatus] = []
+    pending: List[Tuple[int, TextDocumentRequest]] = []
+    batches = 0
+
+    async def flush() -> None:
+        nonlocal batches
+        stored = await run_io(store_text_records, list(pending))
+        pending.clear()
+        valid = [(line_number, record, info) for line_number, record, info, _ in stored if info is not None]
+        statuses.extend(
+            BulkTextRecordStatus(line=line_number, success=False, error=error)
+            for line_number, _, info, error in stored if info is None
+        )
+        by_collection: Dict[Optional[str], List[Tuple[int, TextDocumentRequest, Dict]]] = {}
+        for line_number, record, info in valid:
+            by_collection.setdefault(record.collection or collection, []).append((line_number, record, info))
+        for name, group in by_collection.items():
+            batches += 1
+            results = await ingest_text_batch([
+                {"document_id": info["document_id"], "content": record.content, "metadata": info["metadata"]}
+                for _, record, info in group
+            ], name)
+            for (line_number, _, info), result in zip(group, results):
+                statuses.append(BulkTextRecordStatus(
+                    line=line_number,
+                    document_id=info["document_id"],
+                    filename=info["filename"],
+                    success=result["success"],
+                    chunks=result.get("chunks", 0),
+                    duplicates=result.get("duplicates", 0),
+                    error=result.get("error")
+                ))
+
+    async for line_number, line in ndjson_lines(request):
+        try:
+            pending.append((line_number, TextDocumentRequest.model_validate_json(line)))
+        except ValueError as e:
+            statuses.append(BulkTextRecordStatus(line=line_number, success=False, error=f"Invalid record: {str(e)}"))
+            continue
+        if len(pending) >= BULK_BATCH_RECORDS:
+            await flush()
+    if pending:
+        await flush()
+
+    statuses.sort(key=lambda status: status.line)
+    indexed = sum(status.success for status in statuses)
+    return BulkTextResponse(records=statuses, indexed=indexed, failed=len(statuses) - indexed, batches=batches)
+
+
 @router.get("/{document_id}", response_model=DocumentResponse)
 async def get_document(document_id: str):
     """Get document information."""
-    content = get_document_content(document_id)
+    if not valid_document_id(document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    # Extracting a PDF is CPU-bound
+    content = await asyncio.to_thread(get_document_content, document_id)
     if not content:
         raise HTTPException(status_code=404, detail="Document not found")
     
@@ -171,46 +391,40 @@ async def get_document(document_id: str):
     )
 
 
-# New endpoint to download original files
-@router.get("/download/{document_id}")
-async def download_document(document_id: str):
-    """Download the original document file."""
-    try:
-        found_file = None
+def find_original_file(document_id: str) -> Tuple[Path, str]:
+    """Locate a document's original file and its original filename (blocking)."""
+    if not valid_document_id(document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    entry = catalog.get_document(document_id)
+    if entry is not None and entry["path"]:
+        file_path, original_filename = Path(entry["path"]), entry["filename"]
+    else:
+        # Not in the catalog (e.g. uploaded without embeddings): use the id-named metadata file
         original_filename = None
-        
-        # 1. Find the corresponding metadata file to get the original filename and extension
-        embeddings_dir = Path(os.getenv("EMBEDDINGS_DIR", "./data/embeddings"))
-        metadata_path = embeddings_dir / f"{document_id}.json"
-        
         file_extension = ".bin" # Default extension if not found
+        metadata_path = Path(os.getenv("EMBEDDINGS_DIR", "./data/embeddings")) / f"{document_id}.json"
         if metadata_path.exists():
-             with open(metadata_path, "r") as f:
+            with open(metadata_path, "r") as f:
                 metadata = json.load(f)
                 original_filename = metadata.get("metadata", {}).get("filename")
                 file_extension = metadata.get("metadata", {}).get("file_type", file_extension)
-        else:
-            # Fallback: search for any metadata file containing this document_id
-            # This is less efficient but provides robustness if naming convention changes
-            for meta_file in embeddings_dir.glob("*.json"):
-                try:
-                    with open(meta_file, "r") as f:
-                        meta = json.load(f)
-                        if meta.get("document_id") == document_id:
-                             original_filename = meta.get("metadata", {}).get("filename")
-                             file_extension = meta.get("metadata", {}).get("file_type", file_extension)
-                             break
-                except: continue # Ignore files that can't be read
-                
         # Use document_id as fallback filename if original not found
         if not original_filename:
-             original_filename = f"{document_id}{file_extension}"
-
-        # 2. Construct the path to the original file in DOCUMENTS_DIR
+            original_filename = f"{document_id}{file_extension}"
         file_path = DOCUMENTS_DIR / f"{document_id}{file_extension}"
-        
-        if not file_path.exists():
-            raise HTTPException(status_code=404, detail=f"Original document file not found for ID: {document_id}")
+    
+    if not file_path.exists():
+        raise HTTPException(status_code=404, detail=f"Original document file not found for ID: {document_id}")
+    return file_path, original_filename
+
+
+# New endpoint to download original files
+@router.get("/download/{document_id}")
+async def download_document(document_id: str):
+    """Download the original document file."""
+    try:
+        # Reading metadata files blocks, so do it off the event loop
+        file_path, original_filename = await run_io(find_original_file, document_id)
 
         # 3. Determine MIME type
         mime_type, _ = mimetypes.guess_type(file_path)
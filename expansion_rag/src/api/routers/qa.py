@@ -1,14 +1,58 @@
 """Question answering routes using RAG."""
+import json
+from typing import Any, AsyncIterator, Dict
+
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError
 
-from ..models import QARequest, QAResponse, ChunkResponse
-from ..core.rag import generate_answer
+from ..models import QARequest, QAResponse, ChunkResponse, BatchQARequest, BatchQAResult
+from ..core.rag import generate_answer, answer_batch
 from ..core.embeddings import verify_document_embeddings, process_missing_embeddings
+from ..core.executors import run_io
+from .collections import require_collection
 
 router = APIRouter(prefix="/qa", tags=["question-answering"])
 
 
+async def ensure_embeddings() -> None:
+    """Embed any documents that are missing embeddings, or fail with a 400."""
+    verification = await verify_document_embeddings()
+    if not verification["is_complete"]:
+        # Process missing embeddings
+        processing_result = await process_missing_embeddings()
+
+        # Check if processing was successful
+        if not processing_result["verification"]["is_complete"]:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "message": "Failed to process all missing embeddings",
+                    "processing_result": processing_result
+                }
+            )
+
+
+def response_fields(result: Dict[str, Any]) -> Dict[str, Any]:
+    """QAResponse fields of a ``generate_answer`` result."""
+    return {
+        "answer": result["answer"],
+        "chunks": [
+            ChunkResponse(
+                document_id=chunk["document_id"],
+                chunk_id=chunk["chunk_id"],
+                text=chunk["text"],
+                score=chunk["score"],
+                metadata=chunk.get("metadata", {})
+            )
+            for chunk in result.get("chunks", [])
+        ],
+        "expanded_queries": result["expanded_queries"],
+        "success": result["success"],
+        "context_tokens": result.get("context_tokens"),
+    }
+
+
 @router.post("", response_model=QAResponse)
 async def answer_question(request: QARequest):
     """
@@ -18,56 +62,65 @@ async def answer_question(request: QARequest):
     1. Verifies that all documents have embeddings
     2. If any documents are missing embeddings, processes them automatically
     3. Takes a question
-    4. Retrieves relevant chunks from all documents using FAISS similarity search
+    4. Retrieves relevant chunks from all documents of the collection using FAISS similarity search
     5. Generates an answer using OpenAI
     """
     try:
+        collection = await run_io(require_collection, request.collection)
         # Verify document embeddings and process any missing ones
-        verification = await verify_document_embeddings()
-        if not verification["is_complete"]:
-            # Process missing embeddings
-            processing_result = await process_missing_embeddings()
-            
-            # Check if processing was successful
-            if not processing_result["verification"]["is_complete"]:
-                raise HTTPException(
-                    status_code=400,
-                    detail={
-                        "message": "Failed to process all missing embeddings",
-                        "processing_result": processing_result
-                    }
-                )
+        await ensure_embeddings()
         
         # Generate answer using RAG
         result = await generate_answer(
             query=request.query,
             top_k=request.top_k or 3,
             model=request.model,
-            temperature=request.temperature or 0.0
+            temperature=request.temperature or 0.0,
+            filters=request.filters.model_dump() if request.filters else None,
+            route_documents=request.route_documents,
+            collection=collection
         )
         
-        # Convert chunks to ChunkResponse model
-        chunks = [
-            ChunkResponse(
-                document_id=chunk["document_id"],
-                chunk_id=chunk["chunk_id"],
-                text=chunk["text"],
-                score=chunk["score"],
-                metadata=chunk.get("metadata", {})
-            )
-            for chunk in result.get("chunks", [])
-        ]
-        
-        return QAResponse(
-            answer=result["answer"],
-            chunks=chunks,
-            expanded_queries=result["expanded_queries"],
-            success=result["success"]
-        )
+        return QAResponse(**response_fields(result))
     
     except ValidationError as e:
         raise HTTPException(status_code=422, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
+
+
+@router.post("/batch")
+async def answer_questions(request: BatchQARequest):
+    """
+    Answer many questions in one request, streaming the answers as NDJSON.
+
+    The questions and their expansions are embedded in a few large requests and
+    searched together in one matrix search; completions then run concurrently
+    up to ``QA_BATCH_CONCURRENCY``. Each line is a ``BatchQAResult``, written as
+    soon as its answer completes, so lines arrive out of order; ``index`` gives
+    the position of the question in the request. If retrieval fails, the stream
+    ends with a line holding ``success: false`` and the ``error``.
+    """
+    collection = await run_io(require_collection, request.collection)
+    await ensure_embeddings()
+
+    async def stream() -> AsyncIterator[str]:
+        try:
+            async for index, result in answer_batch(
+                request.queries,
+                top_k=request.top_k or 3,
+                model=request.model,
+                temperature=request.temperature or 0.0,
+                filters=request.filters.model_dump() if request.filters else None,
+                route_documents=request.route_documents,
+                collection=collection
+            ):
+                line = BatchQAResult(index=index, query=request.queries[index], **response_fields(result))
+                yield line.model_dump_json() + "\n"
+        except Exception as e:
+            print(f"Error answering batch: {e}")
+            yield json.dumps({"success": False, "error": f"Error answering batch: {str(e)}"}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
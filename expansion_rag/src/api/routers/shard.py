@@ -0,0 +1,35 @@
+"""Shard server routes for scatter-gather search."""
+import asyncio
+from fastapi import APIRouter, HTTPException
+
+from ..models import ShardSearchRequest, ShardSearchResponse
+from ..core.corpus import SHARD_INDEX, SHARD_COUNT, get_store, list_collections, read_version
+from ..core.embeddings import search_corpus
+from ..core.shards import decode_vectors
+
+router = APIRouter(prefix="/shard", tags=["shard"])
+
+
+@router.post("/search", response_model=ShardSearchResponse)
+async def shard_search(request: ShardSearchRequest):
+    """Search this shard's corpus for a batch of query vectors."""
+    try:
+        vectors = decode_vectors(request.vectors, request.dimension)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid vectors: {e}")
+    results = await search_corpus(
+        vectors,
+        request.top_k,
+        request.filters.model_dump() if request.filters else None,
+        request.route_documents,
+        request.collection
+    )
+    return ShardSearchResponse(shard=SHARD_INDEX, results=results)
+
+
+@router.post("/refresh")
+async def shard_refresh():
+    """Sync this shard's corpus of every collection with the embeddings directories now."""
+    collections = await asyncio.to_thread(list_collections)
+    await asyncio.gather(*(asyncio.wrap_future(get_store(name).schedule_refresh()) for name in collections))
+    return {"shard": SHARD_INDEX, "shard_count": SHARD_COUNT, "generation": read_version()}
@@ -0,0 +1,43 @@
+"""Export or import a single-file corpus snapshot from the command line.
+
+Usage::
+
+    api-snapshot export corpus.snap
+    api-snapshot import corpus.snap
+
+Import with the service stopped, or let replicas import the file on their first
+start by setting ``CORPUS_SNAPSHOT`` (see ``core.snapshot``).
+"""
+import sys
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+from .core.snapshot import SnapshotError, export_snapshot, import_snapshot
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the snapshot tool."""
+    parser = argparse.ArgumentParser(description="Export or import a single-file corpus snapshot.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write the corpus, embeddings and catalog to a snapshot")
+    export_parser.add_argument("path", type=Path, help="Snapshot file to write")
+    import_parser = subparsers.add_parser("import", help="Install a snapshot as the live corpus")
+    import_parser.add_argument("path", type=Path, help="Snapshot file to read")
+    import_parser.add_argument("--no-verify", action="store_true", help="Skip the member checksums")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "export":
+            info = export_snapshot(args.path)
+        else:
+            info = import_snapshot(args.path, verify=not args.no_verify)
+    except (SnapshotError, OSError) as e:
+        print(f"Snapshot {args.command} failed: {e}")
+        sys.exit(1)
+    print(f"{args.command.capitalize()}ed {info['documents']} documents ({info['chunks']} chunks, "
+          f"dimension {info['dimension']}) {'to' if args.command == 'export' else 'from'} {args.path}")
+
+
+if __name__ == "__main__":
+    main()
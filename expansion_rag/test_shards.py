@@ -0,0 +1,142 @@
+"""Scatter-gather search check with local shard server processes.
+
+Starts ``SHARDS`` API servers on the shipped embeddings, each holding one
+partition of the corpus, and compares the coordinator's merged results with a
+single unsharded corpus. Then stops one shard and pauses another to check that
+queries still return within the deadline.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Number of shard processes to start
+SHARDS = int(os.getenv("TEST_SHARDS", "3"))
+# Random query vectors per check
+QUERIES = int(os.getenv("TEST_QUERIES", "20"))
+TOP_K = 5
+EMBEDDINGS_DIR = os.path.join(ROOT, "src", "api", "data", "embeddings")
+WORK_DIR = tempfile.mkdtemp(prefix="test-shards-")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+PORTS = [free_port() for _ in range(SHARDS)]
+URLS = [f"http://127.0.0.1:{port}" for port in PORTS]
+
+# Configure the coordinator (this process) before importing the app modules
+os.environ.update(
+    EMBEDDINGS_DIR=EMBEDDINGS_DIR,
+    CORPUS_DIR=os.path.join(WORK_DIR, "reference"),
+    CATALOG_PATH=os.path.join(WORK_DIR, "catalog.sqlite3"),
+    SHARD_URLS=",".join(URLS),
+    SHARD_DEADLINE_MS=os.getenv("SHARD_DEADLINE_MS", "2000"),
+)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import numpy as np
+from api.core.corpus import ensure_corpus, get_corpus
+from api.core.shards import scatter_search, close_http_client, SHARD_DEADLINE
+
+
+def start_shard(index: int) -> subprocess.Popen:
+    """Start one shard server on its port."""
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(SHARDS),
+        SHARD_INDEX=str(index),
+        CORPUS_DIR=os.path.join(WORK_DIR, f"shard{index}"),
+        CATALOG_PATH=os.path.join(WORK_DIR, f"catalog{index}.sqlite3"),
+        PYTHONPATH=os.path.join(ROOT, "src"),
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-shard-test"),
+        SHARD_URLS="",
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.app:app", "--port", str(PORTS[index]), "--log-level", "warning"],
+        env=env
+    )
+
+
+def wait_ready(url: str, timeout: float = 120) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"{url}/health", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Shard {url} did not start")
+
+
+def chunk_ids(results):
+    return [[chunk["chunk_id"] for chunk in query] for query in results]
+
+
+async def run_checks(vectors: np.ndarray, expected, shards) -> bool:
+    ok = True
+
+    start = time.perf_counter()
+    merged = await scatter_search(vectors, TOP_K)
+    elapsed = time.perf_counter() - start
+    matches = sum(a == b for a, b in zip(chunk_ids(merged), expected))
+    print(f"All shards: {matches}/{len(vectors)} queries match the unsharded top-{TOP_K} ({elapsed * 1000:.0f} ms)")
+    ok &= matches == len(vectors)
+
+    # A missing shard: its documents drop out, the others still answer
+    shards[0].terminate()
+    shards[0].wait()
+    # A slow shard: paused, so it never answers before the deadline
+    if len(shards) > 2:
+        shards[1].send_signal(signal.SIGSTOP)
+    start = time.perf_counter()
+    merged = await scatter_search(vectors, TOP_K)
+    elapsed = time.perf_counter() - start
+    answered = sum(bool(query) for query in merged)
+    print(f"Degraded: {answered}/{len(vectors)} queries answered in {elapsed * 1000:.0f} ms "
+          f"(deadline {SHARD_DEADLINE * 1000:.0f} ms)")
+    ok &= elapsed < SHARD_DEADLINE + 0.5 and answered > 0
+    if len(shards) > 2:
+        shards[1].send_signal(signal.SIGCONT)
+
+    await close_http_client()
+    return ok
+
+
+def main():
+    print(f"Building the unsharded reference corpus in {WORK_DIR}...")
+    ensure_corpus()
+    corpus = get_corpus()
+    rng = np.random.default_rng(0)
+    dimension = corpus.segments[0].dimension
+    vectors = rng.standard_normal((QUERIES, dimension)).astype(np.float32)
+    expected = chunk_ids(corpus.search(vectors, TOP_K))
+
+    print(f"Starting {SHARDS} shard servers...")
+    shards = [start_shard(i) for i in range(SHARDS)]
+    try:
+        for url in URLS:
+            wait_ready(url)
+        ok = asyncio.run(run_checks(vectors, expected, shards))
+    finally:
+        for shard in shards:
+            if shard.poll() is None:
+                shard.send_signal(signal.SIGCONT)
+                shard.terminate()
+                shard.wait()
+
+    print("OK" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Import-time budget check for the RAG API."""
+import os
+import sys
+import json
+import subprocess
+
+# Maximum seconds allowed for `import api.app` in a fresh interpreter
+BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "1.0"))
+# Dependencies that must not be loaded just by importing the app
+HEAVY_MODULES = ["openai", "faiss", "numpy", "tiktoken", "pdfplumber"]
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+import api.app
+elapsed = time.perf_counter() - start
+loaded = [name for name in {modules!r}
+          if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule"]
+print(json.dumps({{"seconds": elapsed, "loaded": loaded}}))
+"""
+
+
+def measure_import() -> dict:
+    """Import the app in a fresh interpreter and report time and loaded modules."""
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "sk-startup-check")
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(modules=HEAVY_MODULES)],
+        env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    # Take the best of a few runs to ignore a cold disk cache
+    runs = [measure_import() for _ in range(3)]
+    best = min(runs, key=lambda r: r["seconds"])
+    print(f"import api.app: {best['seconds']:.3f}s (budget {BUDGET_SECONDS:.3f}s)")
+    print(f"Heavy modules loaded at import: {best['loaded'] or 'none'}")
+
+    failed = False
+    if best["seconds"] > BUDGET_SECONDS:
+        print("FAIL: import time is over budget")
+        failed = True
+    if best["loaded"]:
+        print("FAIL: heavy modules are imported eagerly")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
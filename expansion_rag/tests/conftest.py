@@ -0,0 +1,175 @@
+"""Shared test setup: isolated data directories, an offline tokenizer and a fake OpenAI client.
+
+The API reads its directories from the environment at import time, so they are
+set before any ``api`` module is imported. Tests that store documents use a
+collection of their own (the ``collection`` fixture) to stay independent.
+"""
+import io
+import os
+import re
+import sys
+import uuid
+import zlib
+import asyncio
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pytest
+
+DATA_DIR = Path(tempfile.mkdtemp(prefix="rag-tests-"))
+os.environ.update({
+    "OPENAI_API_KEY": "sk-test",
+    "DOCUMENTS_DIR": str(DATA_DIR / "documents"),
+    "EMBEDDINGS_DIR": str(DATA_DIR / "embeddings"),
+    "SESSIONS_DIR": str(DATA_DIR / "sessions"),
+})
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# Dimension of the fake embeddings
+DIMENSION = 64
+_WORD = re.compile(r"\w+")
+
+
+class WordEncoding:
+    """Stand-in for a tiktoken encoding with one token per space-separated word."""
+
+    name = "words"
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._words: List[str] = []
+
+    def _id(self, word: str) -> int:
+        if word not in self._ids:
+            self._ids[word] = len(self._words)
+            self._words.append(word)
+        return self._ids[word]
+
+    def encode_ordinary(self, text: str) -> List[int]:
+        return [self._id(word) for word in text.split(" ")] if text else []
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        return self.encode_ordinary(text)
+
+    def encode_ordinary_batch(self, texts: List[str], num_threads: int = 1) -> List[List[int]]:
+        return [self.encode_ordinary(text) for text in texts]
+
+    def encode_batch(self, texts: List[str], num_threads: int = 1, **kwargs) -> List[List[int]]:
+        return self.encode_ordinary_batch(texts)
+
+    def decode(self, tokens: List[int]) -> str:
+        return " ".join(self._words[token] for token in tokens)
+
+    def decode_batch(self, batch: List[List[int]], num_threads: int = 1) -> List[str]:
+        return [self.decode(tokens) for tokens in batch]
+
+
+def embed_text(text: str) -> List[float]:
+    """Deterministic bag-of-words vector: texts sharing words are close."""
+    vector = [0.0] * DIMENSION
+    for word in _WORD.findall(text.lower()):
+        vector[zlib.crc32(word.encode()) % DIMENSION] += 1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+class _Record:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class FakeEmbeddings:
+    def __init__(self, client: "FakeOpenAI"):
+        self.client = client
+
+    async def create(self, input, model, **kwargs):
+        texts = input if isinstance(input, list) else [input]
+        self.client.embedding_requests.append(texts)
+        return _Record(data=[_Record(index=i, embedding=embed_text(text)) for i, text in enumerate(texts)])
+
+
+class FakeCompletions:
+    def __init__(self, client: "FakeOpenAI"):
+        self.client = client
+
+    async def create(self, model, messages, **kwargs):
+        self.client.chat_requests.append(messages)
+        await asyncio.sleep(self.client.latency)
+        content = self.client.answer(messages)
+        return _Record(choices=[_Record(message=_Record(content=content))])
+
+
+class FakeOpenAI:
+    """Records the requests it receives; embeddings come from ``embed_text``."""
+
+    def __init__(self):
+        # Seconds each chat completion takes
+        self.latency = 0.0
+        self.embedding_requests: List[List[str]] = []
+        self.chat_requests: List[List[Dict]] = []
+        self.embeddings = FakeEmbeddings(self)
+        self.chat = _Record(completions=FakeCompletions(self))
+
+    def answer(self, messages: List[Dict]) -> str:
+        """No alternative queries for query expansion, a numbered answer otherwise."""
+        if "query expansion" in messages[0]["content"]:
+            return ""
+        return f"answer {len(self.chat_requests)}"
+
+
+@pytest.fixture(autouse=True)
+def openai(monkeypatch) -> FakeOpenAI:
+    """Route every OpenAI call and token count of the API to offline fakes."""
+    from api.core import context, embeddings, rag
+
+    client = FakeOpenAI()
+    encoding = WordEncoding()
+    monkeypatch.setattr(embeddings, "get_openai_client", lambda: client)
+    monkeypatch.setattr(rag, "get_openai_client", lambda: client)
+    monkeypatch.setattr(embeddings, "get_encoding", lambda name="cl100k_base": encoding)
+    monkeypatch.setattr(context, "get_encoding", lambda name="cl100k_base": encoding)
+    return client
+
+
+@pytest.fixture
+def collection() -> str:
+    """Name of a new, empty collection."""
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def client():
+    """Test client of the app, started and stopped around each test."""
+    from fastapi.testclient import TestClient
+    from api.app import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+def upload(client, text: str, collection: str, filename: str = "notes.txt") -> str:
+    """Upload a text file into a collection and return its document id."""
+    response = client.post(
+        "/documents/upload",
+        files={"file": (filename, io.BytesIO(text.encode()), "text/plain")},
+        data={"collection": collection}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()["document_id"]
+
+
+def publish(client, collection: str) -> None:
+    """Wait until everything stored in the collection is searchable."""
+    from api.core import corpus
+
+    client.portal.call(lambda: asyncio.wrap_future(corpus.get_store(collection).schedule_refresh()))
+
+
+def search(client, query: str, collection: str, top_k: int = 10, filters: Optional[Dict] = None) -> List[Dict]:
+    """Chunks of the collection nearest to a query, best first."""
+    import numpy as np
+    from api.core import embeddings
+
+    vectors = np.array([embed_text(query)], dtype=np.float32)
+    return client.portal.call(embeddings.search_corpus, vectors, top_k, filters, 0, collection)[0]
@@ -0,0 +1,72 @@
+"""Lane priorities and fast rejections of the admission controller."""
+import time
+import asyncio
+
+import pytest
+
+from api.core.admission import AdmissionController, Rejected
+
+LANES = {
+    "interactive": {"priority": 0, "concurrency": 1, "queue": 8, "max_wait": 5.0},
+    "bulk": {"priority": 1, "concurrency": 1, "queue": 8, "max_wait": 5.0},
+}
+
+
+def test_interactive_requests_jump_the_bulk_queue():
+    async def scenario():
+        controller = AdmissionController(capacity=1, lanes=LANES)
+        started = []
+
+        async def request(lane: str, name: str) -> None:
+            await controller.acquire(lane)
+            started.append(name)
+
+        # A bulk request holds the only slot; more bulk work queues up behind it
+        await controller.acquire("bulk")
+        queued = [asyncio.create_task(request("bulk", f"bulk-{i}")) for i in range(2)]
+        await asyncio.sleep(0)
+        queued.append(asyncio.create_task(request("interactive", "interactive")))
+        await asyncio.sleep(0)
+        assert started == []
+
+        # Each finished request hands the slot to the next one
+        holder = "bulk"
+        for count in range(1, 4):
+            controller.release(holder, 0.01)
+            while len(started) < count:
+                await asyncio.sleep(0)
+            holder = started[-1].split("-")[0]
+        await asyncio.gather(*queued)
+        return started
+
+    assert asyncio.run(scenario()) == ["interactive", "bulk-0", "bulk-1"]
+
+
+def test_saturated_lane_rejects_on_arrival():
+    async def scenario():
+        controller = AdmissionController(capacity=4, lanes=LANES)
+        bulk = controller.lanes["bulk"]
+        # Bulk requests have been taking 2s each
+        bulk.service_time = 2.0
+        await controller.acquire("bulk")
+        # Expected waits of 2s and 4s are within the 5s budget
+        waiting = [asyncio.create_task(controller.acquire("bulk")) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert len(bulk.waiters) == 2
+
+        # The next one would wait about 6s: rejected at once, not after 5s
+        start = time.perf_counter()
+        with pytest.raises(Rejected) as rejected:
+            await controller.acquire("bulk")
+        assert time.perf_counter() - start < 0.1
+        assert rejected.value.status_code == 503
+        assert rejected.value.retry_after >= 6
+        assert bulk.rejected[503] == 1
+
+        # Other lanes are not affected by the bulk backlog
+        await asyncio.wait_for(controller.acquire("interactive"), 0.1)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+"""Packing retrieved chunks into the prompt token budget."""
+from api.core import context
+
+MODEL = "test-model"
+
+
+def chunk(rank: int, words: int) -> dict:
+    return {"text": " ".join(f"rank{rank}w{i}" for i in range(words)), "metadata": {"filename": f"doc{rank}.txt"}}
+
+
+def prompt_tokens(messages) -> int:
+    return sum(context.count_tokens(message["content"]) + context.MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def test_packing_stays_within_the_budget_and_keeps_the_best_chunks(monkeypatch):
+    monkeypatch.setitem(context.MODEL_TOKEN_BUDGETS, MODEL, 400)
+    monkeypatch.setattr(context, "CONTEXT_MIN_CHUNK_TOKENS", 20)
+    chunks = [chunk(rank, 100) for rank in range(6)]
+
+    packed = context.pack_context("be brief", "what is in the documents", chunks, MODEL, "user: hi assistant: hello")
+
+    tokens = packed["tokens"]
+    assert tokens["budget"] == 400
+    assert tokens["total"] <= 400
+    assert prompt_tokens(packed["messages"]) <= tokens["total"]
+    # The highest-ranked chunks, in rank order; the last one may be trimmed
+    kept = packed["chunks"]
+    assert 0 < len(kept) < len(chunks)
+    assert [c["metadata"]["filename"] for c in kept] == [f"doc{rank}.txt" for rank in range(len(kept))]
+    assert [c["text"] for c in kept[:-1]] == [c["text"] for c in chunks[:len(kept) - 1]]
+    assert chunks[len(kept) - 1]["text"].startswith(kept[-1]["text"])
+    assert tokens["dropped_chunks"] == len(chunks) - len(kept)
+
+
+def test_a_chunk_too_short_after_trimming_is_dropped(monkeypatch):
+    monkeypatch.setitem(context.MODEL_TOKEN_BUDGETS, MODEL, 80)
+    monkeypatch.setattr(context, "CONTEXT_MIN_CHUNK_TOKENS", 64)
+    chunks = [chunk(0, 100), chunk(1, 100)]
+
+    packed = context.pack_context("be brief", "question", chunks, MODEL)
+
+    # Not enough room for 64 tokens of even the best chunk
+    assert packed["chunks"] == []
+    assert packed["tokens"]["dropped_chunks"] == 2
+    assert packed["tokens"]["total"] <= 80
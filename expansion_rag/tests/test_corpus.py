@@ -0,0 +1,165 @@
+"""Segmented corpus index: search and metadata filters against a brute-force reference.
+
+Documents are written as per-document files, sealed into segments,
+tombstoned, replaced, compacted and merged; after every step the corpus must
+return exactly the chunks a linear scan of the live documents returns.
+"""
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from api.core import corpus
+
+DIMENSION = 16
+TOP_K = 7
+FILTERS = [
+    None,
+    {"document_ids": ["doc03", "doc07", "doc10"]},
+    {"filenames": ["REPORT"]},
+    {"file_types": ["pdf"]},
+    {"page_from": 2, "page_to": 4},
+    {"file_types": [".txt", ".pdf"], "filenames": ["annex"], "page_to": 3},
+    {"document_ids": ["doc01"], "file_types": [".txt"]},
+]
+
+
+class Reference:
+    """The live chunks of the per-document files, searched by a linear scan."""
+
+    def __init__(self, store: corpus.CorpusStore, seed: int = 7):
+        self.store = store
+        self.rng = np.random.RandomState(seed)
+        self.documents = {}
+
+    def write(self, document_id: str, chunks: int, filename: str, file_type: str) -> None:
+        vectors = self.rng.standard_normal((chunks, DIMENSION)).astype(np.float32)
+        pages = [i % 5 + 1 for i in range(chunks)] if file_type == ".pdf" else [None] * chunks
+        document_data = {
+            "document_id": document_id,
+            "metadata": {"filename": filename, "file_type": file_type},
+            "chunks": [
+                {"chunk_id": f"{document_id}_c{i}", "text": f"{document_id} chunk {i}", "page_number": page, "embedding_index": i}
+                for i, page in enumerate(pages)
+            ]
+        }
+        self.store.embeddings_dir.mkdir(parents=True, exist_ok=True)
+        index = faiss.IndexFlatL2(DIMENSION)
+        index.add(vectors)
+        faiss.write_index(index, str(self.store.embeddings_dir / f"{document_id}.index"))
+        metadata_path = self.store.embeddings_dir / f"{document_id}.json"
+        previous = metadata_path.stat().st_mtime_ns if metadata_path.exists() else 0
+        metadata_path.write_text(json.dumps(document_data))
+        # A replaced file must get a newer version even on coarse timestamps
+        if metadata_path.stat().st_mtime_ns <= previous:
+            os.utime(metadata_path, ns=(previous + 1, previous + 1))
+        self.documents[document_id] = (document_data, vectors)
+
+    def delete(self, document_id: str) -> None:
+        """Delete the way the API does: tombstone first, then remove the files."""
+        metadata_path = self.store.embeddings_dir / f"{document_id}.json"
+        self.store.add_tombstone(document_id, metadata_path.stat().st_mtime_ns)
+        metadata_path.unlink()
+        metadata_path.with_suffix(".index").unlink()
+        del self.documents[document_id]
+
+    def search(self, query: np.ndarray, filters) -> list:
+        rows = []
+        for document_id, (document_data, vectors) in self.documents.items():
+            metadata = document_data["metadata"]
+            for chunk, vector in zip(document_data["chunks"], vectors):
+                if filters and not self.matches(document_id, metadata, chunk["page_number"], filters):
+                    continue
+                rows.append((float(np.sum((vector - query) ** 2)), chunk["chunk_id"]))
+        return [chunk_id for _, chunk_id in sorted(rows)[:TOP_K]]
+
+    @staticmethod
+    def matches(document_id: str, metadata: dict, page, filters: dict) -> bool:
+        if "document_ids" in filters and document_id not in filters["document_ids"]:
+            return False
+        if "filenames" in filters and not any(name in metadata["filename"].lower() for name in filters["filenames"]):
+            return False
+        if "file_types" in filters and metadata["file_type"] not in filters["file_types"]:
+            return False
+        page = -1 if page is None else page
+        if "page_from" in filters or "page_to" in filters:
+            if page < max(filters.get("page_from") or 0, 0):
+                return False
+            if "page_to" in filters and page > filters["page_to"]:
+                return False
+        return True
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = corpus.CorpusStore("test", tmp_path / "embeddings", tmp_path / "embeddings" / "corpus")
+    yield store
+    store.unload()
+
+
+def assert_matches_reference(store: corpus.CorpusStore, reference: Reference, queries: np.ndarray) -> None:
+    for filters in FILTERS:
+        normalized = corpus.normalize_filters(filters)
+        results = store.search(queries, TOP_K, normalized)
+        for query, hits in zip(queries, results):
+            assert [hit["chunk_id"] for hit in hits] == reference.search(query, normalized), filters
+            for hit in hits:
+                assert hit["document_id"] == hit["chunk_id"].split("_")[0]
+                assert hit["text"] == hit["chunk_id"].replace("_c", " chunk ")
+
+
+def test_segments_match_brute_force_through_deletes_replaces_and_merges(store, monkeypatch):
+    monkeypatch.setattr(corpus, "MERGE_FANOUT", 3)
+    monkeypatch.setattr(corpus, "COMPACTION_THRESHOLD", 0.2)
+    reference = Reference(store)
+    queries = np.random.RandomState(11).standard_normal((5, DIMENSION)).astype(np.float32)
+    kinds = [("report-{}.pdf", ".pdf"), ("annex-{}.txt", ".txt"), ("Annual-Report-{}.txt", ".txt")]
+
+    # Three flushes leave three level-0 segments
+    for batch in range(3):
+        for n in range(batch * 4, batch * 4 + 4):
+            filename, file_type = kinds[n % len(kinds)]
+            reference.write(f"doc{n:02d}", 3 + n % 4, filename.format(n), file_type)
+        store.ensure_corpus()
+    generation = store.get_corpus()
+    assert [segment.level for segment in generation.segments] == [0, 0, 0]
+    assert_matches_reference(store, reference, queries)
+
+    # Deleted documents disappear through their tombstones before any rebuild
+    reference.delete("doc03")
+    reference.delete("doc05")
+    assert store.get_corpus() is generation
+    assert_matches_reference(store, reference, queries)
+
+    # A replaced document is only found in its new version once sealed
+    reference.write("doc07", 6, "report-7-consolidated.pdf", ".pdf")
+    store.ensure_corpus()
+    assert store.get_corpus().live_documents()["doc07"] == store.source_versions()["doc07"]
+    assert_matches_reference(store, reference, queries)
+
+    # Compaction drops the dead rows and merging folds the level into one segment
+    store.refresh_corpus()
+    generation = store.get_corpus()
+    assert generation.dead_rows == 0
+    assert max(segment.level for segment in generation.segments) == 1
+    assert len(generation.segments) < 4
+    assert store.current_tombstones()[1] == {}
+    assert sorted(generation.live_documents()) == sorted(reference.documents)
+    assert_matches_reference(store, reference, queries)
+
+
+def test_routed_search_matches_brute_force_over_the_routed_documents(store):
+    reference = Reference(store, seed=3)
+    for n in range(6):
+        reference.write(f"doc{n:02d}", 4, f"report-{n}.pdf", ".pdf")
+    store.ensure_corpus()
+    queries = np.random.RandomState(5).standard_normal((3, DIMENSION)).astype(np.float32)
+    generation = store.get_corpus()
+
+    routed = store.search(queries, TOP_K, route_documents=2)
+    for query, hits in zip(queries, routed):
+        documents = generation.route(query, 2)
+        assert len(documents) == 2
+        assert [hit["chunk_id"] for hit in hits] == reference.search(query, {"document_ids": documents})
@@ -0,0 +1,105 @@
+"""Near-duplicate chunks: detection, canonical promotion and what search returns."""
+import json
+import uuid
+
+from api.core import catalog, corpus, dedup, embeddings
+from conftest import publish, search
+
+ARTICLE = (
+    "member states shall ensure that large undertakings include in the management report information "
+    "necessary to understand the impacts of the undertaking on sustainability matters and information "
+    "necessary to understand how sustainability matters affect the development performance and position "
+    "of the undertaking including a brief description of the business model and strategy"
+)
+# The same article with its last word changed, as in a consolidated version
+AMENDED = ARTICLE.rsplit(" ", 1)[0] + " plans"
+ANNEX = "annex two lists the reporting standards adopted by delegated act for each sector of activity"
+TABLE = "table three gives the transition timeline for listed small and medium sized enterprises"
+SCHEDULE = "schedule four sets out penalties applicable to infringements of the national provisions"
+
+
+# Document ids of the ingested documents
+SOURCE, AMENDMENT, COPY = (str(uuid.uuid4()) for _ in range(3))
+
+
+def chunks(document_id: str, *texts: str) -> list:
+    return [{"chunk_id": f"{document_id}_t{i}", "text": text} for i, text in enumerate(texts)]
+
+
+def ingest(client, document_id: str, pages, collection: str) -> dict:
+    return client.portal.call(
+        embeddings.create_document_embeddings, document_id, pages, {"filename": f"{document_id}.pdf"}, False, collection
+    )
+
+
+def stored_chunks(document_id: str, collection: str) -> list:
+    with open(corpus.get_store(collection).embeddings_dir / f"{document_id}.json") as f:
+        return json.load(f)["chunks"]
+
+
+def test_split_separates_near_copies_from_canonical_chunks():
+    detector = dedup.DuplicateDetector("doc", scope="document")
+
+    canonical, duplicates = detector.split(chunks("doc", ARTICLE, AMENDED, ANNEX))
+
+    assert [chunk["chunk_id"] for chunk in canonical] == ["doc_t0", "doc_t2"]
+    assert duplicates == [{
+        "chunk_id": "doc_t1", "text": AMENDED,
+        "duplicate_of": "doc_t0", "duplicate_document": "doc", "embedding_index": None
+    }]
+
+
+def test_split_matches_indexed_chunks_of_other_documents_only():
+    signature = dedup.signature_bytes(dedup.minhash(ARTICLE))
+    # The catalog still lists a chunk of the document being re-ingested; it must not match itself
+    lookup = lambda keys: [("doc_t0", "doc", signature), ("other_t4", "other", signature)]
+
+    _, duplicates = dedup.DuplicateDetector("doc", lookup, scope="corpus").split(chunks("doc", AMENDED))
+    assert [(chunk["duplicate_of"], chunk["duplicate_document"]) for chunk in duplicates] == [("other_t4", "other")]
+
+    # Other scopes never consult the catalog
+    assert dedup.DuplicateDetector("doc", lookup, scope="document").split(chunks("doc", AMENDED))[1] == []
+    assert dedup.DuplicateDetector("doc", lookup, scope="off").split(chunks("doc", ARTICLE, ARTICLE))[1] == []
+
+
+def test_restore_canonical_drops_the_duplicate_link():
+    _, (duplicate,) = dedup.DuplicateDetector("doc", scope="document").split(chunks("doc", ARTICLE, AMENDED))
+
+    assert dedup.restore_canonical(duplicate) == {"chunk_id": "doc_t1", "text": AMENDED}
+
+
+def test_every_document_stays_searchable_and_duplicates_are_promoted_on_delete(client, collection):
+    assert ingest(client, SOURCE, [(1, ARTICLE), (2, ANNEX)], collection)["duplicates"] == 0
+    # One page repeats the source: it reuses the source's vector
+    amendment = ingest(client, AMENDMENT, [(1, AMENDED), (2, TABLE)], collection)
+    assert (amendment["chunks"], amendment["duplicates"]) == (2, 1)
+    # Only duplicates: the first one is promoted so the document keeps a vector of its own
+    copy = ingest(client, COPY, [(1, AMENDED), (2, ARTICLE)], collection)
+    assert (copy["chunks"], copy["duplicates"]) == (2, 1)
+    assert [chunk.get("embedding_index") for chunk in stored_chunks(COPY, collection)] == [0, None]
+    publish(client, collection)
+
+    # The amendment's copy of the article takes no row; its own page is still found
+    article_hits = {hit["document_id"] for hit in search(client, ARTICLE, collection)}
+    assert article_hits == {SOURCE, COPY, AMENDMENT}
+    assert [hit["text"] for hit in search(client, ARTICLE, collection) if hit["document_id"] == AMENDMENT] == [TABLE]
+    assert search(client, TABLE, collection, top_k=1)[0]["document_id"] == AMENDMENT
+    assert sum(1 for hit in search(client, ARTICLE, collection) if hit["text"] in (ARTICLE, AMENDED)) == 2
+
+    # Filters that leave the canonical chunk out find the duplicate under its own document and page
+    only_amendment = search(client, ARTICLE, collection, filters={"document_ids": [AMENDMENT]})
+    assert [(hit["text"], hit["metadata"]["page_number"]) for hit in only_amendment] == [(AMENDED, 1), (TABLE, 2)]
+    second_page = search(client, ARTICLE, collection, filters={"filenames": [COPY], "page_from": 2})
+    assert [(hit["document_id"], hit["text"]) for hit in second_page] == [(COPY, ARTICLE)]
+
+    # Deleting the source copies its vector into the amendment, which now answers for the article
+    assert set(catalog.duplicate_dependents(SOURCE)) == {AMENDMENT, COPY}
+    assert client.delete(f"/documents/{SOURCE}").status_code == 200
+    publish(client, collection)
+
+    promoted = stored_chunks(AMENDMENT, collection)
+    assert [(chunk["text"], chunk.get("embedding_index")) for chunk in promoted] == [(TABLE, 0), (AMENDED, 1)]
+    assert catalog.duplicate_dependents(SOURCE) == {}
+    hits = search(client, AMENDED, collection)
+    assert {hit["document_id"] for hit in hits if hit["text"] == AMENDED} == {AMENDMENT, COPY}
+    assert SOURCE not in {hit["document_id"] for hit in hits}
@@ -0,0 +1,179 @@
+"""Ingesting, deleting and replacing documents through the API, and tombstone filtering of search."""
+import io
+import asyncio
+import uuid
+
+import pytest
+
+from fastapi.testclient import TestClient
+
+from api.core import corpus, document_processor, embeddings, pipeline
+from api.core.embeddings import CHUNK_OVERLAP, CHUNK_SIZE
+from conftest import publish, search, upload
+
+ALPHA = "alpha apples arrive at the annual autumn market"
+BETA = "beta bananas belong in the blue basket"
+GAMMA = "gamma grapes grow on the green garden wall"
+
+
+def replace(client: TestClient, document_id: str, text: str, filename: str = "notes.txt", **data):
+    return client.put(
+        f"/documents/{document_id}",
+        files={"file": (filename, io.BytesIO(text.encode()), "text/plain")},
+        data=data
+    )
+
+
+def stored_text(document_id: str) -> str:
+    return (document_processor.DOCUMENTS_DIR / f"{document_id}.txt").read_text()
+
+
+def test_text_documents_are_embedded_in_batches(client, collection, openai, monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(embeddings, "EMBEDDING_CONCURRENCY", 2)
+    in_flight, peak = 0, 0
+    get_embeddings = embeddings.get_embeddings
+
+    async def counted(texts):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return await get_embeddings(texts)
+        finally:
+            in_flight -= 1
+
+    monkeypatch.setattr(embeddings, "get_embeddings", counted)
+    # Long enough for five chunks
+    text = " ".join(f"word{i}" for i in range(4 * (CHUNK_SIZE - CHUNK_OVERLAP) + CHUNK_SIZE))
+
+    response = client.post("/documents/text", json={"content": text, "filename": "long.txt", "collection": collection})
+    assert response.status_code == 200, response.text
+
+    assert sorted(len(request) for request in openai.embedding_requests) == [1, 2, 2]
+    assert peak == 2
+    publish(client, collection)
+    assert len(search(client, "word0", collection)) == 5
+
+
+def test_delete_hides_document_before_the_index_is_rebuilt(client, collection, monkeypatch):
+    # Keep the tombstoned rows in their segment instead of compacting them away
+    monkeypatch.setattr(corpus, "COMPACTION_THRESHOLD", 2.0)
+    kept = upload(client, ALPHA, collection)
+    deleted = upload(client, BETA, collection)
+    publish(client, collection)
+    assert {hit["document_id"] for hit in search(client, BETA, collection)} == {kept, deleted}
+
+    response = client.delete(f"/documents/{deleted}")
+    assert response.status_code == 200
+
+    # The tombstone hides the rows; no segment has been rewritten yet
+    assert deleted in corpus.get_store(collection).current_tombstones()[1]
+    assert {hit["document_id"] for hit in search(client, BETA, collection)} == {kept}
+    assert client.delete(f"/documents/{deleted}").status_code == 404
+
+
+def test_replace_publishes_the_new_version_and_tombstones_the_old(client, collection):
+    document_id = upload(client, ALPHA, collection)
+    publish(client, collection)
+    old_version = corpus.get_store(collection).source_versions()[document_id]
+
+    response = replace(client, document_id, GAMMA)
+    assert response.status_code == 200, response.text
+    assert response.json()["document_id"] == document_id
+
+    # Searchable as soon as the request returns, with the old rows filtered out
+    hits = search(client, "gamma grapes", collection)
+    assert [hit["text"] for hit in hits] == [GAMMA]
+    assert all(hit["text"] != ALPHA for hit in search(client, ALPHA, collection))
+    store = corpus.get_store(collection)
+    assert store.get_corpus().live_documents()[document_id] == store.source_versions()[document_id] > old_version
+    assert stored_text(document_id) == GAMMA
+
+
+def test_replace_with_an_unsupported_file_keeps_the_old_version(client, collection):
+    document_id = upload(client, ALPHA, collection)
+    publish(client, collection)
+
+    response = replace(client, document_id, GAMMA, filename="notes.xyz")
+    assert response.status_code == 415
+    assert "previous version is kept" in response.json()["detail"]
+
+    assert [hit["text"] for hit in search(client, ALPHA, collection)] == [ALPHA]
+    assert document_id not in corpus.get_store(collection).current_tombstones()[1]
+    assert stored_text(document_id) == ALPHA
+    assert not list(document_processor.STAGING_DIR.glob(f"{document_id}-*"))
+
+
+def test_replace_that_fails_to_embed_keeps_the_old_version(client, collection, monkeypatch):
+    document_id = upload(client, ALPHA, collection)
+    publish(client, collection)
+
+    async def unavailable(texts):
+        raise ConnectionError("embedding service unavailable")
+
+    monkeypatch.setattr(pipeline, "get_embeddings", unavailable)
+    response = replace(client, document_id, GAMMA)
+    assert response.status_code == 500
+    assert "previous version is kept" in response.json()["detail"]
+
+    publish(client, collection)
+    assert [hit["text"] for hit in search(client, ALPHA, collection)] == [ALPHA]
+    assert stored_text(document_id) == ALPHA
+
+
+def test_replace_with_an_empty_file_removes_the_old_embeddings(client, collection):
+    document_id = upload(client, ALPHA, collection)
+    publish(client, collection)
+
+    response = replace(client, document_id, "")
+    assert response.status_code == 200, response.text
+
+    assert search(client, ALPHA, collection) == []
+    assert stored_text(document_id) == ""
+
+
+def test_replace_can_move_a_document_to_another_collection(client, collection):
+    target = f"{collection}-moved"
+    document_id = upload(client, ALPHA, collection)
+    publish(client, collection)
+
+    response = replace(client, document_id, GAMMA, collection=target)
+    assert response.status_code == 200, response.text
+
+    assert [hit["document_id"] for hit in search(client, GAMMA, target)] == [document_id]
+    assert search(client, ALPHA, collection) == []
+    assert embeddings.document_store(document_id).name == target
+
+
+def test_replace_of_an_unknown_document_is_not_found(client):
+    assert replace(client, "no-such-document", GAMMA).status_code == 404
+    assert replace(client, str(uuid.uuid4()), GAMMA).status_code == 404
+
+
+@pytest.mark.parametrize("document_id", ["*", "?" * 36, "%3F", "..%2F..%2Fdocuments", "*.txt"])
+def test_ids_that_are_not_document_ids_touch_no_files(client, collection, document_id):
+    kept = [upload(client, ALPHA, collection), upload(client, BETA, collection)]
+
+    assert client.delete(f"/documents/{document_id}").status_code == 404
+    assert replace(client, document_id, GAMMA).status_code == 404
+    assert client.get(f"/documents/{document_id}").status_code == 404
+
+    assert [stored_text(document_id) for document_id in kept] == [ALPHA, BETA]
+    assert document_processor.document_files("*") == []
+    assert not document_processor.delete_document_files("*")
+    with pytest.raises(ValueError):
+        document_processor.install_staged_file("../" + kept[0], document_processor.STAGING_DIR / "x.txt")
+
+
+def test_unsupported_uploads_are_not_stored(client, collection):
+    response = client.post(
+        "/documents/upload",
+        files={"file": ("notes.xyz", io.BytesIO(ALPHA.encode()), "application/octet-stream")},
+        data={"collection": collection}
+    )
+    assert response.status_code == 200
+    assert not response.json()["success"]
+    document_id = response.json()["document_id"]
+    assert not list(document_processor.DOCUMENTS_DIR.glob(f"{document_id}*"))
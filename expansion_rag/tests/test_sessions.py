@@ -0,0 +1,159 @@
+"""Server-side chat sessions: retrieval reuse and serialized turns."""
+import asyncio
+import gc
+import time
+
+import httpx
+import pytest
+
+from api.app import app
+from api.core import sessions
+from conftest import publish, upload
+
+ORCHARD = "apple orchards need pruning in late winter before the buds open"
+HARBOUR = "harbour cranes unload containers from cargo ships at night"
+
+
+def ask(client, session_id: str, message: str, collection: str, **fields) -> dict:
+    response = client.post("/chat/process", json={
+        "message": message, "session_id": session_id, "collection": collection, **fields
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def settle(client) -> None:
+    """Wait for background summarization of the sessions to finish."""
+    async def wait():
+        while sessions._compactions:
+            await asyncio.gather(*sessions._compactions)
+
+    client.portal.call(wait)
+
+
+@pytest.fixture
+def session_id(client) -> str:
+    return client.post("/chat/sessions").json()["session_id"]
+
+
+def test_follow_up_reuses_the_last_retrieval(client, collection, session_id, openai):
+    upload(client, ORCHARD, collection)
+    upload(client, HARBOUR, collection)
+    publish(client, collection)
+
+    first = ask(client, session_id, "when to prune apple orchards", collection)
+    assert not first["reused_retrieval"]
+    assert first["chunks"][0]["text"] == ORCHARD
+
+    # A close follow-up answers from the same chunks without expanding the query again
+    expansions = sum("query expansion" in request[0]["content"] for request in openai.chat_requests)
+    follow_up = ask(client, session_id, "when to prune apple orchards exactly", collection)
+    assert follow_up["reused_retrieval"]
+    assert follow_up["chunks"] == first["chunks"]
+    assert sum("query expansion" in request[0]["content"] for request in openai.chat_requests) == expansions
+
+    # An unrelated question searches again, as does a forced refresh
+    other = ask(client, session_id, "cargo ships and harbour cranes", collection)
+    assert not other["reused_retrieval"]
+    assert other["chunks"][0]["text"] == HARBOUR
+    forced = ask(client, session_id, "cargo ships and harbour cranes", collection, reuse_retrieval=False)
+    assert not forced["reused_retrieval"]
+
+    settle(client)
+    stored = client.get(f"/chat/sessions/{session_id}").json()
+    assert (len(stored["messages"]), stored["summarized_messages"]) == (6, 2)
+
+
+def test_concurrent_turns_of_a_session_are_applied_in_order(client, collection, session_id, openai):
+    upload(client, ORCHARD, collection)
+    publish(client, collection)
+    openai.latency = 0.05
+
+    async def both_turns():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(
+                http.post("/chat/process", json={"message": message, "session_id": session_id, "collection": collection})
+                for message in ("first question", "second question")
+            ))
+
+    responses = client.portal.call(both_turns)
+    assert [response.status_code for response in responses] == [200, 200]
+
+    # Each turn saw the one before it: no message was lost to an interleaved save
+    messages = client.get(f"/chat/sessions/{session_id}").json()["messages"]
+    assert [message["role"] for message in messages] == ["user", "assistant", "user", "assistant"]
+    assert {messages[0]["content"], messages[2]["content"]} == {"first question", "second question"}
+    assert responses[0].json()["history_tokens"] != responses[1].json()["history_tokens"]
+
+
+def test_session_locks_are_only_kept_for_valid_ids_in_use(client, collection, session_id):
+    upload(client, ORCHARD, collection)
+    publish(client, collection)
+    with pytest.raises(ValueError):
+        sessions.session_lock("../../etc/passwd")
+    response = client.post("/chat/process", json={"message": "hello", "session_id": "not-a-session", "collection": collection})
+    assert response.status_code == 404
+
+    ask(client, session_id, "hello", collection)
+    gc.collect()
+    assert session_id not in sessions._locks
+    assert "not-a-session" not in sessions._locks
+
+
+def append_turn(session_id: str, question: str, answer: str) -> None:
+    """Record a turn the way another worker does: under the session's lock file."""
+    with sessions.session_file_lock(session_id):
+        session = sessions.load_session(session_id)
+        sessions.add_message(session, "user", question)
+        sessions.add_message(session, "assistant", answer)
+        sessions.save_session(session)
+
+
+def test_a_turn_waits_for_the_session_lock_of_another_worker(client, collection, session_id):
+    upload(client, ORCHARD, collection)
+    publish(client, collection)
+
+    async def turn():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post("/chat/process", json={"message": "second question", "session_id": session_id, "collection": collection})
+
+    with sessions.session_file_lock(session_id):
+        pending = client.portal.start_task_soon(turn)
+        time.sleep(0.2)
+        assert not pending.done()
+        session = sessions.load_session(session_id)
+        sessions.add_message(session, "user", "first question")
+        sessions.save_session(session)
+
+    assert pending.result(timeout=10).status_code == 200
+    messages = client.get(f"/chat/sessions/{session_id}").json()["messages"]
+    assert [message["content"] for message in messages[:2]] == ["first question", "second question"]
+    assert len(messages) == 3
+
+
+def test_summarization_keeps_turns_saved_while_it_ran(client, session_id, openai, monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_RECENT_MESSAGES", 2)
+    append_turn(session_id, "q1", "a1")
+    append_turn(session_id, "q2", "a2")
+    openai.latency = 0.2
+
+    compacting = client.portal.start_task_soon(sessions.compact_session, session_id)
+    time.sleep(0.05)
+    append_turn(session_id, "q3", "a3")
+    assert compacting.result(timeout=10)
+
+    session = sessions.load_session(session_id)
+    assert session["summary"] and session["summarized_messages"] == 2
+    assert [message["content"] for message in session["messages"]] == ["q2", "a2", "q3", "a3"]
+    assert session["history_tokens"] == session["summary_tokens"] + sum(m["tokens"] for m in session["messages"])
+
+
+def test_deleting_a_session_removes_its_lock_file(client, session_id):
+    append_turn(session_id, "q1", "a1")
+    assert (sessions.SESSIONS_DIR / f"{session_id}.lock").exists()
+
+    assert client.delete(f"/chat/sessions/{session_id}").status_code == 200
+    assert not (sessions.SESSIONS_DIR / f"{session_id}.lock").exists()
+    assert client.get(f"/chat/sessions/{session_id}").status_code == 404
@@ -0,0 +1,58 @@
+"""Corpus snapshots: export and import every collection with the catalog."""
+import os
+import uuid
+import errno
+
+from api.core import catalog, snapshot
+from api.core.snapshot import SnapshotReader
+from conftest import publish, search, upload
+
+CHARTER = "the charter sets out the rights of members and the duties of the board"
+LEDGER = "the ledger records every payment made by the treasury during the year"
+
+
+def test_snapshot_restores_every_collection(client, collection, tmp_path):
+    other = f"test-{uuid.uuid4().hex[:12]}"
+    charter = upload(client, CHARTER, collection, "charter.txt")
+    ledger = upload(client, LEDGER, other, "ledger.txt")
+    publish(client, collection)
+    publish(client, other)
+
+    path = tmp_path / "corpus.snap"
+    info = snapshot.export_snapshot(path)
+    assert info["collections"][collection] == {"documents": 1, "chunks": 1}
+    assert info["collections"][other] == {"documents": 1, "chunks": 1}
+    with SnapshotReader(path) as reader:
+        for name, document_id in ((collection, charter), (other, ledger)):
+            assert f"{name}/embeddings/{document_id}.json" in reader.members
+            assert f"{name}/segment/manifest.json" in reader.members
+
+    for document_id in (charter, ledger):
+        assert client.delete(f"/documents/{document_id}").status_code == 200
+    publish(client, collection)
+    publish(client, other)
+    assert search(client, CHARTER, collection) == []
+    assert search(client, LEDGER, other) == []
+
+    snapshot.import_snapshot(path)
+    assert [hit["document_id"] for hit in search(client, CHARTER, collection)] == [charter]
+    assert [hit["document_id"] for hit in search(client, LEDGER, other)] == [ledger]
+    assert catalog.get_document(charter)["collection"] == collection
+    assert catalog.get_document(ledger)["collection"] == other
+
+
+def test_extract_falls_back_to_copying_through_the_map(tmp_path, monkeypatch):
+    source = tmp_path / "member.bin"
+    source.write_bytes(bytes(range(256)) * 40)
+    path = tmp_path / "members.snap"
+    snapshot.write_snapshot(path, [("member.bin", source)], {})
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "cross-device")
+
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    with SnapshotReader(path) as reader:
+        reader.verify()
+        reader.extract("member.bin", tmp_path / "copy.bin")
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert (tmp_path / "copy.bin").stat().st_mtime_ns == source.stat().st_mtime_ns